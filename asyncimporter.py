@@ -0,0 +1,313 @@
+"""
+Imports files from asyncio code without blocking the event loop.
+
+`AsyncFileImporter` has the same semantics as `service.FileImporter`, and
+runs the same steps, but awaits them. Requests to the dataservice are made
+with `aiohttp` if it is installed, otherwise with `requests` on the
+importer's executor. Calls to s3 are always made on the executor, which
+bounds how many are made at once.
+
+Usage:
+```
+async with AsyncFileImporter(api, cavatica_token) as importer:
+    async for record, name, res in importer.import_many(records, 32):
+        ...
+```
+"""
+import os
+import time
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import service
+
+
+# Number of records imported at once by `import_many()`
+IMPORT_CONCURRENCY = int(os.environ.get('IMPORT_CONCURRENCY', 16))
+# Number of s3 calls that may be made at once
+S3_WORKERS = int(os.environ.get('ASYNC_S3_WORKERS', 16))
+# Seconds that a request to the dataservice may take with `aiohttp`
+REQUEST_TIMEOUT = float(os.environ.get('DATASERVICE_TIMEOUT', 30))
+
+
+class Response:
+    """
+    The parts of a `requests` response used by the importer
+    """
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class AsyncFileImporter:
+    """
+    Imports files asynchronously, see `service.FileImporter`
+
+    :param importer: Optional `FileImporter` to share clients, hasher and
+        cached study external_ids with
+    :param executor: Optional executor to make s3 calls on, otherwise one
+        with `S3_WORKERS` threads is made
+    :param session: Optional `aiohttp.ClientSession` for the dataservice
+    """
+
+    def __init__(self, api, cavatica_token, clients=None, hasher=None,
+                 importer=None, executor=None, session=None):
+        self.importer = importer or service.FileImporter(
+            api, cavatica_token, clients=clients, hasher=hasher)
+        self.api = self.importer.api
+        self.executor = executor or ThreadPoolExecutor(max_workers=S3_WORKERS)
+        self._own_executor = executor is None
+        self.session = session
+        self._own_session = False
+        self.started = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes the session and executor, if they were made by the importer
+        """
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs a blocking function on the executor
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor,
+                                    partial(func, *args, **kwargs))
+
+    async def import_many(self, records, concurrency=IMPORT_CONCURRENCY,
+                          should_stop=None, sink=None, run_id=None):
+        """
+        Imports records, `concurrency` at a time, yielding
+        `(record, bucket/key, result)` as each completes
+
+        :param should_stop: Optional function called before each record is
+            started. Once it returns True, no more records are started and
+            `started` is the number of records that were started. Records
+            whose harmonized file was registered by then are paused, see
+            `import_from_event()`.
+        :param sink: Optional `outcomes.OutcomeSink` to record outcomes in,
+            paused records are recorded once they complete
+        """
+        records = iter(records)
+        pending = set()
+        stopping = False
+
+        def start_next():
+            if should_stop is not None and should_stop():
+                return False
+            record = next(records, None)
+            if record is None:
+                return False
+            self.started += 1
+            pending.add(asyncio.ensure_future(
+                self._import(record, sink, run_id, should_stop)))
+            return True
+
+        try:
+            while not stopping and len(pending) < concurrency:
+                stopping = not start_next()
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.remove(task)
+                    yield task.result()
+                    if not stopping:
+                        stopping = not start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _import(self, record, sink=None, run_id=None,
+                      should_stop=None):
+        bucket = record['s3']['bucket']['name']
+        key = record['s3']['object']['key']
+        name = '{}/{}'.format(bucket, key)
+        start = time.time()
+        res = await self.import_from_event(record, should_stop)
+        if sink is not None and res['stage'] != service.PAUSED:
+            sink.append(name, res, start, time.time() - start, run_id)
+        return record, name, res
+
+    async def import_from_event(self, event, should_stop=None):
+        """
+        Processes a single record from an s3 event, pausing it once its
+        harmonized file is registered if `should_stop` returns True, see
+        `service.FileImporter.import_from_event()`
+        """
+        res = {'harmonized': 'not imported', 'source': 'not imported',
+               'kf_ids': [], 'stage': 'done'}
+        marker = self.importer.resume(event, res)
+        if marker is None:
+            f = self.importer.harmonized_file(event)
+            try:
+                await self.run_steps(f)
+                res['harmonized'] = 'imported'
+                res['kf_ids'].append(f.gf['kf_id'])
+            except service.IMPORT_ERRORS as err:
+                res['harmonized'] = str(err)
+                res['retry'] = service.is_transient(err)
+                res['stage'] = f.stage
+                return res
+            marker = self.importer.progress(f)
+            if should_stop is not None and should_stop():
+                res['stage'] = service.PAUSED
+                res['progress'] = marker
+                return res
+
+        f = None
+        try:
+            f = await self.run(self.importer.source_file, marker['tags'])
+            await self.run_steps(f)
+            res['kf_ids'].append(f.gf['kf_id'])
+            res['source'] = 'imported'
+        except service.SOURCE_ERRORS as err:
+            res['source'] = str(err)
+            res['retry'] = service.is_transient(err)
+            res['stage'] = f.stage if f is not None else \
+                self.importer.steps[0]
+            if res['retry']:
+                res['progress'] = marker
+
+        return res
+
+    async def register_input(self, harm_tags):
+        """
+        Registers a source genomic file given the tags of its harmonized
+        file, see `service.FileImporter.register_input()`
+
+        :returns: The kf_id of the source genomic file
+        """
+        f = await self.run(self.importer.source_file, harm_tags)
+        await self.run_steps(f)
+        return f.gf['kf_id']
+
+    async def run_steps(self, f):
+        """
+        Awaits every step of the import of a file in turn
+        """
+        for step in self.importer.steps:
+            f.stage = step
+            await getattr(self, step)(f)
+        f.stage = 'done'
+
+    async def read_tags(self, f):
+        await self.run(self.importer.read_tags, f)
+
+    async def check(self, f):
+        """
+        See `service.FileImporter.check()`
+        """
+        if 'gf_id' in f.tags:
+            resp = await self.get(self.api+'genomic-files/'+f.tags['gf_id'])
+            f.gf_id = service.check_gf_id(f.tags['gf_id'], resp)
+        else:
+            f.gf_id = None
+
+        if not f.harmonized:
+            obj = await self.run(f.client.get_object, Bucket=f.bucket,
+                                 Key=f.key)
+            f.size = obj['ContentLength']
+            f.etag = obj['ETag']
+            return
+
+        service.check_required_tags(f.tags)
+        if f.tags['bs_id'] in self.importer.biospecimens:
+            return
+        service.check_biospecimen(
+            await self.get(self.api+'biospecimens/'+f.tags['bs_id']))
+
+    async def hash(self, f):
+        await self.run(self.importer.hash, f)
+
+    async def register(self, f):
+        """
+        See `service.FileImporter.register()`
+        """
+        tags = f.harm_tags or f.tags
+        gf = service.genomic_file(f.bucket, f.key, f.etag, f.size,
+                                  gf_id=f.gf_id, bs_id=tags['bs_id'],
+                                  study_id=tags['study_id'], hashes=f.hashes)
+        external_id = await self.get_external_id(tags['study_id'])
+        if external_id:
+            gf['acl'].append(external_id)
+        resp = await self.post(self.api+'genomic-files', json=gf)
+        f.gf = service.created_file(resp)
+
+    async def write_tags(self, f):
+        await self.run(self.importer.write_tags, f)
+
+    async def get_external_id(self, study_id):
+        external_ids = self.importer.external_ids
+        if study_id is None:
+            return
+        if study_id in external_ids:
+            return external_ids[study_id]
+        external_id = service.external_id_from(
+            await self.get(self.api+'studies/'+study_id))
+        if external_id is not None:
+            external_ids[study_id] = external_id
+        return external_id
+
+    async def get(self, url):
+        """
+        Makes a GET request to the dataservice
+
+        :raises: `service.TransientException` if the request timed out, was
+            throttled or met a server error
+        """
+        if aiohttp is None and self.session is None:
+            return await self.run(self.importer.get, url)
+        return await self._request('GET', url)
+
+    async def post(self, url, json):
+        """
+        Makes a POST request to the dataservice
+
+        :raises: `service.TransientException` if the request timed out, was
+            throttled or met a server error
+        """
+        if aiohttp is None and self.session is None:
+            return await self.run(self.importer.post, url, json)
+        return await self._request('POST', url, json=json)
+
+    async def _request(self, method, url, **kwargs):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+            self._own_session = True
+        try:
+            async with self.session.request(method, url, **kwargs) as resp:
+                try:
+                    body = await resp.json(content_type=None)
+                except ValueError:
+                    body = {}
+                status = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise service.TransientException('dataservice request failed: {}'
+                                             .format(err))
+        if status in service.TRANSIENT_STATUS:
+            raise service.TransientException('dataservice responded with {}'
+                                             .format(status))
+        return Response(status, body or {})
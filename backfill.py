@@ -0,0 +1,257 @@
+"""
+Backfills a bucket+prefix into the dataservice from the command line.
+
+Rather than fanning out through the invoker and the fileregistry lambda,
+objects are listed locally and imported by a pool of processes, each
+running a pool of threads for the s3 and dataservice requests.
+
+Usage:
+    python backfill.py kf-study-us-east-1-dev-sd-0000000 \\
+        --prefix harmonized/ --api http://localhost:5000/ \\
+        --processes 4 --threads 16 --rate 200 \\
+        --cursor backfill.cursor --results backfill.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import boto3
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                ALL_COMPLETED, FIRST_COMPLETED, wait)
+
+import invoker
+import service
+
+
+# The importer and thread pool of each worker process
+_importer = None
+_pool = None
+
+
+def init_worker(api, cavatica_token, threads):
+    """
+    Sets up the importer and thread pool in a worker process
+    """
+    global _importer, _pool
+    # Keep a connection open to s3 for every thread
+    _importer = service.FileImporter(api, cavatica_token,
+                                     clients=service.S3ClientPool(threads))
+    _pool = ThreadPoolExecutor(max_workers=threads)
+
+
+def import_chunk(records, api, threads):
+    """
+    Imports a chunk of records on the worker's thread pool, setting it up
+    on the first chunk a process receives
+
+    :returns: A list of `{bucket/key: result}` dicts, as returned by the
+        handler, in the same order as the records. Unexpected errors are
+        recorded in the result of their record rather than raised.
+    """
+    if _importer is None:
+        init_worker(api, None, threads)
+
+    def import_record(record):
+        name = '{}/{}'.format(record['s3']['bucket']['name'],
+                              record['s3']['object']['key'])
+        try:
+            res = _importer.import_from_event(record)
+        except Exception as err:
+            # Recorded so that one bad record does not end the backfill,
+            # in the same shape as the results of `import_from_event()`
+            res = {'harmonized': str(err), 'source': 'not imported',
+                   'kf_ids': [], 'stage': _importer.steps[0],
+                   'retry': service.is_transient(err)}
+        return {name: res}
+
+    return list(_pool.map(import_record, records))
+
+
+def read_cursor(path):
+    """
+    Returns the last key completed by a previous run, if any
+    """
+    if path is None or not os.path.exists(path):
+        return ''
+    with open(path) as f:
+        return f.read().strip()
+
+
+def write_cursor(path, key):
+    """
+    Atomically replaces the cursor with the given key
+    """
+    if path is None:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(key)
+    os.replace(tmp, path)
+
+
+def chunks(bucket, objects, size):
+    """
+    Groups objects into lists of at most `size` s3 event records
+    """
+    chunk = []
+    for obj in objects:
+        chunk.append(invoker.event_generator(bucket, obj.key, obj.size,
+                                             obj.e_tag))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+class Backfill:
+    """
+    Dispatches chunks of records to an executor and keeps track of progress
+
+    Chunks may complete out of order, so the cursor is only advanced to the
+    last key of the longest run of completed chunks from the start. A
+    resumed run may repeat some records that had completed after a gap,
+    which is harmless as they will be found to be registered already.
+    """
+
+    def __init__(self, executor, api, threads, in_flight, rate=None,
+                 cursor=None, results=None, progress=10, out=sys.stderr):
+        self.executor = executor
+        self.api = api
+        self.threads = threads
+        self.in_flight = in_flight
+        self.rate = rate
+        self.cursor = cursor
+        self.results = results
+        self.progress = progress
+        self.out = out
+
+        self.listed = 0
+        self.done = 0
+        self.start = None
+        self.last_report = None
+        # Last key of each chunk that has not yet advanced the cursor
+        self.pending = {}
+        self.completed = set()
+        self.next_seq = 0
+
+    def run(self, chunks):
+        self.start = self.last_report = time.time()
+        futures = {}
+        for seq, chunk in enumerate(chunks):
+            self.throttle()
+            self.listed += len(chunk)
+            self.pending[seq] = chunk[-1]['s3']['object']['key']
+            future = self.executor.submit(import_chunk, chunk,
+                                          self.api, self.threads)
+            futures[future] = seq
+
+            if len(futures) >= self.in_flight:
+                futures = self.collect(futures, FIRST_COMPLETED)
+
+        self.collect(futures)
+        self.report()
+        return self.done
+
+    def throttle(self):
+        """
+        Sleeps until the next chunk can be submitted without exceeding the
+        target rate
+        """
+        if not self.rate:
+            return
+        due = self.start + self.listed / self.rate
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def collect(self, futures, return_when=ALL_COMPLETED):
+        """
+        Waits on futures, records their results and returns those not done
+        """
+        done, not_done = wait(futures, return_when=return_when)
+        for future in done:
+            res = future.result()
+            self.done += len(res)
+            if self.results is not None:
+                for r in res:
+                    self.results.write(json.dumps(r) + '\n')
+            self.complete(futures[future])
+
+        if self.results is not None:
+            self.results.flush()
+        if time.time() - self.last_report >= self.progress:
+            self.report()
+        return {f: futures[f] for f in not_done}
+
+    def complete(self, seq):
+        """
+        Marks a chunk as done and advances the cursor as far as possible
+        """
+        self.completed.add(seq)
+        key = None
+        while self.next_seq in self.completed:
+            self.completed.remove(self.next_seq)
+            key = self.pending.pop(self.next_seq)
+            self.next_seq += 1
+        if key is not None:
+            write_cursor(self.cursor, key)
+
+    def report(self):
+        self.last_report = time.time()
+        elapsed = max(self.last_report - self.start, 1e-6)
+        self.out.write('{} listed, {} done, {:.1f} records/s\n'
+                       .format(self.listed, self.done, self.done / elapsed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Import all objects under a bucket+prefix')
+    parser.add_argument('bucket')
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--api', default=os.environ.get('DATASERVICE_API'),
+                        help='dataservice url, defaults to $DATASERVICE_API')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='0 to import in this process')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads per process')
+    parser.add_argument('--chunk-size', type=int, default=50,
+                        help='records sent to a process at a time')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='target records per second')
+    parser.add_argument('--cursor', default=None,
+                        help='file to resume from and record progress to')
+    parser.add_argument('--results', default=None,
+                        help='jsonl file to append results to')
+    parser.add_argument('--progress', type=float, default=10,
+                        help='seconds between progress reports')
+    args = parser.parse_args(argv)
+
+    if args.api is None:
+        parser.error('no dataservice url set')
+
+    start_after = read_cursor(args.cursor)
+    bucket = boto3.resource('s3').Bucket(args.bucket)
+    objects = bucket.objects.filter(Prefix=args.prefix, Marker=start_after)
+
+    if args.processes > 0:
+        executor = ProcessPoolExecutor(max_workers=args.processes)
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    results = open(args.results, 'a') if args.results else None
+    try:
+        with executor:
+            backfill = Backfill(executor, args.api, args.threads,
+                                in_flight=2 * max(args.processes, 1),
+                                rate=args.rate, cursor=args.cursor,
+                                results=results, progress=args.progress)
+            return backfill.run(chunks(args.bucket, objects, args.chunk_size))
+    finally:
+        if results is not None:
+            results.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares the verbose s3 record format against the compact batch format used
+between the invoker and the fileregistry lambda.
+
+For each format, measures how many events per second can be encoded by the
+invoker and decoded by the handler, and how many bytes each record takes up
+in the payload.
+
+Usage:
+    python benchmarks/bench_event_format.py [number of objects] [batch size]
+"""
+import os
+import sys
+import copy
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import invoker
+import service
+
+
+BUCKET = 'kf-study-us-east-1-dev-sd-9pyzahhe'
+
+# The per-object template previously deepcopied by the invoker
+RECORD_TEMPLATE = {
+    "s3": {
+        "bucket": {"name": None, "arn": None},
+        "object": {"key": None, "size": None, "eTag": None}
+    }
+}
+
+
+class Summary:
+    def __init__(self, i):
+        self.key = 'harmonized/cram/{:036d}.cram'.format(i)
+        self.size = 1024 * i
+        self.e_tag = '"d41d8cd98f00b204e9800998ecf8427e"'
+
+
+def deepcopy_batches(objects, batch_size):
+    events = []
+    for obj in objects:
+        ev = copy.deepcopy(RECORD_TEMPLATE)
+        ev["s3"]["bucket"]["name"] = BUCKET
+        ev["s3"]["bucket"]["arn"] = 'arn:aws:s3:::'+BUCKET
+        ev["s3"]["object"]["key"] = obj.key
+        ev["s3"]["object"]["size"] = obj.size
+        ev["s3"]["object"]["eTag"] = obj.e_tag.replace('"', '')
+        events.append(ev)
+        if len(events) >= batch_size:
+            yield {'Records': events}
+            events = []
+    if events:
+        yield {'Records': events}
+
+
+def record_batches(objects, batch_size):
+    events = []
+    for obj in objects:
+        events.append(invoker.event_generator(BUCKET, obj.key, obj.size,
+                                              obj.e_tag))
+        if len(events) >= batch_size:
+            yield {'Records': events}
+            events = []
+    if events:
+        yield {'Records': events}
+
+
+def compact_batches(objects, batch_size):
+    return invoker.batch_generator(BUCKET, objects, batch_size)
+
+
+def run(name, batches, objects, batch_size):
+    start = time.time()
+    payloads = [json.dumps(b) for b in batches(objects, batch_size)]
+    encoded = time.time() - start
+
+    start = time.time()
+    n = sum(1 for p in payloads for _ in service.iter_records(json.loads(p)))
+    decoded = time.time() - start
+
+    size = sum(len(p) for p in payloads)
+    print('{:<12} encode {:>10.0f} events/s  decode {:>10.0f} events/s  '
+          '{:>6.1f} bytes/record'.format(name, n / encoded, n / decoded,
+                                         size / n))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    objects = [Summary(i) for i in range(n)]
+    print('{} objects in batches of {}'.format(n, batch_size))
+    run('deepcopy', deepcopy_batches, objects, batch_size)
+    run('records', record_batches, objects, batch_size)
+    run('compact', compact_batches, objects, batch_size)
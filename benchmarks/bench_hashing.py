@@ -0,0 +1,58 @@
+"""
+Measures the throughput of hashing s3 objects with concurrent ranged GETs
+against a mocked s3.
+
+For each concurrency, hashes a set of synthetic objects and reports MB/s.
+Moto serves objects from memory, so this measures the overhead of the
+requests, buffering and hashing rather than real network throughput.
+
+Usage:
+    python benchmarks/bench_hashing.py [object size in MB] [number of objects]
+"""
+import os
+import sys
+import time
+import boto3
+from moto import mock_s3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import hashing
+
+
+BUCKET = 'kf-study-us-east-1-dev-sd-9pyzahhe'
+PART_SIZE = 8 * 1024 * 1024
+
+
+def run(s3, keys, size, concurrency, algorithms):
+    start = time.time()
+    for key in keys:
+        hashing.compute_hashes(s3, BUCKET, key, size, algorithms,
+                               part_size=PART_SIZE, concurrency=concurrency)
+    elapsed = time.time() - start
+    mb = size * len(keys) / 1024 ** 2
+    print('{:<16} concurrency {:>3}  {:>8.1f} MB/s'
+          .format(','.join(algorithms), concurrency, mb / elapsed))
+
+
+@mock_s3
+def main(size, n):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'x')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'x')
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket=BUCKET)
+    body = os.urandom(size)
+    keys = ['harmonized/cram/{}.cram'.format(i) for i in range(n)]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    print('{} objects of {} MB'.format(n, size // 1024 ** 2))
+    for algorithms in (['md5'], ['md5', 'sha256']):
+        for concurrency in (1, 2, 4, 8, 16):
+            run(s3, keys, size, concurrency, algorithms)
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    main(size * 1024 ** 2, n)
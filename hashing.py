@@ -0,0 +1,165 @@
+"""
+Computes content hashes of s3 objects so that genomic files can be
+registered with real checksums rather than only their ETag, which is not
+the md5 of the content for multipart uploads.
+
+Objects are read with concurrent ranged GETs into a fixed pool of buffers.
+Parts are fed to the hashes strictly in order as they arrive, so no more
+than `concurrency` parts are ever held in memory at once.
+"""
+import os
+import time
+import hashlib
+from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Comma separated hashes to compute, eg: md5,sha256. None if unset.
+HASH_ALGORITHMS = os.environ.get('HASH_ALGORITHMS', '')
+HASH_PART_SIZE = int(os.environ.get('HASH_PART_SIZE', 8 * 1024 * 1024))
+HASH_CONCURRENCY = int(os.environ.get('HASH_CONCURRENCY', 8))
+# The most bytes that will be hashed in one invocation
+HASH_MAX_BYTES = int(os.environ.get('HASH_MAX_BYTES', 10 * 1024 ** 3))
+# Seconds to leave for the rest of the invocation after hashing
+HASH_TIME_MARGIN = int(os.environ.get('HASH_TIME_MARGIN', 30))
+# s3 allows no more than this many tags on an object
+MAX_TAGS = 10
+
+
+class Hasher:
+    """
+    Hashes objects within a byte budget and before a deadline
+
+    Hashes are cached in the tags of an object, under the name of the
+    algorithm, so that no object is ever hashed twice.
+    """
+
+    def __init__(self, algorithms, max_bytes=HASH_MAX_BYTES, deadline=None,
+                 part_size=HASH_PART_SIZE, concurrency=HASH_CONCURRENCY):
+        self.algorithms = list(algorithms)
+        self.remaining = max_bytes
+        self.deadline = deadline
+        self.part_size = part_size
+        self.concurrency = concurrency
+
+    @classmethod
+    def from_env(cls, context=None):
+        """
+        Returns a `Hasher` for the configured `HASH_ALGORITHMS`, or None if
+        no hashes are to be computed. Hashing will stop `HASH_TIME_MARGIN`
+        seconds before the lambda runs out of time.
+        """
+        algorithms = os.environ.get('HASH_ALGORITHMS', HASH_ALGORITHMS)
+        algorithms = [a.strip() for a in algorithms.split(',') if a.strip()]
+        if len(algorithms) == 0:
+            return None
+        deadline = None
+        if hasattr(context, 'get_remaining_time_in_millis'):
+            deadline = (time.time() - HASH_TIME_MARGIN +
+                        context.get_remaining_time_in_millis() / 1000)
+        return cls(algorithms, deadline=deadline)
+
+    def hash_object(self, client, bucket, key, size, tags, pending=()):
+        """
+        Returns the hashes of an object, from its tags if it has been
+        hashed before, otherwise by streaming it
+
+        If new hashes were computed and there is room, they are added to
+        `tags` to be saved with the object.
+
+        :param pending: Keys of tags that will be added to the object after,
+            which room is always left for
+
+        :returns: A dict of hashes, which may be empty if the object would
+            exceed the byte budget or the deadline passed, and whether the
+            hashes were newly computed
+        """
+        cached = {a: tags[a] for a in self.algorithms if a in tags}
+        if len(cached) == len(self.algorithms):
+            return cached, False
+        if size > self.remaining:
+            return {}, False
+        if self.deadline is not None and time.time() > self.deadline:
+            return {}, False
+
+        self.remaining -= size
+        hashes = compute_hashes(client, bucket, key, size, self.algorithms,
+                                self.part_size, self.concurrency,
+                                self.deadline)
+        if hashes is None:
+            return {}, False
+
+        if len(set(tags) | set(hashes) | set(pending)) <= MAX_TAGS:
+            tags.update(hashes)
+        return hashes, True
+
+
+def compute_hashes(client, bucket, key, size, algorithms=('md5',),
+                   part_size=HASH_PART_SIZE, concurrency=HASH_CONCURRENCY,
+                   deadline=None):
+    """
+    Streams an object with concurrent ranged GETs into incremental hashes
+
+    :param client: The s3 client to read the object with
+    :param size: The size of the object in bytes
+    :param algorithms: The names of the `hashlib` hashes to compute
+    :param part_size: The number of bytes requested by each GET
+    :param concurrency: The number of GETs, and buffers, in flight at once
+    :param deadline: The epoch time to give up at, if any
+    :returns: A dict of hex digests keyed by algorithm, or None if the
+        deadline passed before the whole object was read
+    """
+    hashes = {a: hashlib.new(a) for a in algorithms}
+    ranges = iter(range(0, size, part_size))
+    buffers = BufferPool(concurrency, part_size)
+
+    def fetch(start):
+        end = min(start + part_size, size) - 1
+        buf = buffers.acquire()
+        body = client.get_object(Bucket=bucket, Key=key,
+                                 Range='bytes={}-{}'.format(start, end))['Body']
+        n = 0
+        for chunk in iter(lambda: body.read(1024 * 1024), b''):
+            buf[n:n + len(chunk)] = chunk
+            n += len(chunk)
+        return buf, n
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = deque(pool.submit(fetch, start)
+                        for _, start in zip(range(concurrency), ranges))
+        while pending:
+            buf, n = pending.popleft().result()
+            view = memoryview(buf)[:n]
+            for h in hashes.values():
+                h.update(view)
+            view.release()
+            buffers.release(buf)
+
+            if deadline is not None and time.time() > deadline:
+                for future in pending:
+                    future.cancel()
+                return None
+
+            start = next(ranges, None)
+            if start is not None:
+                pending.append(pool.submit(fetch, start))
+
+    return {a: h.hexdigest() for a, h in hashes.items()}
+
+
+class BufferPool:
+    """
+    A fixed number of reusable buffers. Acquiring blocks until one is free.
+    """
+
+    def __init__(self, count, size):
+        self.buffers = Queue()
+        for _ in range(count):
+            self.buffers.put(bytearray(size))
+
+    def acquire(self):
+        return self.buffers.get()
+
+    def release(self, buf):
+        self.buffers.put(buf)
@@ -0,0 +1,231 @@
+"""
+Lists the objects of a bucket from an S3 Inventory rather than by paging
+through the bucket, which is much faster for buckets with millions of
+objects.
+
+An inventory is given by the url of its `manifest.json`, eg:
+```
+s3://kf-inventory/kf-study-us-east-1-dev-sd-0000000/all/2018-05-01T00-00Z/manifest.json
+```
+Data files in the gzipped CSV format are streamed and parsed as they are
+read. Data files in the Parquet format need `pyarrow` to be installed and
+are read one row group at a time. Several data files are read at once, each
+handing rows over in chunks through a bounded queue so that memory is
+bounded regardless of the size of the inventory.
+"""
+import io
+import os
+import csv
+import gzip
+import json
+import tempfile
+import threading
+from queue import Queue, Empty, Full
+from collections import namedtuple
+from urllib.parse import unquote_plus
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+# Number of data files read at once
+INVENTORY_WORKERS = int(os.environ.get('INVENTORY_WORKERS', 4))
+# Number of rows handed over from a data file at a time
+CHUNK_SIZE = 1000
+
+# An object listed in an inventory, with the same fields as an s3
+# ObjectSummary that are needed to dispatch it
+Row = namedtuple('Row', ['key', 'size', 'e_tag', 'last_modified'])
+
+# Inventory fields in the CSV schema and their Parquet column names
+FIELDS = {
+    'Key': 'key',
+    'Size': 'size',
+    'ETag': 'e_tag',
+    'LastModifiedDate': 'last_modified_date',
+    'IsLatest': 'is_latest',
+    'IsDeleteMarker': 'is_delete_marker'
+}
+
+
+def read_manifest(client, url):
+    """
+    Returns the manifest of an inventory given its s3 url
+    """
+    bucket, key = url.replace('s3://', '').split('/', 1)
+    body = client.get_object(Bucket=bucket, Key=key)['Body']
+    manifest = json.loads(body.read().decode('utf-8'))
+    fmt = manifest.get('fileFormat', 'CSV').lower()
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError('{} inventories are not supported'.format(
+            manifest['fileFormat']))
+    if fmt == 'parquet' and pq is None:
+        raise ValueError('pyarrow must be installed to read Parquet '
+                         'inventories')
+    return manifest
+
+
+def source_bucket(manifest):
+    """
+    Returns the name of the bucket that an inventory lists
+    """
+    return manifest['sourceBucket']
+
+
+def objects(client, manifest, prefix='', workers=INVENTORY_WORKERS,
+            chunk_size=CHUNK_SIZE):
+    """
+    Yields the current objects listed in an inventory under a prefix
+
+    Data files are read `workers` at a time, so objects are not yielded in
+    any particular order.
+
+    :param client: An s3 client able to read the inventory's data files
+    :param manifest: The inventory manifest, see `read_manifest()`
+    :param prefix: Only objects with keys starting with this are yielded
+    """
+    bucket = manifest['destinationBucket'].split(':::')[-1]
+    if manifest.get('fileFormat', 'CSV').lower() == 'parquet':
+        def read(f):
+            return parquet_rows(client, bucket, f['key'], prefix, chunk_size)
+    else:
+        schema = [c.strip() for c in manifest['fileSchema'].split(',')]
+
+        def read(f):
+            body = client.get_object(Bucket=bucket, Key=f['key'])['Body']
+            return csv_rows(body, schema, prefix, chunk_size)
+
+    for chunk in in_parallel(read, manifest['files'], workers):
+        for row in chunk:
+            yield row
+
+
+def csv_rows(body, schema, prefix='', chunk_size=CHUNK_SIZE):
+    """
+    Streams a gzipped CSV data file, yielding chunks of `Row`s
+
+    Keys in CSV inventories are url encoded.
+
+    :param body: A file-like object of the gzipped data file
+    :param schema: The field names of each column, from the manifest
+    """
+    col = {name: i for i, name in enumerate(schema)}
+    lines = io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding='utf-8')
+    chunk = []
+    for values in csv.reader(lines):
+        fields = {f: values[col[n]] for n, f in FIELDS.items() if n in col}
+        row = to_row(fields, unquote_plus(fields['key']), prefix)
+        if row is not None:
+            chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def parquet_rows(client, bucket, key, prefix='', chunk_size=CHUNK_SIZE):
+    """
+    Reads a Parquet data file one row group at a time, yielding chunks of
+    `Row`s
+
+    Parquet files can't be read as a stream, so the data file is first
+    downloaded to a temporary file.
+    """
+    with tempfile.TemporaryFile() as f:
+        client.download_fileobj(bucket, key, f)
+        f.seek(0)
+        pf = pq.ParquetFile(f)
+        columns = [c for c in FIELDS.values() if c in pf.schema.names]
+        for i in range(pf.num_row_groups):
+            group = pf.read_row_group(i, columns=columns).to_pydict()
+            chunk = []
+            for values in zip(*(group[c] for c in columns)):
+                fields = dict(zip(columns, values))
+                row = to_row(fields, fields['key'], prefix)
+                if row is not None:
+                    chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if len(chunk) > 0:
+                yield chunk
+
+
+def to_row(fields, key, prefix):
+    """
+    Returns a `Row` for the fields of a listed object, or None if it is not
+    under the prefix or is not the current version of an object
+    """
+    if not key.startswith(prefix):
+        return None
+    if str(fields.get('is_latest', 'true')).lower() == 'false':
+        return None
+    if str(fields.get('is_delete_marker', 'false')).lower() == 'true':
+        return None
+    if fields.get('size') in (None, ''):
+        return None
+    return Row(key, int(fields['size']), fields.get('e_tag', ''),
+               fields.get('last_modified_date', None))
+
+
+def in_parallel(func, items, workers):
+    """
+    Yields everything yielded by `func(item)` for each item, running
+    `workers` at once on threads. Each thread blocks once the consumer is
+    more than a few values behind.
+
+    Errors raised by `func` are raised to the consumer. If the consumer
+    stops early, the threads are stopped too.
+    """
+    items = list(items)
+    queue = Queue(maxsize=2 * workers)
+    todo = Queue()
+    for item in items:
+        todo.put(item)
+    stopping = threading.Event()
+    done = object()
+
+    def put(value):
+        while not stopping.is_set():
+            try:
+                queue.put(value, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def work():
+        while not stopping.is_set():
+            try:
+                item = todo.get_nowait()
+            except Empty:
+                return
+            try:
+                for value in func(item):
+                    if not put(value):
+                        return
+            except Exception as err:
+                put(err)
+                return
+            put(done)
+
+    threads = [threading.Thread(target=work, daemon=True)
+               for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+
+    remaining = len(items)
+    try:
+        while remaining > 0:
+            value = queue.get()
+            if value is done:
+                remaining -= 1
+            elif isinstance(value, Exception):
+                raise value
+            else:
+                yield value
+    finally:
+        stopping.set()
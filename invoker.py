@@ -1,35 +1,48 @@
-import copy
 import os
 import json
+import time
 import boto3
-from botocore.vendored import requests
-
-
-record_template = {
-    "s3":{
-       "bucket":{
-          "name":"kf-study-us-east-1-dev-sd-9pyzahhe",
-          "arn":"kf-study-us-east-1-dev-sd-9pyzahhe"
-       },
-       "object":{
-          "key": None,
-          "size": None,
-          "eTag": None
-       }
-    }
-}
+from collections import namedtuple, deque
+from functools import partial
+from itertools import chain
+
+import inventory
+import lanes
+import outcomes
+import service
+import tracing
+from slack import SlackNotifier
 
 
-BATCH_SIZE = 10
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 10))
+# How many levels of prefixes may be handed to child invokers
+FANOUT_DEPTH = int(os.environ.get('FANOUT_DEPTH', 3))
+# The most invokers that may be started for a run, not counting the first
+FANOUT_MAX_INVOKERS = int(os.environ.get('FANOUT_MAX_INVOKERS', 100))
+# Prefixes with more objects than this are handed to a child invoker
+FANOUT_THRESHOLD = int(os.environ.get('FANOUT_THRESHOLD', 1000))
+# The most batches that may be dispatched across all jobs of a run within
+# IN_FLIGHT_WINDOW seconds, 0 for no limit
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 0))
+# Seconds that a dispatched batch is assumed to be in flight for
+IN_FLIGHT_WINDOW = float(os.environ.get('IN_FLIGHT_WINDOW', 60))
+# Concurrent executions of the fileregistry, 0 if unknown. Backfills only
+# dispatch up to their share of these within IN_FLIGHT_WINDOW, see `lanes.py`
+FILEREGISTRY_CONCURRENCY = int(os.environ.get('FILEREGISTRY_CONCURRENCY', 0))
+# Whether to list the biospecimens of a study in the payload of every batch
+PREFETCH_BIOSPECIMENS = bool(os.environ.get('PREFETCH_BIOSPECIMENS', ''))
 SLACK_TOKEN = os.environ.get('SLACK_SECRET', None)
 SLACK_CHANNELS = os.environ.get('SLACK_CHANNEL', '').split(',')
 SLACK_CHANNELS = [c.replace('#','').replace('@','') for c in SLACK_CHANNELS]
 
+# Stands in for an s3 ObjectSummary for objects listed with the client
+Object = namedtuple('Object', ['key', 'size', 'e_tag'])
+
 
 def handler(event, context):
     """
     Scans a bucket+prefix and invokes the fileregistry lambda for every
-    object found in batches of 10 records.
+    object found in batches of `BATCH_SIZE` records.
 
     Will recieve an event of the form:
     ```
@@ -39,120 +52,540 @@ def handler(event, context):
     }
     ```
     Where the prefix is optional and will default to the entire bucket.
+
+    If `FILEREGISTRY_QUEUE` is set, batches are sent as messages to that
+    SQS queue instead of invoking the fileregistry lambda directly.
+
+    Every batch carries the `run_id` of this scan so that the outcomes of
+    its records may be summarized together, see `outcomes.py`, and the
+    span of this invoker so the run may be traced, see `tracing.py`.
+
+    Slack notifications, including periodic progress updates, are sent from
+    a background thread so that they never hold up listing.
+
+    If `fanout` is set in the event, large prefixes one level below the
+    prefix are handed off to child invokers, see `fan_out()`.
+
+    If `inventory` is set in the event to the s3 url of an S3 Inventory
+    manifest, objects are read from the inventory instead of listing the
+    bucket, see `inventory.py`. The bucket is then taken from the manifest.
+
+    Many studies may be imported at once by giving a list of `jobs`
+    instead, see `jobs_handler()`.
+
+    Batches are dispatched as backfills, so that the fileregistry imports
+    live records first, and are paced to the backfill share of its
+    capacity, see `backfill_limit()`.
+
+    The study of the bucket is resolved once and sent with every batch so
+    that the fileregistry need not look it up, see `resolve_study()`.
     """
     bucket = event.get('bucket', None)
     # The fileregistry lambda ARN
     fileregistry = os.environ.get('FILEREGISTRY', None)
-    if bucket is None or fileregistry is None:
+    # The url of the fileregistry SQS queue
+    queue = os.environ.get('FILEREGISTRY_QUEUE', None)
+    if 'jobs' in event and (fileregistry is not None or queue is not None):
+        return jobs_handler(event, context, fileregistry, queue)
+    manifest = None
+    if event.get('inventory', None) and (fileregistry or queue):
+        manifest = inventory.read_manifest(boto3.client('s3'),
+                                           event['inventory'])
+        bucket = inventory.source_bucket(manifest)
+    if bucket is None or (fileregistry is None and queue is None):
         return 'no bucket or lambda specified'
 
     prefix = event.get('prefix', '')
+    tracer = tracing.from_event(event, 'invoker')
+    run_id = tracer.run_id
+    with tracer.stage('study'):
+        study = resolve_study(bucket, event)
+    if study is not None:
+        # Child invokers are given the study too
+        event = dict(event, study=study)
+    # Only the invoker that started the run reports to slack
+    token = None if event.get('child', False) else SLACK_TOKEN
+    slack = SlackNotifier(token, SLACK_CHANNELS).start()
 
-    
     attachments = [
         { "fallback": "I'm about to import all files under `{}/{}`, hold tight...".format(bucket, prefix),
           "text": "I'm about to import all files under `{}/{}`, hold tight...".format(bucket, prefix),
           "color": "#005e99"
         }
     ]
-    send_slack(attachments=attachments)
-        
+    slack.send(attachments=attachments)
+
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(bucket)
-    lam = boto3.client('lambda')
     s3cl = boto3.client('s3')
-    
+    dispatch = tracer.timed('dispatch', dispatcher(fileregistry, queue))
+    limit = backfill_limit()
+
     records = 0
     invoked = 0
-    events = []
+    start = time.time()
+    title = '{}/{}'.format(bucket.name, prefix)
+
+    children = 0
+    if manifest is not None:
+        objects = inventory.objects(s3cl, manifest, prefix)
+    elif event.get('fanout', False):
+        with tracer.stage('fanout'):
+            objects, children = fan_out(bucket, prefix, event, context,
+                                        tracer)
+    else:
+        objects = bucket.objects.filter(Prefix=prefix)
+
+    # Set if the scan stopped before every object was dispatched
+    truncated = False
+    objects = until_timeout(tracer.iterate('list', objects), context)
+    for payload in batch_generator(bucket.name, objects):
+        with tracer.stage('throttle'):
+            if not limit.acquire(context):
+                # Waiting for the throttle would outlast the lambda
+                truncated = True
+                break
+        if study is not None:
+            payload['study'] = study
+        tracer.propagate(payload)
+        records += len(payload['Batch']['keys'])
+        invoked += 1
+        dispatch(payload)
+        slack.progress(title, records, invoked, start)
+
+    # Send warning message if little time remaining, or if the throttle
+    # stopped the scan
+    if context.get_remaining_time_in_millis()/1000 < 1:
+        truncated = True
+    if truncated:
+        attachments = [
+            { "fallback": "Ran out of time for `{}/{}`".format(bucket.name, prefix),
+              "text": "Ran out of time for `{}/{}`".format(bucket.name, prefix),
+              "fields": [
+                  {
+                      "title": "Files Imported",
+                      "value": records,
+                      "short": True
+                  },
+                  {
+                      "title": "Function Calls",
+                      "value": invoked,
+                      "short": True
+                  }
+              ],
+              "color": "danger"
+            }
+        ]
+    else:
+        # Slack notif
+        attachments = [
+            { "fallback": "Finished invokes for `{}/{}` with *{}s* remaining".format(bucket.name, prefix, context.get_remaining_time_in_millis()/1000),
+              "text": "Finished invokes for `{}/{}` with *{}s* remaining".format(bucket.name, prefix, context.get_remaining_time_in_millis()/1000),
+              "fields": [
+                  {
+                      "title": "Files Imported",
+                      "value": records,
+                      "short": True
+                  },
+                  {
+                      "title": "Function Calls",
+                      "value": invoked,
+                      "short": True
+                  }
+              ],
+              "color": "good"
+            }
+        ]
+    slack.send(attachments=attachments)
+    with tracer.stage('slack'):
+        slack.stop()
+
+    tracer.finish(prefix=prefix, records=records, invoked=invoked,
+                  children=children, truncated=truncated)
+    print('run {} dispatched {} records'.format(run_id, records))
+    outcomes.record_invoker(run_id, {'prefix': prefix, 'records': records,
+                                     'invoked': invoked, 'children': children,
+                                     'truncated': truncated})
+    if children > 0:
+        res = '{} records processed in {} calls and {} child invokers'.format(
+            records, invoked, children)
+    else:
+        res = '{} records processed in {} calls'.format(records, invoked)
+    if truncated:
+        res += ' before running out of time'
+    return res
+
+
+def jobs_handler(event, context, fileregistry, queue=None):
+    """
+    Scans many bucket+prefixes in one run, sharing dispatch fairly between
+    them so that small studies finish quickly while large ones still make
+    progress.
+
+    Will recieve an event of the form:
+    ```
+    {
+        "jobs": [
+            {"bucket": "kf-study-us-east-1-dev-sd-0000000", "weight": 4},
+            {"bucket": "kf-study-us-east-1-dev-sd-1111111",
+             "prefix": "harmonized/", "fanout": true},
+            {"inventory": "s3://kf-inventory/.../manifest.json"}
+        ]
+    }
+    ```
+    Batches are taken from the jobs in weighted round-robin, up to `weight`
+    batches from each job in turn, see `round_robin()`. Dispatch is paced
+    across every job, see `backfill_limit()`.
 
-    for i, k in enumerate(bucket.objects.filter(Prefix=prefix)):
-        # Send warning message if little time remaining
+    A slack message is sent as each job is finished.
+    """
+    tracer = tracing.from_event(event, 'invoker')
+    run_id = tracer.run_id
+    token = None if event.get('child', False) else SLACK_TOKEN
+    slack = SlackNotifier(token, SLACK_CHANNELS).start()
+
+    s3 = boto3.resource('s3')
+    s3cl = boto3.client('s3')
+    dispatch = tracer.timed('dispatch', dispatcher(fileregistry, queue))
+    limit = backfill_limit()
+
+    manifests = [inventory.read_manifest(s3cl, j['inventory'])
+                 if j.get('inventory', None) else None
+                 for j in event['jobs']]
+    jobs = [Job(inventory.source_bucket(m) if m else j['bucket'],
+                j.get('prefix', ''), j.get('weight', 1))
+            for j, m in zip(event['jobs'], manifests)]
+    text = "I'm about to import {} jobs, hold tight...".format(len(jobs))
+    slack.send(attachments=[{"fallback": text, "text": text,
+                             "color": "#005e99"}])
+
+    children = 0
+    for job, spec, manifest in zip(jobs, event['jobs'], manifests):
+        with tracer.stage('study'):
+            job.study = resolve_study(job.bucket, spec)
+        if job.study is not None:
+            spec = dict(spec, study=job.study)
+        bucket = s3.Bucket(job.bucket)
+        if manifest is not None:
+            objects = inventory.objects(s3cl, manifest, job.prefix)
+        elif spec.get('fanout', False):
+            with tracer.stage('fanout'):
+                objects, n = fan_out(bucket, job.prefix, spec, context,
+                                     tracer)
+            children += n
+        else:
+            objects = bucket.objects.filter(Prefix=job.prefix)
+        objects = until_timeout(tracer.iterate('list', objects), context,
+                                job.cut_short)
+        job.batches = batch_generator(job.bucket, objects)
+
+    start = time.time()
+    records = invoked = 0
+    title = '{} jobs'.format(len(jobs))
+    for job, payload in round_robin(jobs):
+        if payload is None:
+            # Jobs whose listing was cut short are reported below
+            if job.done:
+                slack.send(attachments=job_attachments(job))
+            continue
         if context.get_remaining_time_in_millis()/1000 < 1:
-            attachments = [
-                { "fallback": "Ran out of time for `{}/{}`".format(bucket.name, prefix),
-                  "text": "Ran out of time for `{}/{}`".format(bucket.name, prefix),
-                  "fields": [
-                      {
-                          "title": "Files Imported",
-                          "value": records,
-                          "short": True
-                      },
-                      {
-                          "title": "Function Calls",
-                          "value": invoked,
-                          "short": True
-                      }
-                  ],
-                  "color": "danger"
-                }
-            ]
-            send_slack(attachments=attachments)
             break
+        with tracer.stage('throttle'):
+            if not limit.acquire(context):
+                break
+        if job.study is not None:
+            payload['study'] = job.study
+        tracer.propagate(payload)
+        job.records += len(payload['Batch']['keys'])
+        job.invoked += 1
+        records += len(payload['Batch']['keys'])
+        invoked += 1
+        dispatch(payload)
+        slack.progress(title, records, invoked, start)
 
-        records += 1
-        events.append(event_generator(bucket.name, k.key, k.size, k.e_tag))
+    # Jobs not yet finished ran out of time
+    for job in jobs:
+        if not job.done:
+            slack.send(attachments=job_attachments(job))
+    with tracer.stage('slack'):
+        slack.stop()
 
-        # Flush events
-        if len(events) >= BATCH_SIZE:
-            invoked += 1
-            invoke(lam, fileregistry, events)
-            events = []
+    totals = [job.totals() for job in jobs]
+    tracer.finish(jobs=totals, records=records, invoked=invoked,
+                  children=children)
+    print('run {} dispatched {} records for {} jobs'
+          .format(run_id, records, len(jobs)))
+    outcomes.record_invoker(run_id, {'jobs': totals, 'records': records,
+                                     'invoked': invoked,
+                                     'children': children})
+    return '{} records processed in {} calls across {} jobs'.format(
+        records, invoked, len(jobs))
 
-    if len(events) > 0:
-        invoked += 1
-        invoke(lam, fileregistry, events)
 
-    # Slack notif
-    attachments = [
-        { "fallback": "Finished invokes for `{}/{}` with *{}s* remaining".format(bucket.name, prefix, context.get_remaining_time_in_millis()/1000),
-          "text": "Finished invokes for `{}/{}` with *{}s* remaining".format(bucket.name, prefix, context.get_remaining_time_in_millis()/1000),
-          "fields": [
-              {
-                  "title": "Files Imported",
-                  "value": records,
-                  "short": True
-              },
-              {
-                  "title": "Function Calls",
-                  "value": invoked,
-                  "short": True
-              }
-          ],
-          "color": "good"
+class Job:
+    """
+    A bucket+prefix to be scanned as part of a multi-study run, along with
+    its progress
+    """
+
+    def __init__(self, bucket, prefix='', weight=1):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.weight = max(int(weight), 1)
+        self.batches = iter([])
+        self.study = None
+        self.records = 0
+        self.invoked = 0
+        self.done = False
+        self.truncated = False
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def title(self):
+        return '{}/{}'.format(self.bucket, self.prefix)
+
+    def cut_short(self):
+        """
+        Marks the listing of the job as stopped before it was finished
+        """
+        self.truncated = True
+
+    def totals(self):
+        return {'bucket': self.bucket, 'prefix': self.prefix,
+                'records': self.records, 'invoked': self.invoked,
+                'done': self.done}
+
+
+def round_robin(jobs):
+    """
+    Yields `(job, payload)` for the batches of each job in weighted
+    round-robin, taking up to `weight` batches from a job before moving on
+    to the next. Once a job has no batches left, `(job, None)` is yielded
+    and the job is dropped from the rotation, done unless its listing was
+    cut short.
+    """
+    active = deque(jobs)
+    while active:
+        job = active.popleft()
+        for _ in range(job.weight):
+            payload = next(job.batches, None)
+            if payload is None:
+                job.done = not job.truncated
+                job.end = time.time()
+                yield job, None
+                break
+            yield job, payload
+        else:
+            active.append(job)
+
+
+class InFlightLimit:
+    """
+    Paces dispatch so that at most `max_in_flight` batches are sent in any
+    `window` seconds
+
+    Invocations are asynchronous so the invoker cannot see when a batch
+    completes. Instead, a batch is treated as in flight for `window`
+    seconds after it was sent, which should be about as long as a batch
+    takes to import.
+    """
+
+    def __init__(self, max_in_flight, window=IN_FLIGHT_WINDOW):
+        self.max_in_flight = max_in_flight
+        self.window = window
+        self.sent = deque()
+
+    def acquire(self, context):
+        """
+        Waits until another batch may be sent
+
+        :returns: False if the lambda would run out of time first
+        """
+        if not self.max_in_flight:
+            return True
+        now = time.time()
+        while self.sent and self.sent[0] <= now - self.window:
+            self.sent.popleft()
+        if len(self.sent) >= self.max_in_flight:
+            delay = self.sent[0] + self.window - now
+            if delay > context.get_remaining_time_in_millis()/1000 - 1:
+                return False
+            time.sleep(delay)
+            self.sent.popleft()
+        self.sent.append(time.time())
+        return True
+
+
+def resolve_study(bucket, event):
+    """
+    Resolves the study of a bucket once for a scan, or takes it from the
+    event if it was resolved by a parent invoker already, see
+    `service.FileImporter.resolve_study()`
+
+    The biospecimens of the study are listed too if `biospecimens` is set in
+    the event, or `PREFETCH_BIOSPECIMENS` is set.
+
+    :returns: The study, or None if it could not be resolved, in which case
+        the fileregistry will look it up itself
+    """
+    if event.get('study', None):
+        return event['study']
+    api = os.environ.get('DATASERVICE_API', None)
+    if api is None:
+        return None
+    importer = service.FileImporter(api, None)
+    try:
+        return importer.resolve_study(
+            bucket, event.get('biospecimens', PREFETCH_BIOSPECIMENS))
+    except Exception as err:
+        # The study is only an optimization so the scan carries on without
+        print('could not resolve the study of {}: {}'.format(bucket, err))
+        return None
+
+
+def backfill_limit():
+    """
+    Returns the limit on batches dispatched by a backfill within
+    `IN_FLIGHT_WINDOW` seconds: `MAX_IN_FLIGHT` or the backfill share of
+    `FILEREGISTRY_CONCURRENCY`, whichever is lower, leaving the rest of the
+    fileregistry's capacity for live notifications
+    """
+    limits = [n for n in (MAX_IN_FLIGHT,
+                          lanes.share(FILEREGISTRY_CONCURRENCY)) if n]
+    return InFlightLimit(min(limits) if limits else 0, IN_FLIGHT_WINDOW)
+
+
+def job_attachments(job):
+    """
+    Formats the completion, or not, of a job as slack attachments
+    """
+    if job.done:
+        text = "Finished invokes for `{}` in *{:.0f}s*".format(
+            job.title, job.end - job.start)
+        color = "good"
+    else:
+        text = "Ran out of time for `{}`".format(job.title)
+        color = "danger"
+    return [{"fallback": text, "text": text, "color": color, "fields": [
+        {"title": "Files Imported", "value": job.records, "short": True},
+        {"title": "Function Calls", "value": job.invoked, "short": True}
+    ]}]
+
+
+def fan_out(bucket, prefix, event, context, tracer):
+    """
+    Splits the listing of a prefix between this invoker and child invokers
+
+    One level of common prefixes is listed under the prefix. Any prefix
+    found to hold more than `FANOUT_THRESHOLD` objects is handed off to a
+    child invoker which will fan out again itself, one level deeper, until
+    `depth` levels have been split. Every child is given an equal share of
+    the remaining `max_invokers` so that the whole run never starts more.
+    Objects directly under the prefix and smaller prefixes are left to this
+    invoker, smaller prefixes having already been listed in full while
+    finding out their size. Prefixes are no longer looked at once the lambda
+    is running out of time, and are left to this invoker to list too.
+
+    :returns: An iterable of the objects for this invoker to dispatch and
+        the number of child invokers started
+    """
+    depth = event.get('depth', FANOUT_DEPTH)
+    budget = event.get('max_invokers', FANOUT_MAX_INVOKERS)
+    if depth <= 0 or budget <= 0:
+        return bucket.objects.filter(Prefix=prefix), 0
+
+    s3 = boto3.client('s3')
+    prefixes = list(common_prefixes(s3, bucket.name, prefix))
+
+    large = []
+    listed = {}
+    for p in prefixes:
+        if len(large) >= budget or service.running_out_of_time(context):
+            break
+        objects = list_small(s3, bucket.name, p)
+        if objects is None:
+            large.append(p)
+        else:
+            listed[p] = objects
+
+    lam = boto3.client('lambda')
+    share = (budget - len(large)) // max(len(large), 1)
+    for p in large:
+        child = {
+            'bucket': bucket.name,
+            'prefix': p,
+            'fanout': True,
+            'depth': depth - 1,
+            'max_invokers': share,
+            'child': True
         }
-    ]
-    send_slack(attachments=attachments)
+        # Children need not resolve the study again
+        if event.get('study', None):
+            child['study'] = event['study']
+        invoke(lam, context.invoked_function_arn, tracer.propagate(child))
+    print('handed {} of {} prefixes under {} to child invokers'
+          .format(len(large), len(prefixes), prefix))
 
-    return '{} records processed in {} calls'.format(records, invoked)
+    handed_off = set(large)
+    small = [p for p in prefixes if p not in handed_off]
+    objects = [direct_objects(s3, bucket.name, prefix)]
+    objects.extend(listed[p] if p in listed
+                   else bucket.objects.filter(Prefix=p) for p in small)
+    return chain.from_iterable(objects), len(large)
 
 
-def send_slack(msg=None, attachments=None):
+def common_prefixes(s3, bucket, prefix):
     """
-    Sends a slack notification
+    Yields the prefixes one level below a prefix
     """
-    if SLACK_TOKEN is not None:
-        for channel in SLACK_CHANNELS:
-            message = {
-                'username': 'File Registry Bot',
-                'icon_emoji': ':file_folder:',
-                'channel': channel
-            }
-            if msg:
-                message['text'] = msg
-            if attachments:
-                message['attachments'] = attachments
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                   Delimiter='/'):
+        for p in page.get('CommonPrefixes', []):
+            yield p['Prefix']
 
-            resp = requests.post('https://slack.com/api/chat.postMessage',
-                headers={'Authorization': 'Bearer '+SLACK_TOKEN},
-                json=message)
 
+def direct_objects(s3, bucket, prefix):
+    """
+    Yields the objects directly under a prefix, not under a further prefix
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                   Delimiter='/'):
+        for obj in page.get('Contents', []):
+            yield Object(obj['Key'], obj['Size'], obj['ETag'])
 
-def invoke(lam, fileregistry, records):
+
+def list_small(s3, bucket, prefix):
     """
-    Invokes the lambda for given records
+    Returns the objects under a prefix if there are no more than
+    `FANOUT_THRESHOLD` of them, listing no more than that to find out
+
+    :returns: A list of `Object`s, or None if the prefix holds more
+    """
+    resp = s3.list_objects_v2(Bucket=bucket, Prefix=prefix,
+                              MaxKeys=FANOUT_THRESHOLD)
+    if resp.get('IsTruncated', False):
+        return None
+    return [Object(obj['Key'], obj['Size'], obj['ETag'])
+            for obj in resp.get('Contents', [])]
+
+
+def dispatcher(fileregistry, queue=None):
+    """
+    Returns a function that will send a payload to the fileregistry queue,
+    if one is given, or invoke the fileregistry lambda otherwise
+    """
+    if queue is not None:
+        return partial(enqueue, boto3.client('sqs'), queue)
+    return partial(invoke, boto3.client('lambda'), fileregistry)
+
+
+def invoke(lam, fileregistry, payload):
+    """
+    Invokes the lambda with the given payload
     """
-    payload = {'Records': records}
     response = lam.invoke(
         FunctionName=fileregistry,
         InvocationType='Event',
@@ -160,12 +593,76 @@ def invoke(lam, fileregistry, records):
     )
 
 
-def event_generator(bucket, key, size, e_tag):
-    ev = copy.deepcopy(record_template)
-    ev["s3"]["bucket"]["name"] = bucket
-    ev["s3"]["bucket"]["arn"] = 'arn:aws:s3:::'+bucket
-    ev["s3"]["object"]["key"] = key
-    ev["s3"]["object"]["size"] = size
-    ev["s3"]["object"]["eTag"] = e_tag.replace('"', '')
-    
-    return ev
+def enqueue(sqs, queue, payload):
+    """
+    Sends the given payload to the fileregistry queue as a single message
+    """
+    response = sqs.send_message(
+        QueueUrl=queue,
+        MessageBody=json.dumps(payload),
+    )
+
+
+def until_timeout(objects, context, on_timeout=None):
+    """
+    Yields objects until the lambda has less than a second remaining
+
+    :param on_timeout: Optional function called if objects were left
+    """
+    for obj in objects:
+        if context.get_remaining_time_in_millis()/1000 < 1:
+            if on_timeout is not None:
+                on_timeout()
+            return
+        yield obj
+
+
+def batch_generator(bucket, objects, batch_size=BATCH_SIZE,
+                    priority=lanes.BACKFILL):
+    """
+    Yields compact batches of at most `batch_size` objects as they are
+    listed. The bucket is only stated once per batch and the keys, sizes
+    and etags of the objects are kept in parallel lists.
+    See `service.iter_records()` for the format.
+
+    :param bucket: The name of the bucket the objects are in
+    :param objects: An iterable of s3 `ObjectSummary`s
+    :param batch_size: The maximum number of objects in a batch
+    :param priority: The lane of the batches, see `lanes.py`
+    """
+    keys, sizes, etags = [], [], []
+    for obj in objects:
+        keys.append(obj.key)
+        sizes.append(obj.size)
+        etags.append(obj.e_tag.replace('"', ''))
+        if len(keys) >= batch_size:
+            yield {'priority': priority,
+                   'Batch': {'bucket': bucket, 'keys': keys,
+                             'sizes': sizes, 'etags': etags}}
+            keys, sizes, etags = [], [], []
+
+    if len(keys) > 0:
+        yield {'priority': priority,
+               'Batch': {'bucket': bucket, 'keys': keys,
+                         'sizes': sizes, 'etags': etags}}
+
+
+def event_generator(bucket, key, size, e_tag, priority=lanes.BACKFILL):
+    """
+    Returns a standard s3 event record for an object, tagged with the lane
+    it is imported in, see `lanes.py`
+    """
+    return {
+        "priority": priority,
+        "s3": {
+            "bucket": {
+                "name": bucket,
+                "arn": 'arn:aws:s3:::'+bucket
+            },
+            "object": {
+                "key": key,
+                "size": size,
+                "eTag": e_tag.replace('"', '')
+            }
+        }
+    }
@@ -0,0 +1,66 @@
+"""
+Priority lanes keep freshly uploaded files from waiting behind backfills.
+
+Records from s3 notifications are `live`. Payloads dispatched by the
+invoker, and records made by `invoker.event_generator()`, are tagged as
+`backfill`, either on the whole payload or on a single record:
+```
+{"priority": "backfill", "Batch": {...}}
+```
+Live records are always imported before backfill records in the same
+invocation, and backfills may only use `BACKFILL_SHARE` of the capacity
+that is available, whether that is the records imported at once by the
+fileregistry or the batches in flight from the invoker.
+"""
+import os
+
+
+LIVE = 'live'
+BACKFILL = 'backfill'
+LANES = [LIVE, BACKFILL]
+
+# Share of capacity that backfills may use, the rest is left for live records
+BACKFILL_SHARE = float(os.environ.get('BACKFILL_SHARE', 0.5))
+
+
+def priority(record, event=None):
+    """
+    Returns the lane of a record, given on the record itself, or on the
+    event it came in, or `live` if neither is tagged
+    """
+    lane = record.get('priority', None)
+    if lane is None and event is not None:
+        lane = event.get('priority', None)
+    return lane if lane in LANES else LIVE
+
+
+def prioritized(records, event=None, lane=None):
+    """
+    Returns the records with live records first, otherwise keeping their
+    order
+
+    :param lane: Optional function returning the lane of each record, in
+        place of `priority()`
+    """
+    lane = lane or (lambda r: priority(r, event))
+    return sorted(records, key=lambda r: LANES.index(lane(r)))
+
+
+def share(capacity, lane=BACKFILL):
+    """
+    Returns how much of a capacity a lane may use, at least 1 unless the
+    capacity is 0, meaning unlimited
+    """
+    if lane != BACKFILL or not capacity:
+        return capacity
+    return max(1, int(capacity * BACKFILL_SHARE))
+
+
+def lane_of(records, event=None):
+    """
+    Returns the lane of a group of records, `backfill` only if every record
+    is a backfill record so that live records are never held back
+    """
+    if records and all(priority(r, event) == BACKFILL for r in records):
+        return BACKFILL
+    return LIVE
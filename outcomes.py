@@ -0,0 +1,269 @@
+"""
+Records the outcome of every record processed by the fileregistry and
+summarizes the outcomes of a run.
+
+Outcomes are buffered by each invocation and written out as parts of json
+lines under `OUTCOME_LOCATION`, which may be an s3 url or a local directory:
+```
+<OUTCOME_LOCATION>/<run_id>/<part>.jsonl
+```
+The totals of each invoker in a run are saved alongside:
+```
+<OUTCOME_LOCATION>/invokers/<run_id>/<invoker>.json
+```
+
+Usage:
+    python outcomes.py s3://kf-fileregistry-outcomes/ <run_id>
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import boto3
+from collections import Counter, defaultdict
+
+
+PART_SIZE = int(os.environ.get('OUTCOME_PART_SIZE', 1000))
+
+
+def sink_from_env():
+    """
+    Returns an `OutcomeSink` for the configured `OUTCOME_LOCATION`, or None
+    if outcomes are not being recorded
+    """
+    location = os.environ.get('OUTCOME_LOCATION', None)
+    if not location:
+        return None
+    return OutcomeSink(writer(location))
+
+
+def record_invoker(run_id, totals):
+    """
+    Saves the totals of a single invoker so that the totals of a run that
+    was split across many invokers may be added up, see `invoker_totals()`
+    """
+    location = os.environ.get('OUTCOME_LOCATION', None)
+    if not location:
+        return
+    name = 'invokers/{}/{}.json'.format(run_id, uuid.uuid4().hex)
+    writer(location).write(name, json.dumps(totals) + '\n')
+
+
+def invoker_totals(writer, run_id):
+    """
+    Adds up the totals of every invoker in a run
+    """
+    totals = {'invokers': 0, 'records': 0, 'invoked': 0, 'children': 0}
+    for line in writer.read('invokers/{}'.format(run_id)):
+        if not line.strip():
+            continue
+        line = json.loads(line)
+        totals['invokers'] += 1
+        for k in ('records', 'invoked', 'children'):
+            totals[k] += line.get(k, 0)
+    return totals
+
+
+def writer(location):
+    """
+    Returns a writer for an s3 url or a local directory
+    """
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[5:].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3Writer(bucket, prefix)
+    return LocalWriter(location)
+
+
+class S3Writer:
+    """
+    Writes parts as objects in s3
+    """
+
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client('s3')
+
+    def write(self, name, body):
+        key = '{}{}'.format(self.prefix, name)
+        self.s3.put_object(Bucket=self.bucket, Key=key,
+                           Body=body.encode('utf-8'))
+
+    def read(self, run_id):
+        """
+        Yields the lines of every part for a run
+        """
+        prefix = '{}{}/'.format(self.prefix, run_id)
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                body = self.s3.get_object(Bucket=self.bucket,
+                                          Key=obj['Key'])['Body']
+                for line in iter_lines(body):
+                    yield line
+
+
+def iter_lines(body, chunk_size=1024 * 1024):
+    """
+    Yields lines from a streaming s3 object body, a chunk at a time
+    """
+    pending = b''
+    for chunk in iter(lambda: body.read(chunk_size), b''):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if pending:
+        yield pending.decode('utf-8')
+
+
+class LocalWriter:
+    """
+    Writes parts as files in a local directory
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, name, body):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(body)
+
+    def read(self, run_id):
+        """
+        Yields the lines of every part for a run
+        """
+        directory = os.path.join(self.directory, run_id)
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name)) as f:
+                for line in f:
+                    yield line
+
+
+class OutcomeSink:
+    """
+    Buffers compact per-record outcomes and writes them out in parts
+
+    Outcomes are grouped by the run that they belong to. A part is written
+    whenever `part_size` outcomes of a run have been buffered and when the
+    sink is flushed at the end of an invocation.
+    """
+
+    def __init__(self, writer, part_size=PART_SIZE):
+        self.writer = writer
+        self.part_size = part_size
+        self.buffers = defaultdict(list)
+
+    def append(self, name, res, start, duration, run_id=None):
+        """
+        Buffers the outcome of importing a record
+
+        :param name: The `bucket/key` of the object
+        :param res: The result returned from `FileImporter.import_from_event`
+        :param start: The epoch time that the import started
+        :param duration: The number of seconds the import took
+        :param run_id: The run that the record was dispatched by, if any
+        """
+        run_id = run_id or 'unknown'
+        buffer = self.buffers[run_id]
+        buffer.append({
+            'object': name,
+            'harmonized': res.get('harmonized'),
+            'source': res.get('source'),
+            'kf_ids': res.get('kf_ids', []),
+            'stage': res.get('stage'),
+            'start': round(start, 3),
+            'duration': round(duration, 3)
+        })
+        if len(buffer) >= self.part_size:
+            self._write(run_id)
+
+    def flush(self):
+        """
+        Writes any buffered outcomes as new parts
+        """
+        for run_id in list(self.buffers):
+            self._write(run_id)
+
+    def _write(self, run_id):
+        buffer = self.buffers.pop(run_id, [])
+        if len(buffer) == 0:
+            return
+        name = '{}/{}-{}.jsonl'.format(run_id, int(time.time() * 1000),
+                                       uuid.uuid4().hex[:8])
+        body = ''.join(json.dumps(o) + '\n' for o in buffer)
+        self.writer.write(name, body)
+
+
+def status(value):
+    """
+    Classifies the status of a harmonized or source import
+    """
+    if value == 'imported':
+        return 'imported'
+    if value == 'not imported':
+        return 'not attempted'
+    if value.endswith('already registered'):
+        return 'skipped'
+    return 'failed'
+
+
+def summarize(outcomes):
+    """
+    Streams outcomes to compute the totals for a run
+
+    :param outcomes: An iterable of outcome dicts or json lines
+    :returns: A dict with the number of records, counts of each status for
+        the harmonized and source files, a count of each error message and
+        the throughput of the run in records/sec
+    """
+    records = 0
+    harmonized = Counter()
+    source = Counter()
+    errors = Counter()
+    first = None
+    last = None
+    busy = 0.0
+
+    for outcome in outcomes:
+        if not isinstance(outcome, dict):
+            outcome = json.loads(outcome)
+        records += 1
+        for counts, field in ((harmonized, 'harmonized'), (source, 'source')):
+            s = status(outcome[field])
+            counts[s] += 1
+            if s == 'failed':
+                errors[outcome[field]] += 1
+
+        end = outcome['start'] + outcome['duration']
+        first = outcome['start'] if first is None else min(first, outcome['start'])
+        last = end if last is None else max(last, end)
+        busy += outcome['duration']
+
+    elapsed = (last - first) if records else 0
+    return {
+        'records': records,
+        'harmonized': dict(harmonized),
+        'source': dict(source),
+        'errors': dict(errors),
+        'elapsed': round(elapsed, 3),
+        'busy': round(busy, 3),
+        'records_per_sec': round(records / elapsed, 3) if elapsed else None
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    w = writer(sys.argv[1])
+    totals = summarize(w.read(sys.argv[2]))
+    totals['invokers'] = invoker_totals(w, sys.argv[2])
+    print(json.dumps(totals, indent=2))
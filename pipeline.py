@@ -0,0 +1,261 @@
+"""
+Imports many records at once as a pipeline of stages, one for each step of
+importing a file, see `service.FileImporter.steps`:
+```
+read_tags -> check -> hash -> register -> write_tags
+    ^                                          |
+    +------ source file of a harmonized file --+
+```
+Each stage has its own queue and pool of worker threads, so that a slow
+stage may be given more workers without holding up the rest. A worker takes
+up to `batch_size` files from its queue at a time; the `check` stage looks
+up each biospecimen only once per batch.
+
+Records carrying a progress marker, see `service.FileImporter.progress()`,
+start at the source file. Once told to stop, records whose harmonized file
+has been registered are paused rather than going on to their source file,
+and are finished with their marker, as `service.FileImporter` does.
+
+No more than `max_in_flight` records are in the pipeline at once, which
+bounds every queue. The depth of each queue is sampled as files are queued
+so that the stage holding up the pipeline can be found, see `report()`.
+"""
+import os
+import time
+import threading
+from queue import Queue, Empty
+from collections import defaultdict
+
+
+# Number of workers for each stage, eg: `check=8,register=4`
+PIPELINE_WORKERS = os.environ.get('PIPELINE_WORKERS', '')
+DEFAULT_WORKERS = 2
+BATCH_SIZE = 10
+# Stage of a record paused between its harmonized and source file
+PAUSED = 'paused'
+
+
+def workers_from_env(spec=None):
+    """
+    Parses the number of workers for each stage, or returns None if the
+    pipeline is not enabled
+
+    :param spec: A string such as `check=8,register=4`, or `true` to use
+        the default number of workers for every stage
+    """
+    spec = os.environ.get('PIPELINE_WORKERS', PIPELINE_WORKERS) \
+        if spec is None else spec
+    if not spec:
+        return None
+    workers = {}
+    for part in spec.split(','):
+        if '=' in part:
+            stage, n = part.split('=', 1)
+            workers[stage.strip()] = int(n)
+    return workers
+
+
+class Pipeline:
+    """
+    Runs the steps of a `service.FileImporter` as stages over many records
+
+    :param importer: The `FileImporter` to run the steps of
+    :param is_transient: Returns whether an error raised by a step may not
+        happen again if the record is retried, see `service.is_transient()`
+    :param workers: The number of workers for each stage
+    """
+
+    def __init__(self, importer, is_transient, workers=None,
+                 batch_size=BATCH_SIZE, max_in_flight=None):
+        self.importer = importer
+        self.is_transient = is_transient
+        self.batch_size = batch_size
+        self.stages = importer.steps
+        workers = workers or {}
+        self.workers = {s: workers.get(s, DEFAULT_WORKERS)
+                        for s in self.stages}
+        self.max_in_flight = max_in_flight or 2 * sum(self.workers.values())
+        # Admission is limited so the queues can never fill and block
+        self.queues = {s: Queue(maxsize=self.max_in_flight + self.workers[s])
+                       for s in self.stages}
+        self.results = Queue()
+        self.stats = {s: defaultdict(float) for s in self.stages}
+        self.lock = threading.Lock()
+        self.started = 0
+        self.should_stop = None
+
+    def run(self, records, should_stop=None, sink=None, run_id=None):
+        """
+        Imports records, yielding `(record, bucket/key, result)` as each
+        completes
+
+        Results may be yielded in a different order to the records. Like
+        `service.import_record()`, outcomes are recorded in the sink if
+        given.
+
+        :param should_stop: Optional function called before each record is
+            started. Once it returns True, no more records are started, those
+            in the pipeline are finished or paused, and `started` is the
+            number of records that were started. Paused records are not
+            recorded in the sink until they complete.
+        """
+        self.should_stop = should_stop
+        threads = [threading.Thread(target=self._work, args=(s,),
+                                    daemon=True)
+                   for s in self.stages for _ in range(self.workers[s])]
+        for t in threads:
+            t.start()
+
+        records = iter(records)
+        in_flight = 0
+        stopping = False
+        try:
+            while True:
+                while (not stopping and in_flight < self.max_in_flight):
+                    if should_stop is not None and should_stop():
+                        stopping = True
+                        break
+                    record = next(records, None)
+                    if record is None:
+                        stopping = True
+                        break
+                    self._start(record)
+                    in_flight += 1
+                if in_flight == 0:
+                    break
+                item = self.results.get()
+                in_flight -= 1
+                if sink is not None and item['res']['stage'] != PAUSED:
+                    sink.append(item['name'], item['res'], item['start'],
+                                time.time() - item['start'], run_id)
+                yield item['record'], item['name'], item['res']
+        finally:
+            for s in self.stages:
+                for _ in range(self.workers[s]):
+                    self.queues[s].put(None)
+            for t in threads:
+                t.join()
+
+    def _start(self, record):
+        bucket = record['s3']['bucket']['name']
+        key = record['s3']['object']['key']
+        item = {
+            'record': record,
+            'name': '{}/{}'.format(bucket, key),
+            'start': time.time(),
+            'file': self.importer.harmonized_file(record),
+            'res': {'harmonized': 'not imported', 'source': 'not imported',
+                    'kf_ids': [], 'stage': 'done'}
+        }
+        self.started += 1
+        # The harmonized file may have been registered already
+        item['progress'] = self.importer.resume(record, item['res'])
+        if item['progress'] is not None:
+            try:
+                item['file'] = self.importer.source_file(
+                    item['progress']['tags'])
+            except Exception as err:
+                self._fail(item, self.stages[0], err, field='source')
+                return
+        self._put(self.stages[0], item)
+
+    def _put(self, stage, item):
+        queue = self.queues[stage]
+        with self.lock:
+            stats = self.stats[stage]
+            stats['samples'] += 1
+            stats['depth'] += queue.qsize()
+            stats['max_depth'] = max(stats['max_depth'], queue.qsize())
+        queue.put(item)
+
+    def _work(self, stage):
+        queue = self.queues[stage]
+        step = getattr(self.importer, stage)
+        while True:
+            batch = [queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            items = [i for i in batch if i is not None]
+
+            start = time.time()
+            # Biospecimens found to exist are shared across the batch
+            kwargs = {'biospecimens': {}} if stage == 'check' else {}
+            for item in items:
+                item['file'].stage = stage
+                try:
+                    step(item['file'], **kwargs)
+                except Exception as err:
+                    self._fail(item, stage, err)
+                    continue
+                self._next(stage, item)
+
+            with self.lock:
+                self.stats[stage]['busy'] += time.time() - start
+                self.stats[stage]['processed'] += len(items)
+            if len(items) < len(batch):
+                return
+
+    def _next(self, stage, item):
+        i = self.stages.index(stage)
+        if i + 1 < len(self.stages):
+            self._put(self.stages[i + 1], item)
+            return
+
+        f = item['file']
+        res = item['res']
+        res['kf_ids'].append(f.gf['kf_id'])
+        if f.harmonized:
+            res['harmonized'] = 'imported'
+            item['progress'] = self.importer.progress(f)
+            if self.should_stop is not None and self.should_stop():
+                res['stage'] = PAUSED
+                res['progress'] = item['progress']
+                self._finish(item)
+                return
+            try:
+                item['file'] = self.importer.source_file(f.tags)
+            except Exception as err:
+                self._fail(item, self.stages[0], err, field='source')
+                return
+            self._put(self.stages[0], item)
+            return
+        res['source'] = 'imported'
+        self._finish(item)
+
+    def _fail(self, item, stage, err, field=None):
+        res = item['res']
+        if field is None:
+            field = 'harmonized' if item['file'].harmonized else 'source'
+        res[field] = str(err)
+        res['retry'] = self.is_transient(err)
+        res['stage'] = stage
+        # Retries of the record may skip the harmonized file
+        if res['retry'] and item.get('progress', None) is not None:
+            res['progress'] = item['progress']
+        self._finish(item)
+
+    def _finish(self, item):
+        self.results.put(item)
+
+    def report(self):
+        """
+        Returns the number of files processed by each stage, the time its
+        workers were busy and the mean and max depth of its queue, along
+        with the stage that files waited longest to enter
+        """
+        stages = {}
+        for s in self.stages:
+            stats = self.stats[s]
+            samples = stats['samples'] or 1
+            stages[s] = {
+                'workers': self.workers[s],
+                'processed': int(stats['processed']),
+                'busy': round(stats['busy'], 3),
+                'mean_depth': round(stats['depth'] / samples, 2),
+                'max_depth': int(stats['max_depth'])
+            }
+        bottleneck = max(self.stages, key=lambda s: stages[s]['mean_depth'])
+        return {'stages': stages, 'bottleneck': bottleneck}
@@ -0,0 +1,217 @@
+import os
+import json
+import zlib
+import shutil
+import tempfile
+import boto3
+
+import invoker
+import service
+
+
+PARTITIONS = int(os.environ.get('RECONCILE_PARTITIONS', 64))
+
+MISSING_IN_DATASERVICE = 'missing_in_dataservice'
+MISSING_IN_S3 = 'missing_in_s3'
+ETAG_MISMATCH = 'etag_mismatch'
+
+
+def handler(event, context):
+    """
+    Compares the objects in a bucket+prefix against the genomic files
+    registered for the study in the dataservice.
+
+    Will recieve an event of the form:
+    ```
+    {
+        "bucket": "kf-study-us-east-1-dev-sd-0000000",
+        "prefix": "harmonized/",
+        "study_id": "SD_00000000",
+        "dispatch": true,
+        "report": "s3://kf-reports/reconcile/sd-0000000.jsonl"
+    }
+    ```
+    Where the prefix is optional and will default to the entire bucket and
+    the study_id will default to the one derived from the bucket name.
+    If `dispatch` is true, objects missing in the dataservice are sent to
+    the fileregistry for import. If a `report` location is given, every
+    discrepancy found is written there as a line of json.
+    """
+    DATASERVICE_API = os.environ.get('DATASERVICE_API', None)
+    bucket = event.get('bucket', None)
+    if bucket is None or DATASERVICE_API is None:
+        return 'no bucket or dataservice url specified'
+
+    FILEREGISTRY = os.environ.get('FILEREGISTRY', None)
+    FILEREGISTRY_QUEUE = os.environ.get('FILEREGISTRY_QUEUE', None)
+    if (event.get('dispatch', False) and
+            FILEREGISTRY is None and FILEREGISTRY_QUEUE is None):
+        return 'no fileregistry or queue specified to dispatch to'
+
+    prefix = event.get('prefix', '')
+    study_id = event.get('study_id', service.study_id_from_bucket(bucket))
+
+    importer = service.FileImporter(DATASERVICE_API, None)
+    objects = boto3.resource('s3').Bucket(bucket).objects.filter(Prefix=prefix)
+
+    dispatch = None
+    if event.get('dispatch', False):
+        dispatch = invoker.dispatcher(FILEREGISTRY, FILEREGISTRY_QUEUE)
+
+    report = None
+    if event.get('report', None):
+        report = tempfile.NamedTemporaryFile('w', suffix='.jsonl')
+
+    with Reconciler(bucket, prefix) as rec:
+        rec.index_dataservice(importer.get_genomic_files(study_id))
+        rec.index_s3(objects)
+        counts, dispatched = summarize(bucket, rec.diff(), dispatch, report)
+
+    if report is not None:
+        report.flush()
+        report_bucket, report_key = event['report'][5:].split('/', 1)
+        boto3.client('s3').upload_file(report.name, report_bucket, report_key)
+        report.close()
+
+    counts['dispatched'] = dispatched
+    return counts
+
+
+def summarize(bucket, discrepancies, dispatch=None, report=None):
+    """
+    Counts discrepancies by kind while streaming them to the report and
+    dispatching the objects that are missing in the dataservice in batches
+
+    :returns: The counts of each kind of discrepancy and the number of
+        batches dispatched
+    """
+    counts = {MISSING_IN_DATASERVICE: 0, MISSING_IN_S3: 0, ETAG_MISMATCH: 0}
+
+    def missing():
+        for d in discrepancies:
+            counts[d['kind']] += 1
+            if report is not None:
+                report.write(json.dumps(d) + '\n')
+            if d['kind'] == MISSING_IN_DATASERVICE:
+                yield invoker.Object(d['key'], d['size'], d['etag'])
+
+    dispatched = 0
+    for payload in invoker.batch_generator(bucket, missing()):
+        if dispatch is not None:
+            dispatch(payload)
+            dispatched += 1
+    return counts, dispatched
+
+
+class Reconciler:
+    """
+    Diffs the objects in a bucket+prefix against genomic files from the
+    dataservice with memory bounded by the size of one partition.
+
+    Both sides are first spilled to disk, partitioned by a hash of each
+    object's s3 url. Each partition's genomic files are then loaded into
+    an index in memory and that partition's objects are streamed against
+    it, so only `1/partitions` of the genomic files are held at once.
+    """
+
+    def __init__(self, bucket, prefix='', partitions=PARTITIONS, workdir=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.partitions = partitions
+        self.root = 's3://{}/'.format(bucket)
+        self.workdir = tempfile.mkdtemp(dir=workdir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def index_dataservice(self, genomic_files):
+        """
+        Spills the urls, etags and kf_ids of genomic files located under the
+        bucket+prefix to partitions on disk
+        """
+        url_prefix = self.root + self.prefix
+        with self._writers('dataservice') as write:
+            for gf in genomic_files:
+                etag = (gf.get('hashes') or {}).get('etag', None)
+                for url in gf.get('urls') or []:
+                    if url.startswith(url_prefix):
+                        write(url, [url, etag, gf.get('kf_id')])
+
+    def index_s3(self, objects):
+        """
+        Spills the urls, sizes and etags of s3 objects to partitions on disk
+
+        :param objects: An iterable of s3 `ObjectSummary`s
+        """
+        with self._writers('s3') as write:
+            for obj in objects:
+                url = self.root + obj.key
+                write(url, [url, obj.size, obj.e_tag.replace('"', '')])
+
+    def diff(self):
+        """
+        Yields a dict for every discrepancy found between the dataservice
+        and s3, one partition at a time. The `kind` of each is one of
+        `missing_in_dataservice`, `missing_in_s3` or `etag_mismatch`.
+        """
+        for i in range(self.partitions):
+            index = {}
+            for url, etag, kf_id in self._read('dataservice', i):
+                index[url] = (etag, kf_id)
+
+            for url, size, etag in self._read('s3', i):
+                key = url[len(self.root):]
+                if url not in index:
+                    yield {'kind': MISSING_IN_DATASERVICE, 'url': url,
+                           'bucket': self.bucket, 'key': key,
+                           'size': size, 'etag': etag}
+                    continue
+                ds_etag, kf_id = index.pop(url)
+                if ds_etag is not None and ds_etag != etag:
+                    yield {'kind': ETAG_MISMATCH, 'url': url,
+                           'bucket': self.bucket, 'key': key,
+                           'kf_id': kf_id, 'size': size, 'etag': etag,
+                           'dataservice_etag': ds_etag}
+
+            for url, (etag, kf_id) in index.items():
+                yield {'kind': MISSING_IN_S3, 'url': url,
+                       'bucket': self.bucket, 'key': url[len(self.root):],
+                       'kf_id': kf_id, 'dataservice_etag': etag}
+
+    def _path(self, side, i):
+        return os.path.join(self.workdir, '{}-{}.jsonl'.format(side, i))
+
+    def _writers(self, side):
+        return _PartitionWriter([self._path(side, i)
+                                 for i in range(self.partitions)])
+
+    def _read(self, side, i):
+        path = self._path(side, i)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class _PartitionWriter:
+    """
+    Appends rows to one of several files chosen by a hash of a url
+    """
+
+    def __init__(self, paths):
+        self.files = [open(path, 'w') for path in paths]
+
+    def __enter__(self):
+        return self.write
+
+    def __exit__(self, *args):
+        for f in self.files:
+            f.close()
+
+    def write(self, url, row):
+        i = zlib.crc32(url.encode('utf-8')) % len(self.files)
+        self.files[i].write(json.dumps(row) + '\n')
@@ -0,0 +1,118 @@
+"""
+Persists records whose import failed for a transient reason so that they
+may be replayed later, see `service.replay()`.
+
+Records are stored in batches as json objects under `RETRY_LOCATION`:
+```
+<RETRY_LOCATION><next eligible epoch>-<id>.json
+```
+Because the key starts with the zero-padded time that the batch becomes
+eligible, listing the location returns batches in the order they should be
+retried and the listing may stop at the first batch that is not yet due.
+"""
+import os
+import json
+import time
+import uuid
+import boto3
+
+
+MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 8))
+# Seconds to wait before the first retry, doubled for each further attempt
+BASE_DELAY = int(os.environ.get('RETRY_BASE_DELAY', 60))
+MAX_DELAY = int(os.environ.get('RETRY_MAX_DELAY', 6 * 60 * 60))
+
+
+def store_from_env():
+    """
+    Returns a `RetryStore` for the configured `RETRY_LOCATION`, or None if
+    transient failures are not being persisted
+    """
+    location = os.environ.get('RETRY_LOCATION', None)
+    if not location:
+        return None
+    bucket, _, prefix = location.replace('s3://', '').partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return RetryStore(bucket, prefix)
+
+
+def backoff(attempt):
+    """
+    Returns the number of seconds to wait before making the given attempt
+    """
+    return min(MAX_DELAY, BASE_DELAY * 2 ** max(attempt - 2, 0))
+
+
+class RetryStore:
+    """
+    Stores batches of failed records in s3 with their attempt count and the
+    time they next become eligible to be retried.
+
+    Batches that have used up `MAX_ATTEMPTS` are moved under `dead/` to be
+    inspected by hand instead of being retried again.
+    """
+
+    def __init__(self, bucket, prefix='retry/', max_attempts=MAX_ATTEMPTS):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_attempts = max_attempts
+        self.s3 = boto3.client('s3')
+
+    def put(self, items, attempt, now=None):
+        """
+        Stores a batch of failed records to be tried again
+
+        :param items: A list of `{'record': s3 event record, 'error': str,
+            'run_id': str}`
+        :param attempt: The attempt that the records will be retried on
+        :returns: The key of the batch, or None if there were no items
+        """
+        if len(items) == 0:
+            return None
+        now = now or time.time()
+        next_time = int(now + backoff(attempt))
+        if attempt > self.max_attempts:
+            key = '{}dead/{:012d}-{}.json'.format(self.prefix, int(now),
+                                                  uuid.uuid4().hex)
+        else:
+            key = '{}{:012d}-{}.json'.format(self.prefix, next_time,
+                                             uuid.uuid4().hex)
+        body = {'attempt': attempt, 'next': next_time, 'items': items}
+        self.s3.put_object(Bucket=self.bucket, Key=key,
+                           Body=json.dumps(body).encode('utf-8'))
+        return key
+
+    def eligible(self, now=None):
+        """
+        Yields the keys of batches that are due to be retried, in the order
+        they became eligible
+        """
+        now = now or time.time()
+        paginator = self.s3.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.bucket, Prefix=self.prefix,
+                                   Delimiter='/')
+        for page in pages:
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(self.prefix):]
+                if int(name.split('-')[0]) > now:
+                    return
+                yield obj['Key']
+
+    def get(self, key):
+        """
+        Returns a stored batch
+        """
+        body = self.s3.get_object(Bucket=self.bucket, Key=key)['Body']
+        return json.loads(body.read().decode('utf-8'))
+
+    def remove(self, keys):
+        """
+        Deletes batches once they have been retried
+        """
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            self.s3.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': k} for k in keys[i:i+1000]],
+                'Quiet': True
+            })
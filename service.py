@@ -2,12 +2,44 @@ import os
 import boto3
 import json
 import time
+import asyncio
+import threading
+from botocore.config import Config
 from botocore.vendored import requests
+from botocore.vendored.requests.exceptions import RequestException
+from botocore.exceptions import (BotoCoreError, ClientError,
+                                 EndpointConnectionError)
 from base64 import b64decode
 
+import hashing
+import lanes
+import outcomes
+import pipeline
+import retry
+import tracing
+
 
 s3 = boto3.client("s3")
 
+# Connections kept open to s3 per region, should be at least the number of
+# records being imported at once or the s3 calls made at once by the async
+# importer, whichever is more
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get(
+    'S3_MAX_POOL_CONNECTIONS',
+    max(int(os.environ.get('IMPORT_CONCURRENCY') or 0),
+        int(os.environ.get('ASYNC_S3_WORKERS', 16)))))
+
+# Regions of buckets that have been looked up, kept for warm invocations
+BUCKET_REGIONS = {}
+
+# The longest that SQS will delay the delivery of a message, in seconds
+SQS_MAX_DELAY = 900
+
+# The most biospecimen kf_ids that are embedded in a study's context, more
+# would risk going over the size limit of a payload
+MAX_CONTEXT_BIOSPECIMENS = int(os.environ.get('MAX_CONTEXT_BIOSPECIMENS',
+                                              5000))
+
 
 DATA_TYPES = {
     'fq': 'Unaligned Reads',
@@ -60,11 +92,61 @@ class CavaticaException(Exception):
         pass
 
 
+class TransientException(Exception):
+        """
+        A failure that is likely to resolve itself, such as a timeout,
+        throttling or a server error, after which the import may be retried
+        """
+        pass
+
+
+# Dataservice response codes that are worth retrying
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+# S3 error codes that are worth retrying
+TRANSIENT_CODES = {'SlowDown', 'Throttling', 'ThrottlingException',
+                   'RequestTimeout', 'ServiceUnavailable', 'InternalError',
+                   '500', '503'}
+# The tags a harmonized file must have to be imported
+REQUIRED_TAGS = ['cavatica_harmonized_file', 'cavatica_source_file',
+                 'cavatica_app', 'bs_id', 'cavatica_source_path',
+                 'cavatica_task']
+# The tags of a harmonized file needed to import its source file, kept in
+# the progress marker of a record, see `FileImporter.progress()`
+PROGRESS_TAGS = ['cavatica_source_path', 'bs_id', 'study_id']
+# The steps of importing a file, see `FileImporter.run_steps()`
+STEPS = ['read_tags', 'check', 'hash', 'register', 'write_tags']
+# The stage of a record whose import stopped between its two files
+PAUSED = pipeline.PAUSED
+# Errors that will stop the import of a single file
+IMPORT_ERRORS = (ImportException, DataServiceException, TransientException,
+                 ClientError, EndpointConnectionError, RequestException)
+# Errors that will stop the import of a source file, which may also be
+# found from a malformed `cavatica_source_path` or progress marker
+SOURCE_ERRORS = IMPORT_ERRORS + (ValueError, KeyError)
+
+
 def handler(event, context):
     """
     Register a genomic file in dataservice from a list of s3 events.
     If all events are not processed before the lambda runs out of time,
     the remaining will be submitted to a new function
+
+    Events may hold standard s3 notification `Records` or a compact `Batch`
+    of objects as sent by the invoker, see `iter_records()`.
+
+    The span of each invocation is logged and passed on in any
+    re-invocation, see `tracing.py`.
+
+    If `PIPELINE_WORKERS` is set, records are imported concurrently by a
+    pipeline of stages, see `pipeline.py`, rather than one at a time. If
+    `IMPORT_CONCURRENCY` is set, they are imported concurrently by an
+    `asyncimporter.AsyncFileImporter` instead.
+
+    Live records are imported before backfill records and an invocation of
+    only backfill records imports fewer at once, see `lanes.py`.
+
+    Payloads from the invoker carry the `study` of their bucket, which is
+    used rather than looking it up, see `FileImporter.use_study()`.
     """
     DATASERVICE_API = os.environ.get('DATASERVICE_API', None)
     if DATASERVICE_API is None:
@@ -78,68 +160,738 @@ def handler(event, context):
                          get('Plaintext', None)
         HEADERS = {'X-SBG-Auth-Token': CAVATICA_TOKEN}
 
-    importer = FileImporter(DATASERVICE_API, CAVATICA_TOKEN)
+    importer = FileImporter(DATASERVICE_API, CAVATICA_TOKEN,
+                            hasher=hashing.Hasher.from_env(context))
+    sink = outcomes.sink_from_env()
+    store = retry.store_from_env()
+
+    if is_sqs_event(event):
+        res = sqs_handler(importer, event, context, sink)
+        if sink is not None:
+            sink.flush()
+        return res
+
+    tracer = tracing.from_event(event, 'fileregistry')
     res = {}
-    for i, record in enumerate(event['Records']):
-
-        # If we're running out of time, stop processing and re-invoke
-        # NB: We check that i > 0 to ensure that *some* progress has been made
-        # to avoid infinite call chains.
-        if (hasattr(context, 'invoked_function_arn') and
-            context.get_remaining_time_in_millis() < 5000 and
-            i > 0):
-            records = event['Records'][i:]
-            print('not able to complete {} records, '
-                  're-invoking the function'.format(len(records)))
-            remaining = {'Records': records}
-            lam = boto3.client('lambda')
-            context.invoked_function_arn
-            # Invoke the lambda again with remaining records
+    failed = []
+    importer.use_study(event.get('study', None))
+    records = list(iter_records(event))
+    ordered = lanes.prioritized(records, event)
+    run_id = event.get('run_id', None)
+    with tracer.stage('import'):
+        results, started, report = import_records(
+            importer, ordered, context, sink, run_id,
+            lanes.lane_of(records, event))
+
+    paused = []
+    for record, name, r in results:
+        res[name] = r
+        if r.get('stage') == PAUSED:
+            paused.append(with_progress(record, r))
+        if r.get('retry', False):
+            failed.append({'record': with_progress(record, r),
+                           'error': failure_reason(r),
+                           'run_id': run_id})
+
+    # If we ran out of time, re-invoke with the remaining records
+    if started < len(records) or len(paused) > 0:
+        print('not able to complete {} records, '
+              're-invoking the function'
+              .format(len(records) - started + len(paused)))
+        if ordered == records and started < len(records):
+            remaining = remaining_event(event, started)
+        else:
+            # Records were reordered so are no longer in their batch order
+            remaining = dict(event, Records=ordered[started:])
+            remaining.pop('Batch', None)
+        # Paused records resume from where they left off
+        remaining['Records'] = paused + remaining.get('Records', [])
+        remaining = tracer.propagate(remaining)
+        lam = boto3.client('lambda')
+        # Invoke the lambda again with remaining records
+        with tracer.stage('reinvoke'):
             response = lam.invoke(
                 FunctionName=context.invoked_function_arn,
                 InvocationType='Event',
                 Payload=str.encode(json.dumps(remaining))
             )
-            # Stop processing and exit
-            break
-
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-        name = '{}/{}'.format(bucket, key)
-        res[name] = importer.import_from_event(record)
     else:
         print('processed all records')
 
+    with tracer.stage('flush'):
+        if sink is not None:
+            sink.flush()
+        # Save any records that may succeed later to be replayed
+        if store is not None and len(failed) > 0:
+            store.put(failed, attempt=2)
+
+    tracer.finish(records=len(res), failed=len(failed), pipeline=report)
     return res
 
 
+def replay(event, context):
+    """
+    Retries records whose import previously failed for a transient reason.
+
+    Batches of records that are due are drained from the retry store in the
+    order they became eligible. Records that fail transiently again are
+    stored for another attempt after an exponentially longer delay.
+    Records that fail for any other reason are not retried.
+    """
+    DATASERVICE_API = os.environ.get('DATASERVICE_API', None)
+    store = retry.store_from_env()
+    if DATASERVICE_API is None or store is None:
+        return 'no dataservice url or retry location set'
+
+    importer = FileImporter(DATASERVICE_API, None,
+                            hasher=hashing.Hasher.from_env(context))
+    sink = outcomes.sink_from_env()
+    counts = {'batches': 0, 'records': 0, 'failed': 0}
+    done = []
+
+    for key in store.eligible():
+        # Leave the remaining batches for the next replay
+        if running_out_of_time(context) and counts['batches'] > 0:
+            break
+
+        batch = store.get(key)
+        failed = []
+        for item in batch['items']:
+            # Outcomes are recorded against the run the record came from
+            run_id = item.get('run_id', None)
+            _, res = import_record(importer, item['record'], sink, run_id)
+            if res.get('retry', False):
+                failed.append({'record': with_progress(item['record'], res),
+                               'error': failure_reason(res),
+                               'run_id': run_id})
+        store.put(failed, attempt=batch['attempt'] + 1)
+        done.append(key)
+
+        counts['batches'] += 1
+        counts['records'] += len(batch['items'])
+        counts['failed'] += len(failed)
+
+    store.remove(done)
+    if sink is not None:
+        sink.flush()
+
+    return counts
+
+
+def import_records(importer, records, context, sink=None, run_id=None,
+                   lane=lanes.LIVE):
+    """
+    Imports records until they are all done or the lambda is running out
+    of time, one at a time or concurrently if configured to
+
+    :param lane: The lane of the records, backfill records are only given
+        their share of the records that may be imported at once
+    :returns: A list of `(record, bucket/key, result)`, the number of
+        records that were started and a report of the pipeline, if used
+    """
+    # NB: We check that some records were started before stopping to
+    # ensure that *some* progress has been made to avoid infinite call chains.
+    workers = pipeline.workers_from_env()
+    if workers is not None:
+        p = pipeline.Pipeline(importer, is_transient, workers)
+        p.max_in_flight = lanes.share(p.max_in_flight, lane)
+        should_stop = lambda: p.started > 0 and running_out_of_time(context)
+        results = list(p.run(records, should_stop, sink, run_id))
+        report = p.report()
+        print('pipeline bottleneck: {}'.format(report['bottleneck']))
+        return results, p.started, report
+
+    concurrency = os.environ.get('IMPORT_CONCURRENCY', None)
+    if concurrency:
+        concurrency = lanes.share(int(concurrency), lane)
+        return import_async(importer, records, context, concurrency,
+                            sink, run_id) + (None,)
+
+    results = []
+    for record in records:
+        if running_out_of_time(context) and len(results) > 0:
+            break
+        # Records may pause between their two files if time runs out
+        name, res = import_record(importer, record, sink, run_id,
+                                  lambda: running_out_of_time(context))
+        results.append((record, name, res))
+    return results, len(results), None
+
+
+def import_async(importer, records, context, concurrency, sink=None,
+                 run_id=None):
+    """
+    Imports records `concurrency` at a time on an event loop
+
+    :returns: A list of `(record, bucket/key, result)` and the number of
+        records that were started
+    """
+    # Imported here as it builds on this module
+    from asyncimporter import AsyncFileImporter
+
+    async def collect(aimporter):
+        should_stop = lambda: (aimporter.started > 0 and
+                               running_out_of_time(context))
+        async with aimporter:
+            return [r async for r in aimporter.import_many(
+                records, concurrency, should_stop, sink, run_id)]
+
+    aimporter = AsyncFileImporter(None, None, importer=importer)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        results = loop.run_until_complete(collect(aimporter))
+    finally:
+        loop.close()
+    return results, aimporter.started
+
+
+def failure_reason(res):
+    """
+    Returns the error that stopped the import of a record
+    """
+    if res['harmonized'] != 'imported':
+        return res['harmonized']
+    return res['source']
+
+
+def import_record(importer, record, sink=None, run_id=None,
+                  should_stop=None):
+    """
+    Imports a single record, recording its outcome in the sink if given
+
+    :param should_stop: Optional function to pause the import between the
+        record's two files, see `FileImporter.import_from_event()`
+    :returns: The `bucket/key` of the record's object and the result of
+        importing it
+    """
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
+    name = '{}/{}'.format(bucket, key)
+    start = time.time()
+    res = importer.import_from_event(record, should_stop)
+    # Paused records are recorded once they complete
+    if sink is not None and res.get('stage') != PAUSED:
+        sink.append(name, res, start, time.time() - start, run_id)
+    return name, res
+
+
+def with_progress(record, res):
+    """
+    Returns the record with the progress marker of its result, if any, so
+    that importing it again resumes where it left off
+    """
+    if 'progress' not in res:
+        return record
+    return dict(record, progress=res['progress'])
+
+
+def sqs_handler(importer, event, context, sink=None):
+    """
+    Processes s3 events delivered through an SQS queue.
+
+    The body of each message may be an S3 notification or a payload sent
+    by the invoker, see `iter_records()`. Live messages are processed
+    before backfill messages, see `lanes.py`. Messages with a
+    record that failed for a transient reason are returned under
+    `batchItemFailures` so that SQS redelivers only those messages and
+    retries are left to the queue's redrive policy.
+
+    A redelivered message would start again at the harmonized file, which
+    would be found to be registered already. If a record failed at its
+    source file, the failed records are sent back to the queue with their
+    progress markers instead, see `requeue()`.
+    """
+    failures = []
+    messages = lanes.prioritized(event['Records'], lane=message_priority)
+    for i, message in enumerate(messages):
+        # Hand back whatever is left to the queue if we're out of time
+        if running_out_of_time(context) and i > 0:
+            print('not able to complete {} messages, '
+                  'returning them to the queue'
+                  .format(len(messages[i:])))
+            failures.extend({'itemIdentifier': m['messageId']}
+                            for m in messages[i:])
+            break
+
+        failed = []
+        try:
+            body = json.loads(message['body'])
+            tracer = tracing.from_event(body, 'fileregistry')
+            importer.use_study(body.get('study', None))
+            redeliver = False
+            # S3 test events and other notifications have no records
+            for record in iter_records(body):
+                with tracer.stage('import'):
+                    _, res = import_record(importer, record, sink,
+                                           body.get('run_id', None))
+                if res.get('retry', False):
+                    redeliver = True
+                    failed.append(with_progress(record, res))
+            tracer.finish(message=message['messageId'])
+        except Exception as err:
+            print('failed to process message {}: {}'
+                  .format(message['messageId'], err))
+            redeliver = True
+        else:
+            if any('progress' in r for r in failed):
+                redeliver = not requeue(message, body, failed)
+
+        if redeliver:
+            failures.append({'itemIdentifier': message['messageId']})
+
+    return {'batchItemFailures': failures}
+
+
+def requeue(message, body, records):
+    """
+    Sends records of a message back to the queue it came from as a new
+    message, after a delay that grows with each attempt, see
+    `retry.backoff()`. Messages that have used up `retry.MAX_ATTEMPTS` are
+    dropped, their failures having been recorded in the outcome sink.
+
+    :returns: False if the records could not be sent and the message
+        should be redelivered instead
+    """
+    attempt = body.get('attempt', 1) + 1
+    if attempt > retry.MAX_ATTEMPTS:
+        print('giving up on message {} after {} attempts'
+              .format(message['messageId'], attempt - 1))
+        return True
+
+    requeued = dict(body, Records=records, attempt=attempt)
+    requeued.pop('Batch', None)
+    # arn:aws:sqs:<region>:<account>:<queue name>
+    _, _, _, region, account, name = message['eventSourceARN'].split(':')
+    try:
+        sqs = boto3.client('sqs', region_name=region)
+        queue = sqs.get_queue_url(QueueName=name,
+                                  QueueOwnerAWSAccountId=account)
+        sqs.send_message(QueueUrl=queue['QueueUrl'],
+                         MessageBody=json.dumps(requeued),
+                         DelaySeconds=min(retry.backoff(attempt),
+                                          SQS_MAX_DELAY))
+    except (ClientError, BotoCoreError) as err:
+        print('failed to requeue message {}: {}'
+              .format(message['messageId'], err))
+        return False
+    return True
+
+
+def message_priority(message):
+    """
+    Returns the lane of an SQS message given by its body, see `lanes.py`
+    """
+    try:
+        body = json.loads(message['body'])
+    except (KeyError, TypeError, ValueError):
+        return lanes.LIVE
+    return lanes.priority(body) if isinstance(body, dict) else lanes.LIVE
+
+
+def iter_records(event):
+    """
+    Yields s3 event records from an event
+
+    Records may be given as a list of standard s3 notification `Records`
+    and/or as a compact `Batch` where the bucket is given once along with
+    parallel lists of object keys, sizes and etags:
+    ```
+    {
+        "Batch": {
+            "bucket": "kf-study-us-east-1-dev-sd-0000000",
+            "keys": ["harmonized/cram/0.cram", "harmonized/cram/1.cram"],
+            "sizes": [1024, 2048],
+            "etags": ["d41d8cd98f00b204e9800998ecf8427e", "..."]
+        }
+    }
+    ```
+    Records in a batch are expanded into the minimal s3 record needed by
+    the `FileImporter`.
+    """
+    for record in event.get('Records', []):
+        yield record
+
+    batch = event.get('Batch', None)
+    if batch is None:
+        return
+    bucket = {'name': batch['bucket']}
+    for key, size, etag in zip(batch['keys'], batch['sizes'], batch['etags']):
+        yield {'s3': {'bucket': bucket,
+                      'object': {'key': key, 'size': size, 'eTag': etag}}}
+
+
+def remaining_event(event, i):
+    """
+    Returns a copy of the event with the first `i` records removed
+    """
+    remaining = dict(event)
+    records = event.get('Records', [])
+    if i < len(records) or 'Batch' not in event:
+        remaining['Records'] = records[i:]
+        return remaining
+
+    i -= len(records)
+    remaining.pop('Records', None)
+    remaining['Batch'] = {
+        'bucket': event['Batch']['bucket'],
+        'keys': event['Batch']['keys'][i:],
+        'sizes': event['Batch']['sizes'][i:],
+        'etags': event['Batch']['etags'][i:]
+    }
+    return remaining
+
+
+def is_sqs_event(event):
+    """
+    Returns whether the event was delivered by an SQS event source mapping
+    """
+    records = event.get('Records', [])
+    return len(records) > 0 and records[0].get('eventSource') == 'aws:sqs'
+
+
+def is_transient(err):
+    """
+    Returns whether an error that stopped an import may not happen again if
+    the import is retried later
+    """
+    if isinstance(err, (TransientException, EndpointConnectionError,
+                        RequestException)):
+        return True
+    if isinstance(err, ClientError):
+        return err.response.get('Error', {}).get('Code') in TRANSIENT_CODES
+    return False
+
+
+def study_id_from_bucket(bucket):
+    """
+    Returns the kf_id of the study that a study bucket belongs to
+    eg: kf-study-us-east-1-dev-sd-9pyzahhe -> SD_9PYZAHHE
+    """
+    return '_'.join(bucket.split('-')[-2:]).upper()
+
+
+def running_out_of_time(context):
+    """
+    Returns whether the lambda has less than 5 seconds left to run
+    """
+    return (hasattr(context, 'invoked_function_arn') and
+            context.get_remaining_time_in_millis() < 5000)
+
+
+class S3ClientPool:
+    """
+    Hands out s3 clients for the region that a bucket is in so that
+    requests to buckets in other regions avoid redirects.
+
+    A bucket's region is looked up once and remembered in `BUCKET_REGIONS`
+    and one client is kept per region, each with a connection pool of
+    `max_pool_connections`. If s3 does not say where a bucket is, the default
+    region is used, and is only remembered if asking again would not help.
+    """
+
+    def __init__(self, max_pool_connections=S3_MAX_POOL_CONNECTIONS):
+        self.config = Config(max_pool_connections=max_pool_connections)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, bucket):
+        """
+        Returns a client for the region that the bucket is in
+        """
+        region = self.region(bucket)
+        with self.lock:
+            if region not in self.clients:
+                self.clients[region] = boto3.client('s3', region_name=region,
+                                                    config=self.config)
+            return self.clients[region]
+
+    def region(self, bucket):
+        """
+        Returns the region that a bucket is in, looking it up the first time
+        """
+        if bucket in BUCKET_REGIONS:
+            return BUCKET_REGIONS[bucket]
+        region = self._locate(bucket)
+        if region is None:
+            return s3.meta.region_name
+        BUCKET_REGIONS[bucket] = region
+        return region
+
+    def _locate(self, bucket):
+        """
+        Returns the region of a bucket, or None if it could not be found out
+        this time, such as when the request was throttled
+
+        s3 gives the region of a bucket in the response to a `HEAD` of the
+        bucket whether or not we may access it, which buckets owned by
+        other accounts often do not let us do.
+        """
+        try:
+            resp = s3.head_bucket(Bucket=bucket)
+            region = region_header(resp)
+            if region is None:
+                region = location_region(
+                    s3.get_bucket_location(Bucket=bucket))
+            return region
+        except ClientError as err:
+            region = region_header(err.response)
+            if region is not None:
+                return region
+            print('could not locate bucket {}: {}'.format(bucket, err))
+            if is_transient(err):
+                return None
+            # Other errors, such as AccessDenied, will not go away so the
+            # default region is remembered rather than asking again
+            return s3.meta.region_name
+        except BotoCoreError as err:
+            print('could not locate bucket {}: {}'.format(bucket, err))
+            return None
+
+
+def region_header(response):
+    """
+    Returns the region of a bucket given in the headers of a response from
+    s3, if any
+    """
+    headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    return headers.get('x-amz-bucket-region', None)
+
+
+def location_region(location):
+    """
+    Returns the region of a bucket from its `GetBucketLocation` response
+    """
+    location = location.get('LocationConstraint', None)
+    # Buckets in us-east-1 have no location and EU is a legacy name
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
+
+# Shared across warm invocations
+s3_clients = S3ClientPool()
+
+
+def check_gf_id(gf_id, resp):
+    """
+    Checks the dataservice's response to a lookup of a `gf_id` tag
+
+    :returns: The gf_id, to import the file with as a pre-determined kf_id
+    :raises: `ImportException` if the genomic file is already registered
+    """
+    if resp.status_code != 404 and 'results' in resp.json():
+        raise ImportException(gf_id + ' already registered')
+    return gf_id
+
+
+def check_required_tags(tags):
+    """
+    :raises: `ImportException` if any of `REQUIRED_TAGS` are missing
+    """
+    missing = [tag for tag in REQUIRED_TAGS if tag not in tags]
+    if len(missing) > 0:
+        raise ImportException('missing required tag(s) {}'.format(missing))
+
+
+def check_biospecimen(resp):
+    """
+    :raises: `ImportException` if the dataservice did not find the
+        biospecimen
+    """
+    if resp.status_code != 200:
+        raise ImportException('biospecimen matching bs_id does not exist')
+
+
+def external_id_from(resp):
+    """
+    Returns the external_id of a study from the dataservice's response, if
+    it was found
+    """
+    if resp.status_code == 200 and 'results' in resp.json():
+        return resp.json()['results']['external_id']
+
+
+def genomic_file(bucket, key, etag, size, gf_id=None, bs_id=None,
+                 study_id=None, hashes=None):
+    """
+    Returns the body of a new genomic file for an object, without the
+    external_id of its study in the acl, see `FileImporter.new_file()`
+    """
+    file_name = key.split('/')[-1]
+    hashes = dict(hashes or {}, etag=etag.replace('"', ''))
+    urls = ['s3://{}/{}'.format(bucket, key)]
+    file_format = key.split('/')[-1].lower()
+    for k in FILE_FORMATS:
+        if file_format.endswith(k):
+            file_format = FILE_FORMATS[k]
+            break
+    if file_format not in DATA_TYPES:
+        raise ImportException('unknown file format {}'.format(file_name))
+    data_type = DATA_TYPES[file_format]
+    if file_format in FILE_FORMATS:
+        file_format = FILE_FORMATS[file_format]
+    harmonized = key.startswith('harmonized/')
+    # Add reference_genome for harmonized files
+    reference_genome = None
+    if harmonized:
+       reference_genome = 'GRCh38'
+    gf = {
+        'file_name': file_name,
+        'file_format': file_format,
+        'data_type': data_type,
+        'availability': 'Immediate Download',
+        'controlled_access': True,
+        'is_harmonized': harmonized,
+        'reference_genome': reference_genome,
+        'hashes': hashes,
+        'size': size,
+        'urls': urls,
+        'acl': []
+    }
+
+    if gf_id:
+        gf['kf_id'] = gf_id
+    if bs_id:
+        gf['biospecimen_id'] = bs_id
+    if study_id:
+        gf['acl'].append(study_id)
+    return gf
+
+
+def created_file(resp):
+    """
+    Returns the genomic file created by the dataservice
+
+    :raises: `DataServiceException` if the file was not created
+    """
+    if (resp.status_code != 201 or
+        'results' not in resp.json() or
+        'kf_id' not in resp.json()['results']):
+        raise DataServiceException('bad dataservice response')
+
+    return resp.json()['results']
+
+
 class FileImporter:
 
-    def __init__(self, api, cavatica_token):
+    def __init__(self, api, cavatica_token, clients=None, hasher=None):
         self.api = api
         self.cavatica_token = cavatica_token
         self.external_ids = {}
+        # Studies of buckets and biospecimens known to exist, given by the
+        # invoker, see `use_study()`
+        self.study_ids = {}
+        self.biospecimens = set()
+        self.clients = clients or s3_clients
+        # Computes content hashes of files if set, see `hashing.Hasher`
+        self.hasher = hasher
+
+    def resolve_study(self, bucket, biospecimens=False):
+        """
+        Looks up the study of a bucket so that it may be embedded in the
+        payloads of every batch of a scan, see `use_study()`
+
+        :param biospecimens: Whether to also list the kf_ids of the study's
+            biospecimens. They are left out if there are more than
+            `MAX_CONTEXT_BIOSPECIMENS`.
+        :returns: A dict of the `bucket`, `study_id`, `external_id` and
+            possibly `biospecimens` of the study
+        """
+        study_id = study_id_from_bucket(bucket)
+        study = {'bucket': bucket, 'study_id': study_id,
+                 'external_id': self.get_external_id(study_id)}
+        if biospecimens:
+            kf_ids = []
+            for bs in self.get_all('biospecimens', study_id):
+                kf_ids.append(bs['kf_id'])
+                if len(kf_ids) > MAX_CONTEXT_BIOSPECIMENS:
+                    return study
+            study['biospecimens'] = kf_ids
+        return study
+
+    def use_study(self, study):
+        """
+        Trusts the study of a bucket resolved by the invoker, see
+        `resolve_study()`, instead of looking it up for each record.
+        Biospecimens that are not listed are still looked up as they may
+        have been created since.
+        """
+        if not study:
+            return
+        if study.get('bucket', None) and study.get('study_id', None):
+            self.study_ids[study['bucket']] = study['study_id']
+        if study.get('external_id', None):
+            self.external_ids[study['study_id']] = study['external_id']
+        self.biospecimens.update(study.get('biospecimens', []))
 
-    def import_from_event(self, event):
+    def import_from_event(self, event, should_stop=None):
         """
         Processes a single record from an s3 event
+
+        The `stage` of the result is the step of the import that failed, or
+        `done` if both files were imported, see `STEPS`.
+
+        A record carrying a `progress` marker skips straight to its source
+        file, see `progress()`. If `should_stop` returns True once the
+        harmonized file is registered, the import is paused instead: the
+        `stage` of the result is `paused` and its marker is returned under
+        `progress`, as it is when the source file failed transiently.
         """
-        res = {'harmonized': 'not imported', 'source': 'not imported'}
-        try:
-            tags = self.import_harmonized(event)
-            res['harmonized'] = 'imported'
-        except (DataServiceException, ImportException) as err:
-            res['harmonized'] = str(err)
-            return res
+        res = {'harmonized': 'not imported', 'source': 'not imported',
+               'kf_ids': [], 'stage': 'done'}
+        marker = self.resume(event, res)
+        if marker is None:
+            f = self.harmonized_file(event)
+            try:
+                self.run_steps(f)
+                res['harmonized'] = 'imported'
+                res['kf_ids'].append(f.gf['kf_id'])
+            except IMPORT_ERRORS as err:
+                res['harmonized'] = str(err)
+                res['retry'] = is_transient(err)
+                res['stage'] = f.stage
+                return res
 
+            marker = self.progress(f)
+            if should_stop is not None and should_stop():
+                res['stage'] = PAUSED
+                res['progress'] = marker
+                return res
+
+        f = None
         try:
-            self.register_input(tags)
+            f = self.source_file(marker['tags'])
+            self.run_steps(f)
+            res['kf_ids'].append(f.gf['kf_id'])
             res['source'] = 'imported'
-        except (DataServiceException, ImportException) as err:
+        except SOURCE_ERRORS as err:
             res['source'] = str(err)
+            res['retry'] = is_transient(err)
+            res['stage'] = f.stage if f is not None else self.steps[0]
+            if res['retry']:
+                res['progress'] = marker
 
         return res
 
+    @property
+    def steps(self):
+        """
+        The steps of importing a file, skipping hashing if not configured
+        """
+        return [s for s in STEPS if s != 'hash' or self.hasher is not None]
+
+    def run_steps(self, f):
+        """
+        Runs every step of the import of a file in turn
+        """
+        for step in self.steps:
+            f.stage = step
+            getattr(self, step)(f)
+        f.stage = 'done'
+
     def import_harmonized(self, record):
         """
         Imports a harmonized file from an s3 event record
@@ -166,60 +918,235 @@ class FileImporter:
         object with the kf_id under the `gf_id` tag, unless there was already a
         `gf_id` field there.
         """
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-        tags = s3.get_object_tagging(Bucket=bucket, Key=key)
-        tags = {t['Key']: t['Value'] for t in tags['TagSet']}
+        f = self.harmonized_file(record)
+        self.run_steps(f)
+        return f.tags
+
+    def progress(self, f):
+        """
+        Returns the progress marker of a record once its harmonized file is
+        registered: the harmonized file's kf_id and the tags needed to
+        import the source file, eg:
+        ```
+        {"harmonized": "GF_00000000", "tags": {"bs_id": "BS_00000000", ...}}
+        ```
+        """
+        return {'harmonized': f.gf['kf_id'],
+                'tags': {k: f.tags[k] for k in PROGRESS_TAGS if k in f.tags}}
+
+    def resume(self, record, res):
+        """
+        Marks the harmonized file as imported in the result if the record
+        carries a progress marker, see `progress()`
+
+        :returns: The progress marker, or None to import from the start
+        """
+        marker = record.get('progress', None)
+        if marker is None:
+            return None
+        res['harmonized'] = 'imported'
+        res['kf_ids'].append(marker['harmonized'])
+        return marker
+
+    def harmonized_file(self, record):
+        """
+        Returns the state of the import of the harmonized file of a record
+        """
+        return ImportFile(s3, record['s3']['bucket']['name'],
+                          record['s3']['object']['key'],
+                          size=record['s3']['object']['size'],
+                          etag=record['s3']['object']['eTag'])
+
+    def source_file(self, harm_tags):
+        """
+        Returns the state of the import of the source file of a harmonized
+        file, given the harmonized file's tags
+        """
+        source_path = harm_tags['cavatica_source_path'].replace('s3://', '')
+        bucket, key = source_path.split('/', 1)
+        return ImportFile(self.clients.client(bucket), bucket, key,
+                          harm_tags=harm_tags)
+
+    def read_tags(self, f):
+        """
+        Reads the tags of a file. Harmonized files are tagged with their
+        `study_id` if they don't have one yet.
+        """
+        tags = f.client.get_object_tagging(Bucket=f.bucket, Key=f.key)
+        f.tags = {t['Key']: t['Value'] for t in tags['TagSet']}
 
         # Update if no study_id
-        if 'study_id' not in tags:
-            study_id = '_'.join(bucket.split('-')[-2:]).upper()
-            tags['study_id'] = study_id
-            tagset = {'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()]}
-            r = s3.put_object_tagging(Bucket=bucket, Key=key, Tagging=tagset)
-        study_id = tags['study_id']
+        if f.harmonized and 'study_id' not in f.tags:
+            f.tags['study_id'] = (self.study_ids.get(f.bucket, None) or
+                                  study_id_from_bucket(f.bucket))
+            self.put_tags(f)
+
+    def check(self, f, biospecimens=None):
+        """
+        Checks that a file may be imported
+
+        Skips the file if there is a kf_id assigned already that exists in
+        the dataservice. Harmonized files must have the required tags and a
+        biospecimen that exists. The size and etag of source files are read.
 
+        :param biospecimens: Optional dict of biospecimens already found to
+            exist, shared by the files of a batch
+        """
         # Skip if there is a kf_id assigned already and exists in dataservice
-        gf_id = self.get_gf_id_tag(tags)
+        f.gf_id = self.get_gf_id_tag(f.tags)
 
-        req_tags = ['cavatica_harmonized_file', 'cavatica_source_file',
-                    'cavatica_app', 'bs_id', 'cavatica_source_path',
-                    'cavatica_task']
+        if not f.harmonized:
+            obj = f.client.get_object(Bucket=f.bucket, Key=f.key)
+            f.size = obj['ContentLength']
+            f.etag = obj['ETag']
+            return
 
         # Make sure the required tags are there
-        missing = [tag for tag in req_tags if tag not in tags]
-        if len(missing) > 0:
-            raise ImportException('missing required tag(s) {}'.format(missing))
+        check_required_tags(f.tags)
 
         # Check that the biospecimen exists
-        resp = requests.get(self.api+'biospecimens/'+tags['bs_id'])
-        if resp.status_code != 200:
-            raise ImportException('biospecimen matching bs_id does not exist')
+        bs_id = f.tags['bs_id']
+        if bs_id in self.biospecimens:
+            return
+        if biospecimens is not None and bs_id in biospecimens:
+            return
+        check_biospecimen(self.get(self.api+'biospecimens/'+bs_id))
+        if biospecimens is not None:
+            biospecimens[bs_id] = True
+
+    def hash(self, f):
+        """
+        Computes the content hashes of a file, if configured to
+        """
+        # Leave room for the tags that `write_tags()` adds
+        pending = ['gf_id'] if f.harmonized else ['gf_id', 'study_id', 'bs_id']
+        f.hashes, f.hashed = self.hash_object(f.client, f.bucket, f.key,
+                                              f.size, f.tags, pending)
+
+    def register(self, f):
+        """
+        Creates the genomic file in the dataservice
+        """
+        tags = f.harm_tags or f.tags
+        f.gf = self.new_file(f.bucket, f.key, f.etag, f.size,
+                             gf_id=f.gf_id, bs_id=tags['bs_id'],
+                             study_id=tags['study_id'], hashes=f.hashes)
+
+    def write_tags(self, f):
+        """
+        Tags a file with the kf_id of its genomic file and, for a source
+        file, the study and biospecimen of its harmonized file
+
+        Tags are only written if any were missing or the file was just
+        hashed.
+        """
+        if f.harmonized:
+            # Update tags if no gf_id or the file was just hashed
+            if f.gf_id is None or f.hashed:
+                f.tags['gf_id'] = f.gf['kf_id']
+                self.put_tags(f)
+            return
+
+        # Update tags if study_id or gf_id weren't in the tags or the file
+        # was just hashed
+        if f.gf_id is None or 'study_id' not in f.tags or f.hashed:
+            f.tags['gf_id'] = f.gf['kf_id']
+            f.tags['study_id'] = f.harm_tags['study_id']
+            f.tags['bs_id'] = f.harm_tags['bs_id']
+            self.put_tags(f)
+
+    def put_tags(self, f):
+        tagset = {'TagSet': [{'Key': k, 'Value': v}
+                             for k, v in f.tags.items()]}
+        f.client.put_object_tagging(Bucket=f.bucket, Key=f.key,
+                                    Tagging=tagset)
+
+    def get(self, url):
+        """
+        Makes a GET request to the dataservice
+
+        :raises: `TransientException` if the request timed out, was throttled
+            or met a server error
+        """
+        return self._check(requests.get, url)
 
-        gf = self.new_file(bucket, key, record['s3']['object']['eTag'],
-                           record['s3']['object']['size'], gf_id=gf_id,
-                           bs_id=tags['bs_id'], study_id=study_id)
+    def post(self, url, json):
+        """
+        Makes a POST request to the dataservice
 
-        # Update tags if no gf_id
-        if gf_id is None:
-            tags['gf_id'] = gf['kf_id']
-            tagset = {'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()]}
-            r = s3.put_object_tagging(Bucket=bucket, Key=key, Tagging=tagset)
+        :raises: `TransientException` if the request timed out, was throttled
+            or met a server error
+        """
+        return self._check(requests.post, url, json=json)
 
-        return tags
+    def _check(self, method, url, **kwargs):
+        try:
+            resp = method(url, **kwargs)
+        except RequestException as err:
+            raise TransientException('dataservice request failed: {}'
+                                     .format(err))
+        if resp.status_code in TRANSIENT_STATUS:
+            raise TransientException('dataservice responded with {}'
+                                     .format(resp.status_code))
+        return resp
 
     def get_external_id(self, study_id):
         if study_id is None:
             return
         if study_id in self.external_ids:
             return self.external_ids[study_id]
-        resp = requests.get(self.api+'studies/'+study_id)
-        if resp.status_code == 200 and 'results' in resp.json():
-            self.external_ids[study_id] = resp.json()['results']['external_id']
-            return self.external_ids[study_id]
+        external_id = external_id_from(self.get(self.api+'studies/'+study_id))
+        if external_id is not None:
+            self.external_ids[study_id] = external_id
+        return external_id
+
+    def get_genomic_files(self, study_id, limit=100):
+        """
+        Yields every genomic file in a study from the dataservice, following
+        the pagination links a page at a time
+
+        :param study_id: The kf_id of the study
+        :param limit: The number of genomic files to request per page
+        :raises: `DataServiceException` if a page could not be retrieved
+        """
+        return self.get_all('genomic-files', study_id, limit)
+
+    def get_all(self, endpoint, study_id, limit=100):
+        """
+        Yields every entity of an endpoint in a study from the dataservice,
+        following the pagination links a page at a time
+
+        :raises: `DataServiceException` if a page could not be retrieved
+        """
+        url = '{}{}?study_id={}&limit={}'.format(self.api, endpoint,
+                                                 study_id, limit)
+        while url:
+            resp = self.get(url)
+            if resp.status_code != 200 or 'results' not in resp.json():
+                raise DataServiceException('bad dataservice response')
+            body = resp.json()
+            for entity in body['results']:
+                yield entity
+
+            next_page = body.get('_links', {}).get('next', None)
+            if len(body['results']) == 0 or not next_page:
+                break
+            url = self.api.rstrip('/') + next_page
+
+    def hash_object(self, client, bucket, key, size, tags, pending=()):
+        """
+        Returns the content hashes of an object, if configured to compute
+        them, and whether they were newly computed and added to `tags`
+
+        :param pending: Keys of tags that will be added to the object after
+        """
+        if self.hasher is None:
+            return {}, False
+        return self.hasher.hash_object(client, bucket, key, size, tags,
+                                       pending)
 
     def new_file(self, bucket, key, etag, size,
-                 gf_id=None, bs_id=None, study_id=None):
+                 gf_id=None, bs_id=None, study_id=None, hashes=None):
         """
         Creates a new genomic file in the dataservice
 
@@ -228,55 +1155,14 @@ class FileImporter:
         :param etag: The ETag of the object
         :param size: The size in bytes of the object
         :param gf_id: Optional kf_id for the genomic file
+        :param hashes: Optional content hashes of the object, eg: md5
         """
-        file_name = key.split('/')[-1]
-        hashes = {'etag': etag.replace('"', '')}
-        urls = ['s3://{}/{}'.format(bucket, key)]
-        file_format = key.split('/')[-1].lower()
-        for k in FILE_FORMATS:
-            if file_format.endswith(k):
-                file_format = FILE_FORMATS[k]
-                break
-        data_type = DATA_TYPES[file_format]
-        if file_format in FILE_FORMATS:
-            file_format = FILE_FORMATS[file_format]
-        harmonized = key.startswith('harmonized/')
-        # Add reference_genome for harmonized files
-        reference_genome = None
-        if harmonized:
-           reference_genome = 'GRCh38'
-        gf = {
-            'file_name': file_name,
-            'file_format': file_format,
-            'data_type': data_type,
-            'availability': 'Immediate Download',
-            'controlled_access': True,
-            'is_harmonized': harmonized,
-            'reference_genome': reference_genome,
-            'hashes': hashes,
-            'size': size,
-            'urls': urls,
-            'acl': []
-        }
-
-        if gf_id:
-            gf['kf_id'] = gf_id
-        if bs_id:
-            gf['biospecimen_id'] = bs_id
-        if study_id:
-            gf['acl'].append(study_id)
+        gf = genomic_file(bucket, key, etag, size, gf_id=gf_id, bs_id=bs_id,
+                          study_id=study_id, hashes=hashes)
         external_id = self.get_external_id(study_id)
         if external_id:
             gf['acl'].append(external_id)
-
-        resp = requests.post(self.api+'genomic-files', json=gf)
-
-        if (resp.status_code != 201 or
-            'results' not in resp.json() or
-            'kf_id' not in resp.json()['results']):
-            raise DataServiceException('bad dataservice response')
-
-        return resp.json()['results']
+        return created_file(self.post(self.api+'genomic-files', json=gf))
 
     def get_gf_id_tag(self, tags):
         """
@@ -294,41 +1180,44 @@ class FileImporter:
         :raises: `ImportException` if a file with the matching kf_id already
             exists in the dataservice
         """
-        gf_id = None
-        if 'gf_id' in tags:
-            url = self.api+'genomic-files/'+tags['gf_id']
-            resp = requests.get(url)
-            if resp.status_code != 404 and 'results' in resp.json():
-                raise ImportException(tags['gf_id'] + ' already registered')
-            # Save for later so we can import with pre-determined id
-            gf_id = tags['gf_id']
-        return gf_id
+        if 'gf_id' not in tags:
+            return None
+        url = self.api+'genomic-files/'+tags['gf_id']
+        return check_gf_id(tags['gf_id'], self.get(url))
 
     def register_input(self, harm_tags):
         """
         Registers a source genomic file given an s3 path
-        """
-        source_path = harm_tags['cavatica_source_path']
-        bucket = source_path.replace('s3://', '').split('/')[0]
-        key = '/'.join(source_path.split('/')[1:])
 
-        tags = s3.get_object_tagging(Bucket=bucket, Key=key)
-        tags = {t['Key']: t['Value'] for t in tags['TagSet']}
-
-        study_id = harm_tags['study_id']
+        :returns: The kf_id of the source genomic file
+        """
+        f = self.source_file(harm_tags)
+        self.run_steps(f)
+        return f.gf['kf_id']
 
-        gf_id = self.get_gf_id_tag(tags)
 
-        obj = s3.get_object(Bucket=bucket, Key=key)
+class ImportFile:
+    """
+    The state of the import of a harmonized or source file as it passes
+    through the steps of an import
+    """
 
-        gf = self.new_file(bucket, key, obj['ETag'], obj['ContentLength'],
-                           bs_id=harm_tags['bs_id'], study_id=study_id,
-                           gf_id=gf_id)
+    def __init__(self, client, bucket, key, size=None, etag=None,
+                 harm_tags=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        # The tags of the harmonized file, if this is a source file
+        self.harm_tags = harm_tags
+        self.tags = None
+        self.gf_id = None
+        self.hashes = {}
+        self.hashed = False
+        self.gf = None
+        self.stage = None
 
-        # Update tags if study_id or gf_id weren't in the tags
-        if gf_id is None or 'study_id' not in tags:
-            tags['gf_id'] = gf['kf_id']
-            tags['study_id'] = harm_tags['study_id']
-            tags['bs_id'] = harm_tags['bs_id']
-            tagset = {'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()]}
-            r = s3.put_object_tagging(Bucket=bucket, Key=key, Tagging=tagset)
+    @property
+    def harmonized(self):
+        return self.harm_tags is None
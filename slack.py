@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+from queue import Queue, Empty, Full
+from botocore.vendored import requests
+
+
+SLACK_API = os.environ.get('SLACK_API',
+                           'https://slack.com/api/chat.postMessage')
+# Seconds between progress updates
+PROGRESS_INTERVAL = float(os.environ.get('SLACK_PROGRESS_INTERVAL', 60))
+
+
+class SlackNotifier:
+    """
+    Sends slack messages from a background thread so that posting never
+    holds up the caller.
+
+    Messages are queued and dropped if the queue is full. Progress updates
+    are not queued; only the latest one is kept and it is posted at most
+    once every `interval` seconds.
+    """
+
+    def __init__(self, token, channels, url=SLACK_API,
+                 interval=PROGRESS_INTERVAL, max_queue=100, timeout=5):
+        self.token = token
+        self.channels = [c for c in channels if c]
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.queue = Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.sent = 0
+
+        self._progress = None
+        self._last_progress = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.token is not None and len(self.channels) > 0
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """
+        Sends any queued messages and waits up to `timeout` seconds for the
+        background thread to finish
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def send(self, msg=None, attachments=None):
+        """
+        Queues a message to be sent to every channel, dropping it if the
+        queue is full
+        """
+        if not self.enabled:
+            return
+        try:
+            self.queue.put_nowait((msg, attachments))
+        except Full:
+            self.dropped += 1
+
+    def progress(self, title, listed, dispatched, start):
+        """
+        Updates the progress of a scan, replacing any update not yet sent
+
+        :param title: What is being scanned, eg: `bucket/prefix`
+        :param listed: The number of objects listed so far
+        :param dispatched: The number of batches dispatched so far
+        :param start: The epoch time the scan started
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._progress = (title, listed, dispatched, start)
+
+    def _run(self):
+        while True:
+            try:
+                msg, attachments = self.queue.get(timeout=0.1)
+                self._post(msg, attachments)
+            except Empty:
+                if self._stopping.is_set():
+                    break
+            if time.time() - self._last_progress >= self.interval:
+                self._post_progress()
+
+    def _post_progress(self):
+        with self._lock:
+            progress, self._progress = self._progress, None
+        if progress is None:
+            return
+        self._last_progress = time.time()
+        self._post(attachments=progress_attachments(*progress))
+
+    def _post(self, msg=None, attachments=None):
+        for channel in self.channels:
+            message = {
+                'username': 'File Registry Bot',
+                'icon_emoji': ':file_folder:',
+                'channel': channel
+            }
+            if msg:
+                message['text'] = msg
+            if attachments:
+                message['attachments'] = attachments
+            try:
+                requests.post(self.url,
+                              headers={'Authorization': 'Bearer '+self.token},
+                              json=message, timeout=self.timeout)
+                self.sent += 1
+            except Exception as err:
+                print('failed to send slack message: {}'.format(err))
+
+
+def progress_attachments(title, listed, dispatched, start):
+    """
+    Formats a progress update as slack attachments
+    """
+    elapsed = max(time.time() - start, 1e-6)
+    rate = listed / elapsed
+    fields = [
+        {"title": "Objects Listed", "value": listed, "short": True},
+        {"title": "Batches Dispatched", "value": dispatched, "short": True},
+        {"title": "Rate", "value": "{:.0f}/s".format(rate), "short": True}
+    ]
+    text = "Still importing `{}`...".format(title)
+    return [{"fallback": text, "text": text, "fields": fields,
+             "color": "#005e99"}]
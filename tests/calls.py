@@ -0,0 +1,72 @@
+import json
+import os
+from collections import Counter
+
+import boto3
+
+import service
+
+BUDGETS = os.path.join(os.path.dirname(__file__), 'budgets.json')
+
+
+class CallCounter:
+    """
+    Counts the s3 api calls and dataservice requests made while in use
+
+    s3 calls are counted with a `before-call` hook on the default boto3
+    session, which clients created while counting inherit, and on
+    `service.s3`, which was created when `service` was imported. Dataservice
+    requests are read from the `tests.dataservice.DataService` in use.
+    """
+
+    def __init__(self, dataservice=None):
+        self.dataservice = dataservice
+        self.s3 = Counter()
+        self.emitters = [boto3._get_default_session().events,
+                         service.s3.meta.events]
+
+    def __enter__(self):
+        self.calls = len(self.dataservice.calls) if self.dataservice else 0
+        for events in self.emitters:
+            events.register('before-call.s3', self._count,
+                            unique_id='call-counter')
+        return self
+
+    def __exit__(self, *exc):
+        for events in self.emitters:
+            events.unregister('before-call.s3', self._count,
+                              unique_id='call-counter')
+
+    def _count(self, model, **kwargs):
+        self.s3[model.name] += 1
+
+    def counts(self):
+        """
+        Returns the number of calls made to each s3 operation and each
+        dataservice endpoint, eg: `GET biospecimens`
+        """
+        requests = Counter()
+        if self.dataservice is not None:
+            for method, path in self.dataservice.calls[self.calls:]:
+                endpoint = path.split('?')[0].split('/')[0]
+                requests['{} {}'.format(method, endpoint)] += 1
+        return {'s3': dict(self.s3), 'dataservice': dict(requests)}
+
+
+def over_budget(scenario, counts, budgets=None):
+    """
+    Returns a message for every count that is over the budget of a scenario,
+    calls without a budget may not be made at all
+    """
+    if budgets is None:
+        with open(BUDGETS) as f:
+            budgets = json.load(f)
+    budget = budgets[scenario]
+    over = []
+    for kind in ('s3', 'dataservice'):
+        for call, n in sorted(counts[kind].items()):
+            allowed = budget.get(kind, {}).get(call, 0)
+            if n > allowed:
+                over.append('{}: {} {} called {} times, budget is {}'.format(
+                    scenario, kind, call, n, allowed))
+    return over
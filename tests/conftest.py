@@ -0,0 +1,46 @@
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch
+
+from tests.dataservice import DataService
+from tests.test_service import BUCKET, SOURCE_BUCKET, TAGS
+
+
+@pytest.fixture(scope='function')
+def records():
+    @mock_s3
+    def with_records(n=20, tags=TAGS):
+        """
+        Create `n` harmonized files, each with their own source file, and
+        return an s3 event record for each
+        """
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.create_bucket(Bucket=SOURCE_BUCKET)
+        records = []
+        for i in range(n):
+            key = 'harmonized/cram/{}.cram'.format(i)
+            source = 'source/{}.bam'.format(i)
+            tagset = [t for t in tags['TagSet']
+                      if t['Key'] != 'cavatica_source_path']
+            tagset.append({'Key': 'cavatica_source_path',
+                           'Value': '{}/{}'.format(SOURCE_BUCKET, source)})
+            s3.put_object(Bucket=BUCKET, Key=key, Body=b'test')
+            s3.put_object_tagging(Bucket=BUCKET, Key=key,
+                                  Tagging={'TagSet': tagset})
+            s3.put_object(Bucket=SOURCE_BUCKET, Key=source, Body=b'test')
+            records.append({'s3': {'bucket': {'name': BUCKET},
+                                   'object': {'key': key, 'size': 4,
+                                              'eTag': 'abc'}}})
+        return records
+    return with_records
+
+
+@pytest.fixture(scope='function')
+def dataservice():
+    ds = DataService()
+    mock = patch('service.requests', ds)
+    mock.start()
+    yield ds
+    mock.stop()
@@ -0,0 +1,67 @@
+import threading
+from mock import MagicMock
+
+
+class DataService:
+    """
+    A stand-in for the dataservice to patch in place of `service.requests`
+
+    Genomic files that are posted are stored and may be looked up again.
+    Biospecimens and studies are considered to exist unless listed in
+    `missing`. Listing the biospecimens of a study returns `biospecimens`
+    in a single page. Every request made is recorded in `calls`.
+    """
+
+    def __init__(self, api='http://api.com/', missing=None, post_status=201,
+                 biospecimens=None):
+        self.api = api
+        self.missing = set(missing or [])
+        self.biospecimens = list(biospecimens or [])
+        self.post_status = post_status
+        self.genomic_files = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.counter = 0
+
+        self.get = MagicMock(side_effect=self._get)
+        self.post = MagicMock(side_effect=self._post)
+
+    def _response(self, status_code, body=None):
+        resp = MagicMock()
+        resp.status_code = status_code
+        resp.json.return_value = body or {}
+        return resp
+
+    def _get(self, url, *args, **kwargs):
+        path = url[len(self.api):]
+        with self.lock:
+            self.calls.append(('GET', path))
+        if path.startswith('biospecimens?'):
+            return self._response(200, {
+                'results': [{'kf_id': bs} for bs in self.biospecimens],
+                '_links': {}})
+        endpoint, kf_id = path.split('/', 1)
+        if endpoint == 'genomic-files':
+            if kf_id in self.genomic_files:
+                return self._response(200,
+                                      {'results': self.genomic_files[kf_id]})
+            return self._response(404)
+        if kf_id in self.missing:
+            return self._response(404)
+        if endpoint == 'studies':
+            return self._response(200, {'results': {'kf_id': kf_id,
+                                                    'external_id': 'SD'}})
+        return self._response(200, {'results': {'kf_id': kf_id}})
+
+    def _post(self, url, json=None, *args, **kwargs):
+        path = url[len(self.api):]
+        with self.lock:
+            self.calls.append(('POST', path))
+            if self.post_status != 201:
+                return self._response(self.post_status)
+            gf = dict(json)
+            if 'kf_id' not in gf:
+                self.counter += 1
+                gf['kf_id'] = 'GF_{:08d}'.format(self.counter)
+            self.genomic_files[gf['kf_id']] = gf
+        return self._response(201, {'results': gf})
@@ -0,0 +1,245 @@
+import os
+import json
+import asyncio
+import pytest
+from moto import mock_s3
+from mock import patch
+from aiohttp import web
+import asyncimporter
+import service
+
+from tests.context import Context
+from tests.test_service import BUCKET, TAGS
+
+
+def import_many(importer, recs, **kwargs):
+    """ Run `import_many()` to completion on a new event loop """
+    async def collect():
+        async with importer:
+            return [r async for r in importer.import_many(recs, **kwargs)]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(collect())
+    finally:
+        loop.close()
+
+
+@pytest.fixture(scope='function')
+def no_aiohttp():
+    """ Make dataservice requests through the patched `service.requests` """
+    with patch('asyncimporter.aiohttp', None):
+        yield
+
+
+@mock_s3
+def test_import_many(records, dataservice, no_aiohttp):
+    """ Test that records are imported with the same results as in sync """
+    recs = records(n=10)
+    importer = asyncimporter.AsyncFileImporter('http://api.com/', None)
+
+    results = import_many(importer, recs, concurrency=4)
+
+    assert importer.started == 10
+    assert sorted(name for _, name, _ in results) == \
+        sorted('{}/{}'.format(BUCKET, r['s3']['object']['key']) for r in recs)
+    for record, name, res in results:
+        assert res['harmonized'] == 'imported'
+        assert res['source'] == 'imported'
+        assert res['stage'] == 'done'
+        assert len(res['kf_ids']) == 2
+    assert len(dataservice.genomic_files) == 20
+
+
+@mock_s3
+def test_import_many_stage_failed(records, dataservice, no_aiohttp):
+    """ Test that the stage a record failed at is in its result """
+    tags = {'TagSet': [t for t in TAGS['TagSet'] if t['Key'] != 'bs_id']}
+    recs = records(n=3, tags=tags)
+    importer = asyncimporter.AsyncFileImporter('http://api.com/', None)
+
+    for _, _, res in import_many(importer, recs):
+        assert res['stage'] == 'check'
+        assert res['harmonized'] == "missing required tag(s) ['bs_id']"
+        assert res['retry'] is False
+
+
+@mock_s3
+def test_import_many_stops(records, dataservice, no_aiohttp):
+    """ Test that no more records are started once told to stop """
+    recs = records(n=10)
+    importer = asyncimporter.AsyncFileImporter('http://api.com/', None)
+
+    results = import_many(importer, recs, concurrency=2,
+                          should_stop=lambda: importer.started >= 3)
+
+    assert importer.started == 3
+    assert len(results) == 3
+
+
+@mock_s3
+def test_concurrency(records, dataservice, no_aiohttp):
+    """ Test that no more than `concurrency` records are imported at once """
+    recs = records(n=8)
+    importer = asyncimporter.AsyncFileImporter('http://api.com/', None)
+    running = []
+    most = []
+    import_from_event = importer.import_from_event
+
+    async def counted(record, should_stop=None):
+        running.append(record)
+        most.append(len(running))
+        await asyncio.sleep(0.01)
+        try:
+            return await import_from_event(record, should_stop)
+        finally:
+            running.remove(record)
+
+    importer.import_from_event = counted
+    results = import_many(importer, recs, concurrency=3)
+
+    assert len(results) == 8
+    assert max(most) == 3
+
+
+@mock_s3
+def test_handler_async(records, dataservice, no_aiohttp):
+    """ Test that the handler imports on the event loop and re-invokes """
+    recs = records(n=6)
+    event = {'Records': recs}
+    env = {'DATASERVICE_API': 'http://api.com/', 'IMPORT_CONCURRENCY': '2'}
+
+    # Time runs out once four records have been started
+    started = []
+    harmonized_file = service.FileImporter.harmonized_file
+
+    def start(importer, record):
+        started.append(record)
+        return harmonized_file(importer, record)
+
+    with patch.dict(os.environ, env), \
+            patch.object(service.FileImporter, 'harmonized_file', start), \
+            patch('service.running_out_of_time',
+                  side_effect=lambda context: len(started) >= 4), \
+            patch('service.boto3.client') as client:
+        res = service.handler(event, Context())
+
+    assert len(res) == 4
+    # Records in flight when time ran out are paused
+    paused = [r for r in res.values() if r['stage'] == service.PAUSED]
+    assert all(r['stage'] in ('done', service.PAUSED) for r in res.values())
+    _, args = client().invoke.call_args
+    payload = json.loads(args['Payload'].decode('utf-8'))
+    assert len(payload['Records']) == len(paused) + 2
+    assert all('progress' in r for r in payload['Records'][:len(paused)])
+    assert payload['Records'][len(paused):] == recs[4:]
+
+
+@mock_s3
+def test_source_file_error(records, dataservice, no_aiohttp):
+    """ Test that failing to find the source file fails only the record """
+    recs = records(n=2)
+    importer = asyncimporter.AsyncFileImporter('http://api.com/', None)
+    err = service.EndpointConnectionError(endpoint_url='https://s3')
+
+    with patch.object(importer.importer, 'source_file', side_effect=err):
+        results = import_many(importer, recs)
+
+    assert len(results) == 2
+    for _, _, res in results:
+        assert res['harmonized'] == 'imported'
+        assert res['retry'] is True
+        assert res['stage'] == 'read_tags'
+
+
+def serve(handler, test):
+    """
+    Runs `test(url)` to completion against a local dataservice that answers
+    every request with `handler`
+    """
+    async def run():
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await test('http://127.0.0.1:{}/'.format(port))
+        finally:
+            await runner.cleanup()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_request():
+    """ Test that dataservice responses are read with aiohttp """
+    async def handler(request):
+        if request.method == 'POST':
+            body = await request.json()
+            return web.json_response({'results': body}, status=201)
+        return web.Response(text='not found', status=404)
+
+    async def test(url):
+        async with asyncimporter.AsyncFileImporter(url, None) as importer:
+            posted = await importer.post(url + 'genomic-files',
+                                         json={'file_name': 'a.cram'})
+            missing = await importer.get(url + 'genomic-files/GF_1')
+        return posted, missing
+
+    posted, missing = serve(handler, test)
+    assert posted.status_code == 201
+    assert posted.json() == {'results': {'file_name': 'a.cram'}}
+    # Bodies that are not json are read as empty
+    assert missing.status_code == 404
+    assert missing.json() == {}
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_request_server_error(status):
+    """ Test that throttling and server errors are transient """
+    async def handler(request):
+        return web.json_response({}, status=status)
+
+    async def test(url):
+        async with asyncimporter.AsyncFileImporter(url, None) as importer:
+            await importer.get(url + 'studies/SD_1')
+
+    with pytest.raises(service.TransientException) as err:
+        serve(handler, test)
+    assert str(err.value) == 'dataservice responded with {}'.format(status)
+
+
+def test_request_timeout():
+    """ Test that a request that takes too long is transient """
+    async def handler(request):
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    async def test(url):
+        with patch('asyncimporter.REQUEST_TIMEOUT', 0.1):
+            async with asyncimporter.AsyncFileImporter(url, None) as importer:
+                await importer.get(url + 'studies/SD_1')
+
+    with pytest.raises(service.TransientException):
+        serve(handler, test)
+
+
+def test_request_connection_error():
+    """ Test that failing to connect to the dataservice is transient """
+    async def handler(request):
+        return web.json_response({})
+
+    async def test(url):
+        async with asyncimporter.AsyncFileImporter(url, None) as importer:
+            # Nothing listens on port 1
+            await importer.get('http://127.0.0.1:1/studies/SD_1')
+
+    with pytest.raises(service.TransientException) as err:
+        serve(handler, test)
+    assert str(err.value).startswith('dataservice request failed')
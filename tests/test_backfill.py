@@ -0,0 +1,124 @@
+import os
+import json
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch
+import backfill
+import service
+
+from tests.test_service import BUCKET, SOURCE_BUCKET, SOURCE_OBJECT, TAGS
+
+
+@pytest.fixture(scope='function')
+def objects():
+    @mock_s3
+    def with_objects(start, end):
+        """ Create tagged harmonized files sharing one source file """
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.create_bucket(Bucket=SOURCE_BUCKET)
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=SOURCE_OBJECT, Body=b'test')
+        for i in range(start, end):
+            key = 'harmonized/{:03d}.cram'.format(i)
+            s3.put_object(Bucket=BUCKET, Key=key, Body=b'test')
+            s3.put_object_tagging(Bucket=BUCKET, Key=key, Tagging=TAGS)
+    return with_objects
+
+
+@mock_s3
+def test_backfill(tmpdir, objects, dataservice):
+    """ Test that all objects are imported and results written """
+    objects(0, 12)
+    cursor = str(tmpdir.join('cursor'))
+    results = str(tmpdir.join('results.jsonl'))
+
+    done = backfill.main([BUCKET, '--prefix', 'harmonized/',
+                          '--api', 'http://api.com/', '--processes', '0',
+                          '--threads', '4', '--chunk-size', '5',
+                          '--cursor', cursor, '--results', results])
+
+    assert done == 12
+    res = {}
+    with open(results) as f:
+        for line in f:
+            res.update(json.loads(line))
+    assert len(res) == 12
+    assert all(r['harmonized'] == 'imported' for r in res.values())
+    assert 'source' in res['{}/harmonized/000.cram'.format(BUCKET)]
+    with open(cursor) as f:
+        assert f.read() == 'harmonized/011.cram'
+
+
+@mock_s3
+def test_backfill_resume(tmpdir, objects, dataservice):
+    """ Test that a run resumes after the last completed key """
+    objects(0, 8)
+    cursor = str(tmpdir.join('cursor'))
+    with open(cursor, 'w') as f:
+        f.write('harmonized/004.cram')
+
+    done = backfill.main([BUCKET, '--api', 'http://api.com/',
+                          '--processes', '0', '--cursor', cursor])
+
+    assert done == 3
+    posted = [gf['urls'][0] for gf in dataservice.genomic_files.values()]
+    assert 's3://{}/harmonized/005.cram'.format(BUCKET) in posted
+    assert 's3://{}/harmonized/004.cram'.format(BUCKET) not in posted
+
+
+def test_cursor_out_of_order(tmpdir):
+    """ Test that the cursor only advances over contiguous chunks """
+    cursor = str(tmpdir.join('cursor'))
+    b = backfill.Backfill(None, None, 1, 1, cursor=cursor)
+    b.pending = {0: 'a', 1: 'b', 2: 'c'}
+
+    b.complete(1)
+    assert not os.path.exists(cursor)
+    b.complete(0)
+    assert backfill.read_cursor(cursor) == 'b'
+    b.complete(2)
+    assert backfill.read_cursor(cursor) == 'c'
+
+
+def test_throttle():
+    """ Test that submissions are paced to the target rate """
+    b = backfill.Backfill(None, None, 1, 1, rate=100)
+    b.start = 0
+    b.listed = 50
+    with patch('backfill.time') as t:
+        t.time.return_value = 0.2
+        b.throttle()
+        t.sleep.assert_called_once()
+        assert abs(t.sleep.call_args[0][0] - 0.3) < 1e-9
+
+
+@mock_s3
+def test_backfill_processes(tmpdir, objects, dataservice):
+    """ Test that a failing record does not end a backfill in processes """
+    objects(0, 6)
+    results = str(tmpdir.join('results.jsonl'))
+    import_from_event = service.FileImporter.import_from_event
+
+    def fail_one(importer, record, *args):
+        if record['s3']['object']['key'] == 'harmonized/003.cram':
+            raise RuntimeError('unexpected')
+        return import_from_event(importer, record, *args)
+
+    # Workers are forked so must not inherit an importer from other tests
+    with patch.object(service.FileImporter, 'import_from_event', fail_one), \
+            patch.multiple(backfill, _importer=None, _pool=None):
+        done = backfill.main([BUCKET, '--api', 'http://api.com/',
+                              '--processes', '2', '--threads', '1',
+                              '--chunk-size', '2', '--results', results])
+
+    assert done == 6
+    res = {}
+    with open(results) as f:
+        for line in f:
+            res.update(json.loads(line))
+    failed = res.pop('{}/harmonized/003.cram'.format(BUCKET))
+    assert failed == {'harmonized': 'unexpected', 'source': 'not imported',
+                      'kf_ids': [], 'stage': service.STEPS[0],
+                      'retry': False}
+    assert all(r['harmonized'] == 'imported' for r in res.values())
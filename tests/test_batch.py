@@ -0,0 +1,109 @@
+import os
+import json
+from moto import mock_s3
+from mock import patch, MagicMock
+import invoker
+import service
+
+from tests.context import Context
+from tests.test_service import BUCKET, OBJECT, obj, event
+
+
+class Summary:
+    def __init__(self, key, size=1024, e_tag='"d41d8cd98f00b204e9800998ecf8427e"'):
+        self.key = key
+        self.size = size
+        self.e_tag = e_tag
+
+
+def test_batch_generator():
+    """ Test that objects are batched into compact payloads """
+    objects = (Summary('harmonized/{}.cram'.format(i), i) for i in range(25))
+    batches = list(invoker.batch_generator(BUCKET, objects, batch_size=10))
+
+    assert [len(b['Batch']['keys']) for b in batches] == [10, 10, 5]
+    assert batches[0]['Batch']['bucket'] == BUCKET
+    assert batches[2]['Batch']['keys'][0] == 'harmonized/20.cram'
+    assert batches[2]['Batch']['sizes'][0] == 20
+    assert batches[2]['Batch']['etags'][0] == 'd41d8cd98f00b204e9800998ecf8427e'
+
+
+def test_iter_records_compact():
+    """ Test that compact batches expand to the same records as events """
+    objects = [Summary(OBJECT), Summary('harmonized/1.cram', 2048)]
+    batch = next(invoker.batch_generator(BUCKET, objects))
+    records = list(service.iter_records(batch))
+
+    expected = [invoker.event_generator(BUCKET, o.key, o.size, o.e_tag)
+                for o in objects]
+    assert len(records) == 2
+    for record, ev in zip(records, expected):
+        assert record['s3']['bucket']['name'] == ev['s3']['bucket']['name']
+        assert record['s3']['object'] == ev['s3']['object']
+
+
+def test_remaining_event():
+    """ Test that the remaining records of a batch are kept in a batch """
+    objects = [Summary('harmonized/{}.cram'.format(i)) for i in range(3)]
+    batch = next(invoker.batch_generator(BUCKET, objects))
+    batch['Records'] = [invoker.event_generator(BUCKET, OBJECT, 1, 'abc')]
+
+    remaining = service.remaining_event(batch, 2)
+    assert 'Records' not in remaining
+    assert remaining['Batch']['keys'] == ['harmonized/1.cram',
+                                          'harmonized/2.cram']
+
+    remaining = service.remaining_event(batch, 0)
+    assert len(remaining['Records']) == 1
+    assert len(remaining['Batch']['keys']) == 3
+
+
+@mock_s3
+def test_handler_compact(event, obj):
+    """ Test that the handler imports records from a compact batch """
+    obj()
+    os.environ['DATASERVICE_API'] = 'http://api.com/'
+    mock = patch('service.requests')
+    req = mock.start()
+
+    def mock_get(url, *args, **kwargs):
+        resp = MagicMock()
+        resp.status_code = 404 if '/genomic-files' in url else 200
+        return resp
+
+    req.get.side_effect = mock_get
+    mock_resp = MagicMock()
+    mock_resp.json.return_value = {'results': {'kf_id': 'GF_00000000'}}
+    mock_resp.status_code = 201
+    req.post.return_value = mock_resp
+
+    payload = {'Batch': {'bucket': BUCKET, 'keys': [OBJECT],
+                         'sizes': [1024],
+                         'etags': ['d41d8cd98f00b204e9800998ecf8427e']}}
+    res = service.handler(json.loads(json.dumps(payload)), Context())
+
+    k = '{}/{}'.format(BUCKET, OBJECT)
+    assert res[k]['harmonized'] == 'imported'
+    assert res[k]['source'] == 'imported'
+    gf = req.post.call_args_list[0][1]['json']
+    assert gf['size'] == 1024
+    assert gf['hashes'] == {'etag': 'd41d8cd98f00b204e9800998ecf8427e'}
+
+    mock.stop()
+
+
+def test_handler_compact_out_of_time():
+    """ Test that a compact batch is re-invoked as a compact batch """
+    os.environ['DATASERVICE_API'] = 'http://api.com/'
+    objects = [Summary('harmonized/{}.cram'.format(i)) for i in range(3)]
+    batch = next(invoker.batch_generator(BUCKET, objects))
+
+    with patch('service.FileImporter') as importer, \
+            patch('service.boto3.client') as mock:
+        service.handler(batch, Context(300))
+        assert importer().import_from_event.call_count == 1
+
+        _, args = mock().invoke.call_args_list[0]
+        payload = json.loads(args['Payload'].decode('utf-8'))
+        assert payload['Batch']['keys'] == ['harmonized/1.cram',
+                                            'harmonized/2.cram']
@@ -0,0 +1,135 @@
+import os
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch
+import invoker
+import service
+
+from tests.calls import CallCounter, over_budget
+from tests.context import Context
+from tests.test_service import BUCKET, SOURCE_BUCKET, TAGS
+
+
+@pytest.fixture(autouse=True)
+def cold(dataservice):
+    """
+    Forgets regions and clients so that every scenario is counted as if the
+    lambda were cold
+    """
+    with patch.dict(service.BUCKET_REGIONS, clear=True), \
+            patch('service.s3_clients', service.S3ClientPool()), \
+            patch.dict(os.environ, {'DATASERVICE_API': dataservice.api}):
+        yield
+
+
+@pytest.fixture(scope='function')
+def files():
+    @mock_s3
+    def with_files(n=1, tags=TAGS, shared_source=False):
+        """
+        Create `n` harmonized files with the given tags, each with their own
+        source file unless `shared_source`, and return an s3 event for them
+        """
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.create_bucket(Bucket=SOURCE_BUCKET)
+        records = []
+        for i in range(n):
+            key = 'harmonized/cram/{}.cram'.format(i)
+            source = 'source/{}.bam'.format(0 if shared_source else i)
+            tagset = [t for t in tags['TagSet']
+                      if t['Key'] != 'cavatica_source_path']
+            tagset.append({'Key': 'cavatica_source_path',
+                           'Value': '{}/{}'.format(SOURCE_BUCKET, source)})
+            s3.put_object(Bucket=BUCKET, Key=key, Body=b'test')
+            s3.put_object_tagging(Bucket=BUCKET, Key=key,
+                                  Tagging={'TagSet': tagset})
+            s3.put_object(Bucket=SOURCE_BUCKET, Key=source, Body=b'test')
+            records.append({'s3': {'bucket': {'name': BUCKET},
+                                   'object': {'key': key, 'size': 4,
+                                              'eTag': 'abc'}}})
+        return {'Records': records}
+    return with_files
+
+
+def run(scenario, event, dataservice):
+    """ Run the handler for an event and check its calls are in budget """
+    with CallCounter(dataservice) as counter:
+        res = service.handler(event, Context())
+    assert over_budget(scenario, counter.counts()) == []
+    return res
+
+
+@mock_s3
+def test_new_file(files, dataservice):
+    """ Test the calls made to import a new file and its source """
+    res = run('new_file', files(), dataservice)
+    assert all(r['stage'] == 'done' for r in res.values())
+
+
+@mock_s3
+def test_existing_gf_id(files, dataservice):
+    """ Test the calls made for files that were imported already """
+    event = files()
+    # Import once so that both files are tagged with their gf_id
+    service.handler(event, Context())
+
+    res = run('existing_gf_id', event, dataservice)
+    assert all('already registered' in r['harmonized']
+               for r in res.values())
+
+
+@mock_s3
+def test_missing_tags(files, dataservice):
+    """ Test the calls made for a file that can't be imported """
+    tags = {'TagSet': [t for t in TAGS['TagSet'] if t['Key'] != 'bs_id']}
+    res = run('missing_tags', files(tags=tags), dataservice)
+    assert all(r['stage'] == 'check' for r in res.values())
+
+
+@mock_s3
+def test_shared_source(files, dataservice):
+    """ Test the calls made for files that share a source file """
+    res = run('shared_source', files(n=3, shared_source=True), dataservice)
+    assert len(res) == 3
+
+
+@mock_s3
+def test_invoker(files, dataservice):
+    """ Test the calls made by the invoker to scan a bucket """
+    files(n=25)
+    event = {'bucket': BUCKET, 'prefix': 'harmonized/'}
+    with patch.dict(os.environ, {'FILEREGISTRY': 'kf-fileregistry'}), \
+            patch('invoker.invoke') as invoke, \
+            CallCounter(dataservice) as counter:
+        invoker.handler(event, Context())
+
+    assert invoke.call_count == 3
+    assert over_budget('invoker', counter.counts()) == []
+
+
+@mock_s3
+def test_invoker_batch(files, dataservice):
+    """ Test the calls made for a batch carrying the study of its bucket """
+    event = files()
+    dataservice.biospecimens = ['BS_QV3Z0DZM']
+    with patch.dict(os.environ, {'FILEREGISTRY': 'kf-fileregistry'}), \
+            patch('invoker.invoke') as invoke:
+        invoker.handler({'bucket': BUCKET, 'biospecimens': True}, Context())
+    (_, _, payload), _ = invoke.call_args
+    event['study'] = payload['study']
+
+    res = run('invoker_batch', event, dataservice)
+    assert all(r['stage'] == 'done' for r in res.values())
+
+
+def test_over_budget():
+    """ Test that calls over budget, or without one, are reported """
+    budgets = {'s': {'s3': {'GetObject': 1}, 'dataservice': {}}}
+    counts = {'s3': {'GetObject': 2}, 'dataservice': {'GET studies': 1}}
+    assert over_budget('s', counts, budgets) == [
+        's: s3 GetObject called 2 times, budget is 1',
+        's: dataservice GET studies called 1 times, budget is 0']
+    counts = {'s3': {'GetObject': 1}, 'dataservice': {}}
+    assert over_budget('s', counts, budgets) == []
@@ -0,0 +1,127 @@
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch
+from botocore.exceptions import ClientError, EndpointConnectionError
+import service
+
+
+def located(region):
+    """ Returns a response from s3 giving the region of a bucket """
+    return {'ResponseMetadata': {
+        'HTTPHeaders': {'x-amz-bucket-region': region}
+    }}
+
+
+@pytest.fixture(autouse=True)
+def regions():
+    """ Forget bucket regions between tests """
+    service.BUCKET_REGIONS.clear()
+    yield service.BUCKET_REGIONS
+    service.BUCKET_REGIONS.clear()
+
+
+@mock_s3
+def test_client_region():
+    """ Test that clients are made for the region of the bucket """
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket='kf-seq-data-washu')
+    s3.create_bucket(Bucket='kf-seq-data-eu', CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-1'
+    })
+
+    pool = service.S3ClientPool(max_pool_connections=32)
+    us = pool.client('kf-seq-data-washu')
+    eu = pool.client('kf-seq-data-eu')
+
+    assert us.meta.region_name == 'us-east-1'
+    assert eu.meta.region_name == 'eu-west-1'
+    assert eu.meta.config.max_pool_connections == 32
+    # Clients are shared by buckets in the same region
+    assert pool.client('kf-seq-data-eu') is eu
+
+
+def test_region_memoized(regions):
+    """ Test that a bucket's region is only looked up once """
+    with patch('service.s3') as s3:
+        s3.head_bucket.return_value = located('eu-west-1')
+        pool = service.S3ClientPool()
+        assert pool.region('kf-seq-data-eu') == 'eu-west-1'
+        # A new pool, as in a warm invocation, uses the same regions
+        assert service.S3ClientPool().region('kf-seq-data-eu') == 'eu-west-1'
+
+    assert s3.head_bucket.call_count == 1
+    assert s3.get_bucket_location.call_count == 0
+    assert regions == {'kf-seq-data-eu': 'eu-west-1'}
+
+
+def test_region_location():
+    """ Test that the location is read if s3 gave no region header """
+    with patch('service.s3') as s3:
+        s3.head_bucket.return_value = {'ResponseMetadata': {}}
+        s3.get_bucket_location.return_value = {'LocationConstraint': 'EU'}
+        assert service.S3ClientPool().region('kf-seq-data-eu') == 'eu-west-1'
+
+
+def test_region_access_denied():
+    """ Test that the region is taken from the error if access is denied """
+    err = ClientError(dict(located('us-west-2'), Error={'Code': '403'}),
+                      'HeadBucket')
+    with patch('service.s3') as s3:
+        s3.head_bucket.side_effect = err
+        assert service.S3ClientPool().region('kf-seq-data-other') == \
+            'us-west-2'
+
+
+def test_region_access_denied_no_header(regions):
+    """ Test that a bucket that may not be located is not asked again """
+    err = ClientError({'Error': {'Code': 'AccessDenied'}}, 'HeadBucket')
+    with patch('service.s3') as s3:
+        s3.meta.region_name = 'us-east-1'
+        s3.head_bucket.side_effect = err
+        pool = service.S3ClientPool()
+        assert pool.region('kf-seq-data-other') == 'us-east-1'
+        assert pool.region('kf-seq-data-other') == 'us-east-1'
+
+    assert s3.head_bucket.call_count == 1
+    assert regions == {'kf-seq-data-other': 'us-east-1'}
+
+
+def test_register_input_uses_pool():
+    """ Test that the source file is read with the bucket's client """
+    pool = service.S3ClientPool()
+    importer = service.FileImporter('http://api.com/', None, clients=pool)
+    with patch.object(pool, 'client') as client, \
+            patch.object(importer, 'get_gf_id_tag', return_value='GF_1'), \
+            patch.object(importer, 'new_file',
+                         return_value={'kf_id': 'GF_1'}):
+        client().get_object_tagging.return_value = {'TagSet': []}
+        client().get_object.return_value = {'ETag': 'abc',
+                                            'ContentLength': 1}
+        importer.register_input({
+            'cavatica_source_path': 's3://kf-seq-data-eu/source/1.bam',
+            'study_id': 'SD_00000000',
+            'bs_id': 'BS_00000000'
+        })
+
+    client.assert_called_with('kf-seq-data-eu')
+    client().get_object_tagging.assert_called_with(
+        Bucket='kf-seq-data-eu', Key='source/1.bam')
+
+
+@pytest.mark.parametrize('err', [
+    ClientError({'Error': {'Code': '503'}}, 'HeadBucket'),
+    EndpointConnectionError(endpoint_url='https://s3.amazonaws.com'),
+])
+def test_region_not_found(regions, err):
+    """ Test that a region that could not be looked up is not remembered """
+    with patch('service.s3') as s3:
+        s3.meta.region_name = 'us-east-1'
+        s3.head_bucket.side_effect = [err, located('us-west-2')]
+        pool = service.S3ClientPool()
+        assert pool.region('kf-seq-data-other') == 'us-east-1'
+        assert regions == {}
+        # The next lookup finds the bucket's region
+        assert pool.region('kf-seq-data-other') == 'us-west-2'
+
+    assert regions == {'kf-seq-data-other': 'us-west-2'}
@@ -0,0 +1,144 @@
+import os
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch, MagicMock
+import invoker
+import outcomes
+
+from tests.context import Context
+
+BUCKET = 'kf-study-us-east-1-dev-sd-9pyzahhe'
+
+
+@pytest.fixture(scope='function')
+def bucket():
+    @mock_s3
+    def with_bucket():
+        """
+        Create a bucket with one large and one small prefix and an object
+        directly under the harmonized/ prefix
+        """
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        keys = (['harmonized/cram/{}.cram'.format(i) for i in range(5)] +
+                ['harmonized/crai/{}.crai'.format(i) for i in range(2)] +
+                ['harmonized/README'])
+        for key in keys:
+            s3.put_object(Bucket=BUCKET, Key=key, Body=b'test')
+    return with_bucket
+
+
+@mock_s3
+def test_fan_out(bucket, tmpdir):
+    """ Test that large prefixes are handed to child invokers """
+    bucket()
+    env = {'FILEREGISTRY': 'kf-fileregistry', 'OUTCOME_LOCATION': str(tmpdir)}
+
+    event = {'bucket': BUCKET, 'prefix': 'harmonized/', 'fanout': True,
+             'depth': 2, 'max_invokers': 10, 'run_id': 'run-1'}
+    with patch.dict(os.environ, env), \
+            patch('invoker.FANOUT_THRESHOLD', 3), \
+            patch('invoker.invoke') as invoke:
+        res = invoker.handler(event, Context())
+
+    assert res == '3 records processed in 1 calls and 1 child invokers'
+    payloads = [args[2] for args, _ in invoke.call_args_list]
+    children = [p for p in payloads if 'fanout' in p]
+    # Children and batches are traced back to this invoker
+    assert len(set(p.pop('trace')['parent'] for p in payloads)) == 1
+    batches = [p for p in payloads if 'Batch' in p]
+
+    assert invoke.call_args_list[0][0][1] == Context().invoked_function_arn
+    assert children == [{'bucket': BUCKET, 'prefix': 'harmonized/cram/',
+                         'fanout': True, 'depth': 1, 'max_invokers': 9,
+                         'run_id': 'run-1', 'child': True}]
+    assert sorted(batches[0]['Batch']['keys']) == [
+        'harmonized/README', 'harmonized/crai/0.crai',
+        'harmonized/crai/1.crai'
+    ]
+
+    totals = outcomes.invoker_totals(outcomes.writer(str(tmpdir)), 'run-1')
+    assert totals == {'invokers': 1, 'records': 3, 'invoked': 1,
+                      'children': 1}
+
+
+@mock_s3
+def test_fan_out_leaf(bucket):
+    """ Test that an invoker lists everything once out of depth """
+    bucket()
+    event = {'bucket': BUCKET, 'prefix': 'harmonized/cram/', 'fanout': True,
+             'depth': 0, 'max_invokers': 9, 'run_id': 'run-1', 'child': True}
+    with patch.dict(os.environ, {'FILEREGISTRY': 'kf-fileregistry'}), \
+            patch('invoker.FANOUT_THRESHOLD', 3), \
+            patch('invoker.invoke') as invoke:
+        res = invoker.handler(event, Context())
+
+    assert res == '5 records processed in 1 calls'
+    assert invoke.call_count == 1
+    assert invoke.call_args_list[0][0][1] == 'kf-fileregistry'
+
+
+@mock_s3
+def test_fan_out_budget(bucket):
+    """ Test that no more children are started than the budget allows """
+    bucket()
+    s3 = boto3.client('s3')
+    for i in range(5):
+        s3.put_object(Bucket=BUCKET, Key='harmonized/crai/{}.bai'.format(i),
+                      Body=b'test')
+
+    event = {'bucket': BUCKET, 'prefix': 'harmonized/', 'fanout': True,
+             'depth': 2, 'max_invokers': 1}
+    with patch.dict(os.environ, {'FILEREGISTRY': 'kf-fileregistry'}), \
+            patch('invoker.FANOUT_THRESHOLD', 3), \
+            patch('invoker.invoke') as invoke:
+        res = invoker.handler(event, Context())
+
+    children = [args[2] for args, _ in invoke.call_args_list
+                if 'fanout' in args[2]]
+    assert len(children) == 1
+    assert children[0]['prefix'] == 'harmonized/crai/'
+    assert children[0]['max_invokers'] == 0
+    # The other large prefix is listed by this invoker
+    assert res == '6 records processed in 1 calls and 1 child invokers'
+
+
+@mock_s3
+def test_fan_out_small_listed_once(bucket):
+    """ Test that small prefixes are not listed again to be dispatched """
+    bucket()
+    s3_bucket = boto3.resource('s3').Bucket(BUCKET)
+    event = {'depth': 2, 'max_invokers': 10}
+    with patch('invoker.FANOUT_THRESHOLD', 3), \
+            patch('invoker.invoke'), \
+            patch.object(s3_bucket.objects, 'filter') as listing:
+        objects, children = invoker.fan_out(s3_bucket, 'harmonized/', event,
+                                            Context(), MagicMock())
+        keys = sorted(obj.key for obj in objects)
+
+    assert children == 1
+    assert keys == ['harmonized/README', 'harmonized/crai/0.crai',
+                    'harmonized/crai/1.crai']
+    assert listing.call_count == 0
+
+
+@mock_s3
+def test_fan_out_out_of_time(bucket):
+    """ Test that prefixes are not looked at once out of time """
+    bucket()
+    s3_bucket = boto3.resource('s3').Bucket(BUCKET)
+    event = {'depth': 2, 'max_invokers': 10}
+    with patch('invoker.FANOUT_THRESHOLD', 3), \
+            patch('invoker.invoke') as invoke, \
+            patch('invoker.list_small') as list_small:
+        objects, children = invoker.fan_out(s3_bucket, 'harmonized/', event,
+                                            Context(remaining=3000),
+                                            MagicMock())
+        keys = sorted(obj.key for obj in objects)
+
+    assert children == 0
+    assert invoke.call_count == 0
+    assert list_small.call_count == 0
+    # Every prefix is left to this invoker
+    assert len(keys) == 8
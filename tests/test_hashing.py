@@ -0,0 +1,161 @@
+import os
+import time
+import hashlib
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch, MagicMock
+import hashing
+import service
+
+from tests.dataservice import DataService
+from tests.test_service import BUCKET, OBJECT, SOURCE_BUCKET, SOURCE_OBJECT
+from tests.test_service import obj, event
+
+KEY = 'harmonized/cram/large.cram'
+BODY = os.urandom(100 * 1024 + 17)
+
+
+@pytest.fixture
+def large():
+    @mock_s3
+    def with_large():
+        """ Create an object spanning many parts """
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.put_object(Bucket=BUCKET, Key=KEY, Body=BODY)
+        return s3
+    return with_large
+
+
+@mock_s3
+def test_compute_hashes(large):
+    """ Test that hashes of ranged parts match hashing the whole object """
+    s3 = large()
+    hashes = hashing.compute_hashes(s3, BUCKET, KEY, len(BODY),
+                                    ['md5', 'sha256'], part_size=4096,
+                                    concurrency=4)
+
+    assert hashes == {
+        'md5': hashlib.md5(BODY).hexdigest(),
+        'sha256': hashlib.sha256(BODY).hexdigest()
+    }
+
+
+@mock_s3
+def test_compute_hashes_deadline(large):
+    """ Test that hashing stops once the deadline passes """
+    s3 = large()
+    hashes = hashing.compute_hashes(s3, BUCKET, KEY, len(BODY), ['md5'],
+                                    part_size=4096, concurrency=2,
+                                    deadline=time.time() - 1)
+    assert hashes is None
+
+
+@mock_s3
+def test_hash_object_cached(large):
+    """ Test that hashes are added to tags and not computed again """
+    s3 = large()
+    hasher = hashing.Hasher(['md5'], part_size=4096)
+    tags = {'bs_id': 'BS_00000000'}
+
+    hashes, hashed = hasher.hash_object(s3, BUCKET, KEY, len(BODY), tags)
+    assert hashed
+    assert tags['md5'] == hashes['md5'] == hashlib.md5(BODY).hexdigest()
+
+    client = MagicMock()
+    assert hasher.hash_object(client, BUCKET, KEY, len(BODY), tags) == \
+        (hashes, False)
+    assert client.get_object.call_count == 0
+
+
+def test_hash_object_budget():
+    """ Test that objects are not hashed once the byte budget is used up """
+    client = MagicMock()
+    hasher = hashing.Hasher(['md5'], max_bytes=1024)
+    assert hasher.hash_object(client, BUCKET, KEY, 2048, {}) == ({}, False)
+
+    hasher = hashing.Hasher(['md5'], deadline=time.time() - 1)
+    assert hasher.hash_object(client, BUCKET, KEY, 10, {}) == ({}, False)
+    assert client.get_object.call_count == 0
+
+
+def test_hash_object_tag_limit():
+    """ Test that hashes are not added to tags if there is no room """
+    client = MagicMock()
+    client.get_object.return_value = {'Body': MagicMock(
+        read=MagicMock(side_effect=[b'test', b'']))}
+    hasher = hashing.Hasher(['md5'])
+    tags = {str(i): '' for i in range(hashing.MAX_TAGS)}
+
+    hashes, hashed = hasher.hash_object(client, BUCKET, KEY, 4, tags)
+    assert hashed
+    assert hashes == {'md5': hashlib.md5(b'test').hexdigest()}
+    assert 'md5' not in tags
+
+
+def test_hash_tag_limit_harmonized():
+    """ Test that room is left for the gf_id of a harmonized file """
+    client = MagicMock()
+    client.get_object.return_value = {'Body': MagicMock(
+        read=MagicMock(side_effect=[b'test', b'']))}
+    hasher = hashing.Hasher(['md5', 'sha1', 'sha256'])
+    importer = service.FileImporter('http://api.com/', None, hasher=hasher)
+    f = service.ImportFile(client, BUCKET, KEY, size=4)
+    # The required tags and study_id
+    f.tags = {t: 'x' for t in service.REQUIRED_TAGS + ['study_id']}
+    f.gf_id = None
+
+    importer.hash(f)
+    assert len(f.hashes) == 3
+    assert f.hashed
+
+    f.gf = {'kf_id': 'GF_00000001'}
+    importer.write_tags(f)
+    _, kwargs = client.put_object_tagging.call_args
+    tagset = kwargs['Tagging']['TagSet']
+    assert len(tagset) <= hashing.MAX_TAGS
+    assert {'Key': 'gf_id', 'Value': 'GF_00000001'} in tagset
+
+
+def test_from_env():
+    """ Test that hashing is only enabled when algorithms are set """
+    with patch.dict(os.environ, {'HASH_ALGORITHMS': ''}):
+        assert hashing.Hasher.from_env() is None
+
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 300000
+    with patch.dict(os.environ, {'HASH_ALGORITHMS': 'md5, sha256'}):
+        hasher = hashing.Hasher.from_env(context)
+    assert hasher.algorithms == ['md5', 'sha256']
+    assert hasher.deadline == pytest.approx(
+        time.time() + 300 - hashing.HASH_TIME_MARGIN, abs=5)
+
+
+@mock_s3
+def test_handler_hashes(event, obj):
+    """ Test that files are registered with their hashes when enabled """
+    obj()
+    ds = DataService()
+    mock = patch('service.requests', ds)
+    mock.start()
+
+    env = {'DATASERVICE_API': 'http://api.com/', 'HASH_ALGORITHMS': 'md5'}
+    with patch.dict(os.environ, env):
+        res = service.handler(event, {})
+
+    k = '{}/{}'.format(BUCKET, OBJECT)
+    assert res[k]['harmonized'] == 'imported'
+    assert res[k]['source'] == 'imported'
+
+    md5 = hashlib.md5(b'test').hexdigest()
+    for gf in ds.genomic_files.values():
+        assert gf['hashes']['md5'] == md5
+        assert 'etag' in gf['hashes']
+
+    s3 = boto3.client('s3')
+    for bucket, key in [(BUCKET, OBJECT), (SOURCE_BUCKET, SOURCE_OBJECT)]:
+        tagset = s3.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
+        assert {t['Key']: t['Value'] for t in tagset}['md5'] == md5
+
+    mock.stop()
@@ -0,0 +1,164 @@
+import io
+import os
+import csv
+import gzip
+import json
+import boto3
+import pytest
+from urllib.parse import quote_plus
+from moto import mock_s3
+from mock import patch
+import inventory
+import invoker
+
+from tests.context import Context
+
+BUCKET = 'kf-study-us-east-1-dev-sd-9pyzahhe'
+INVENTORY_BUCKET = 'kf-inventory'
+PREFIX = '{}/all/2018-05-01T00-00Z/'.format(BUCKET)
+MANIFEST = 's3://{}/{}manifest.json'.format(INVENTORY_BUCKET, PREFIX)
+SCHEMA = 'Bucket, Key, Size, LastModifiedDate, ETag, IsLatest, IsDeleteMarker'
+
+
+def rows(n, files):
+    """ Returns the rows of `n` objects split between `files` data files """
+    keys = (['harmonized/cram/{}.cram'.format(i) for i in range(n - 2)] +
+            ['harmonized/cram/with space+plus.cram', 'source/0.bam'])
+    objects = [[BUCKET, key, str(1024 * i), '2018-05-01T00:00:00.000Z',
+                '{:032x}'.format(i), 'true', 'false']
+               for i, key in enumerate(keys)]
+    # Old versions and deleted objects are not current
+    objects.append([BUCKET, 'harmonized/cram/old.cram', '1',
+                    '2018-04-01T00:00:00.000Z', 'a' * 32, 'false', 'false'])
+    objects.append([BUCKET, 'harmonized/cram/deleted.cram', '', '', '',
+                    'true', 'true'])
+    return [objects[i::files] for i in range(files)]
+
+
+@pytest.fixture(scope='function')
+def manifest():
+    @mock_s3
+    def with_manifest(n=50, files=3):
+        """
+        Create a CSV inventory of `n` objects split over `files` data files
+        """
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=INVENTORY_BUCKET)
+        entries = []
+        for i, data in enumerate(rows(n, files)):
+            out = io.StringIO()
+            for row in data:
+                # Keys are url encoded in CSV inventories
+                row[1] = quote_plus(row[1], safe='/')
+                csv.writer(out, quoting=csv.QUOTE_ALL).writerow(row)
+            key = '{}/data/{}.csv.gz'.format(BUCKET, i)
+            body = gzip.compress(out.getvalue().encode('utf-8'))
+            s3.put_object(Bucket=INVENTORY_BUCKET, Key=key, Body=body)
+            entries.append({'key': key, 'size': len(body)})
+
+        s3.put_object(Bucket=INVENTORY_BUCKET, Key=PREFIX + 'manifest.json',
+                      Body=json.dumps({
+                          'sourceBucket': BUCKET,
+                          'destinationBucket': 'arn:aws:s3:::' +
+                                               INVENTORY_BUCKET,
+                          'version': '2016-11-30',
+                          'fileFormat': 'CSV',
+                          'fileSchema': SCHEMA,
+                          'files': entries
+                      }).encode('utf-8'))
+        return s3
+    return with_manifest
+
+
+@mock_s3
+def test_objects(manifest):
+    """ Test that current objects under the prefix are read from all files """
+    s3 = manifest()
+    m = inventory.read_manifest(s3, MANIFEST)
+    assert inventory.source_bucket(m) == BUCKET
+
+    objs = list(inventory.objects(s3, m, prefix='harmonized/',
+                                  workers=2, chunk_size=7))
+
+    keys = sorted(o.key for o in objs)
+    assert len(keys) == 49
+    assert 'harmonized/cram/with space+plus.cram' in keys
+    assert 'harmonized/cram/old.cram' not in keys
+    assert 'harmonized/cram/deleted.cram' not in keys
+    first = [o for o in objs if o.key == 'harmonized/cram/1.cram'][0]
+    assert first.size == 1024
+    assert first.e_tag == '{:032x}'.format(1)
+
+
+def test_csv_rows_chunked():
+    """ Test that rows are handed over in chunks """
+    out = io.StringIO()
+    for row in rows(10, 1)[0]:
+        csv.writer(out).writerow(row)
+    body = io.BytesIO(gzip.compress(out.getvalue().encode('utf-8')))
+    schema = [c.strip() for c in SCHEMA.split(',')]
+
+    chunks = list(inventory.csv_rows(body, schema, chunk_size=4))
+    assert [len(c) for c in chunks] == [4, 4, 2]
+
+
+def test_in_parallel_error():
+    """ Test that an error reading one file is raised to the consumer """
+    def read(i):
+        if i == 2:
+            raise ValueError('bad data file')
+        yield [i]
+
+    with pytest.raises(ValueError):
+        list(inventory.in_parallel(read, range(5), 2))
+
+
+@mock_s3
+def test_unsupported_format(manifest):
+    """ Test that ORC inventories are refused """
+    s3 = manifest()
+    s3.put_object(Bucket=INVENTORY_BUCKET, Key='orc.json',
+                  Body=json.dumps({'fileFormat': 'ORC'}).encode('utf-8'))
+    with pytest.raises(ValueError):
+        inventory.read_manifest(s3, 's3://{}/orc.json'.format(INVENTORY_BUCKET))
+
+
+@mock_s3
+def test_parquet(manifest):
+    """ Test that Parquet data files are read a row group at a time """
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    s3 = manifest()
+    data = rows(10, 1)[0]
+    table = pa.Table.from_arrays(
+        [pa.array([r[i] for r in data]) for i in (1, 2, 4)],
+        names=['key', 'size', 'e_tag'])
+    out = io.BytesIO()
+    pq.write_table(table, out, row_group_size=3)
+    s3.put_object(Bucket=INVENTORY_BUCKET, Key='data/0.parquet',
+                  Body=out.getvalue())
+    m = {'sourceBucket': BUCKET, 'fileFormat': 'Parquet',
+         'destinationBucket': 'arn:aws:s3:::' + INVENTORY_BUCKET,
+         'files': [{'key': 'data/0.parquet'}]}
+
+    objs = list(inventory.objects(s3, m, prefix='harmonized/'))
+    assert len(objs) == 10
+
+
+@mock_s3
+def test_invoker_inventory(manifest):
+    """ Test that the invoker dispatches objects listed by an inventory """
+    manifest()
+    os.environ['FILEREGISTRY'] = 'kf-fileregistry'
+
+    event = {'inventory': MANIFEST, 'prefix': 'harmonized/'}
+    with patch('invoker.invoke') as invoke:
+        res = invoker.handler(event, Context())
+
+    del os.environ['FILEREGISTRY']
+
+    assert res == '49 records processed in 5 calls'
+    payloads = [args[2] for args, _ in invoke.call_args_list]
+    assert all(p['Batch']['bucket'] == BUCKET for p in payloads)
+    keys = [k for p in payloads for k in p['Batch']['keys']]
+    assert len(set(keys)) == 49
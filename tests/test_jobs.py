@@ -0,0 +1,137 @@
+import os
+import time
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch
+import invoker
+import outcomes
+
+from tests.context import Context
+
+LARGE = 'kf-study-us-east-1-dev-sd-00000000'
+SMALL = 'kf-study-us-east-1-dev-sd-11111111'
+
+
+@pytest.fixture(scope='function')
+def buckets():
+    @mock_s3
+    def with_buckets():
+        """ Create a study with three batches and one with a single batch """
+        s3 = boto3.client('s3')
+        for bucket, n in [(LARGE, 25), (SMALL, 4)]:
+            s3.create_bucket(Bucket=bucket)
+            for i in range(n):
+                s3.put_object(Bucket=bucket, Key='harmonized/{}.cram'.format(i),
+                              Body=b'test')
+    return with_buckets
+
+
+def test_round_robin():
+    """ Test that jobs take turns in proportion to their weights """
+    a = invoker.Job('a', weight=2)
+    a.batches = iter(['a1', 'a2', 'a3', 'a4', 'a5'])
+    b = invoker.Job('b')
+    b.batches = iter(['b1', 'b2'])
+
+    order = [(job.bucket, p) for job, p in invoker.round_robin([a, b])]
+
+    assert order == [('a', 'a1'), ('a', 'a2'), ('b', 'b1'),
+                     ('a', 'a3'), ('a', 'a4'), ('b', 'b2'),
+                     ('a', 'a5'), ('a', None), ('b', None)]
+    assert a.done and b.done
+
+
+def test_in_flight_limit():
+    """ Test that no more than the limit are sent within the window """
+    limit = invoker.InFlightLimit(2, window=0.2)
+    start = time.time()
+    assert all(limit.acquire(Context()) for _ in range(4))
+    assert time.time() - start >= 0.2
+
+    # Waiting longer than the lambda has left gives up
+    limit = invoker.InFlightLimit(1, window=10)
+    assert limit.acquire(Context())
+    assert not limit.acquire(Context(remaining=5000))
+
+
+@mock_s3
+def test_handler_throttled(buckets):
+    """ Test that a scan stopped by the throttle is not reported finished """
+    buckets()
+    env = {'FILEREGISTRY': 'kf-fileregistry'}
+    with patch.dict(os.environ, env), \
+            patch('invoker.MAX_IN_FLIGHT', 2), \
+            patch('invoker.IN_FLIGHT_WINDOW', 60), \
+            patch('invoker.invoke') as invoke, \
+            patch('invoker.SlackNotifier') as slack:
+        res = invoker.handler({'bucket': LARGE}, Context(remaining=30000))
+
+    assert invoke.call_count == 2
+    assert res == '20 records processed in 2 calls before running out of time'
+    _, kwargs = slack().start().send.call_args
+    assert kwargs['attachments'][0]['color'] == 'danger'
+    assert kwargs['attachments'][0]['text'].startswith('Ran out of time')
+
+
+@mock_s3
+def test_jobs(buckets, tmpdir):
+    """ Test that a small study is not held up behind a large one """
+    buckets()
+    env = {'FILEREGISTRY': 'kf-fileregistry', 'OUTCOME_LOCATION': str(tmpdir)}
+
+    event = {'run_id': 'run-1', 'jobs': [
+        {'bucket': LARGE, 'prefix': 'harmonized/'},
+        {'bucket': SMALL}
+    ]}
+    with patch.dict(os.environ, env), \
+            patch('invoker.invoke') as invoke:
+        res = invoker.handler(event, Context())
+
+    assert res == '29 records processed in 4 calls across 2 jobs'
+    buckets = [args[2]['Batch']['bucket'] for args, _ in invoke.call_args_list]
+    assert buckets == [LARGE, SMALL, LARGE, LARGE]
+
+    totals = outcomes.invoker_totals(outcomes.writer(str(tmpdir)), 'run-1')
+    assert totals == {'invokers': 1, 'records': 29, 'invoked': 4,
+                      'children': 0}
+
+
+@mock_s3
+def test_jobs_out_of_time(buckets):
+    """ Test that jobs are not reported as finished if time runs out """
+    buckets()
+
+    event = {'jobs': [{'bucket': LARGE}, {'bucket': SMALL}]}
+    with patch.dict(os.environ, {'FILEREGISTRY': 'kf-fileregistry'}), \
+            patch('invoker.invoke') as invoke, \
+            patch('invoker.job_attachments') as attachments:
+        res = invoker.handler(event, Context(remaining=500))
+
+    assert res == '0 records processed in 0 calls across 2 jobs'
+    assert invoke.call_count == 0
+    assert [args[0].done for args, _ in attachments.call_args_list] == \
+        [False, False]
+
+
+@mock_s3
+def test_jobs_finished_before_timeout(buckets):
+    """ Test that a job finished as time runs out is reported as finished """
+    buckets()
+    context = Context()
+
+    def run_out(*args):
+        # Time runs out once the small study has been sent
+        if args[2]['Batch']['bucket'] == SMALL:
+            context.remaining = 500
+
+    event = {'jobs': [{'bucket': LARGE}, {'bucket': SMALL}]}
+    with patch.dict(os.environ, {'FILEREGISTRY': 'kf-fileregistry'}), \
+            patch('invoker.invoke', side_effect=run_out) as invoke, \
+            patch('invoker.job_attachments') as attachments:
+        invoker.handler(event, context)
+
+    assert invoke.call_count == 2
+    jobs = [args[0] for args, _ in attachments.call_args_list]
+    assert [(job.bucket, job.done) for job in jobs] == \
+        [(SMALL, True), (LARGE, False)]
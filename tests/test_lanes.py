@@ -0,0 +1,147 @@
+import os
+import json
+from mock import patch
+import invoker
+import lanes
+import service
+
+from tests.context import Context
+from tests.test_batch import Summary
+from tests.test_sqs import sqs_event
+from tests.test_service import BUCKET
+
+
+def record(key, priority=None):
+    rec = {'s3': {'bucket': {'name': BUCKET},
+                  'object': {'key': key, 'size': 4, 'eTag': 'abc'}}}
+    if priority is not None:
+        rec['priority'] = priority
+    return rec
+
+
+def test_priority():
+    """ Test that records are live unless tagged as backfill """
+    assert lanes.priority(record('a')) == lanes.LIVE
+    assert lanes.priority(record('a', 'backfill')) == lanes.BACKFILL
+    assert lanes.priority(record('a'), {'priority': 'backfill'}) == \
+        lanes.BACKFILL
+    assert lanes.priority(record('a', 'live'), {'priority': 'backfill'}) == \
+        lanes.LIVE
+    assert lanes.priority(record('a', 'urgent')) == lanes.LIVE
+
+
+def test_prioritized():
+    """ Test that live records come first and order is otherwise kept """
+    records = [record('0', 'backfill'), record('1'),
+               record('2', 'backfill'), record('3')]
+    keys = [r['s3']['object']['key'] for r in lanes.prioritized(records)]
+    assert keys == ['1', '3', '0', '2']
+
+
+def test_share():
+    """ Test that backfills get their share of capacity, and at least 1 """
+    with patch('lanes.BACKFILL_SHARE', 0.25):
+        assert lanes.share(20) == 5
+        assert lanes.share(2) == 1
+        assert lanes.share(0) == 0
+        assert lanes.share(20, lanes.LIVE) == 20
+
+
+def test_lane_of():
+    """ Test that a group is only backfill if every record is """
+    assert lanes.lane_of([record('0', 'backfill')]) == lanes.BACKFILL
+    assert lanes.lane_of([record('0', 'backfill'), record('1')]) == \
+        lanes.LIVE
+    assert lanes.lane_of([record('0')], {'priority': 'backfill'}) == \
+        lanes.BACKFILL
+
+
+def test_invoker_tags_backfill():
+    """ Test that payloads from the invoker are tagged as backfill """
+    objects = [Summary('harmonized/{}.cram'.format(i)) for i in range(3)]
+    batch = next(invoker.batch_generator(BUCKET, objects))
+    assert batch['priority'] == lanes.BACKFILL
+    records = list(service.iter_records(batch))
+    assert lanes.lane_of(records, batch) == lanes.BACKFILL
+
+    ev = invoker.event_generator(BUCKET, 'harmonized/0.cram', 1, 'abc')
+    assert lanes.priority(ev) == lanes.BACKFILL
+
+
+def test_backfill_limit():
+    """ Test that backfills are paced to their share of the fileregistry """
+    with patch('invoker.FILEREGISTRY_CONCURRENCY', 10), \
+            patch('invoker.MAX_IN_FLIGHT', 0), \
+            patch('lanes.BACKFILL_SHARE', 0.5):
+        assert invoker.backfill_limit().max_in_flight == 5
+    with patch('invoker.FILEREGISTRY_CONCURRENCY', 10), \
+            patch('invoker.MAX_IN_FLIGHT', 3):
+        assert invoker.backfill_limit().max_in_flight == 3
+    with patch('invoker.FILEREGISTRY_CONCURRENCY', 0), \
+            patch('invoker.MAX_IN_FLIGHT', 0):
+        assert invoker.backfill_limit().max_in_flight == 0
+
+
+def test_handler_live_first():
+    """ Test that live records are imported first and the rest re-invoked """
+    os.environ['DATASERVICE_API'] = 'http://api.com/'
+    records = [record('0', 'backfill'), record('1'),
+               record('2', 'backfill'), record('3')]
+    imported = []
+
+    def import_record(importer, rec, sink=None, run_id=None,
+                      should_stop=None):
+        imported.append(rec['s3']['object']['key'])
+        return rec['s3']['object']['key'], {'harmonized': 'imported'}
+
+    with patch('service.import_record', side_effect=import_record), \
+            patch('service.FileImporter'), \
+            patch('service.running_out_of_time',
+                  side_effect=[False, False, True]), \
+            patch('service.boto3.client') as client:
+        service.handler({'Records': records}, Context())
+
+    assert imported == ['1', '3']
+    _, args = client().invoke.call_args
+    payload = json.loads(args['Payload'].decode('utf-8'))
+    assert [r['s3']['object']['key'] for r in payload['Records']] == \
+        ['0', '2']
+    assert all(lanes.priority(r, payload) == lanes.BACKFILL
+               for r in payload['Records'])
+
+
+def test_handler_backfill_share():
+    """ Test that a backfill imports fewer records at once than live """
+    os.environ['DATASERVICE_API'] = 'http://api.com/'
+    env = {'IMPORT_CONCURRENCY': '8'}
+    batch = {'Batch': {'bucket': BUCKET, 'keys': ['0', '1'],
+                       'sizes': [4, 4], 'etags': ['abc', 'abc']}}
+
+    for priority, concurrency in [('live', 8), ('backfill', 2)]:
+        with patch.dict(os.environ, env), \
+                patch('lanes.BACKFILL_SHARE', 0.25), \
+                patch('service.FileImporter'), \
+                patch('service.import_async',
+                      return_value=([], 2)) as import_async:
+            service.handler(dict(batch, priority=priority), Context())
+        args, _ = import_async.call_args
+        assert args[3] == concurrency
+
+
+def test_sqs_live_first():
+    """ Test that live messages are processed before backfill messages """
+    os.environ['DATASERVICE_API'] = 'http://api.com/'
+    backfill = {'priority': 'backfill', 'Records': [record('0')]}
+    live = {'Records': [record('1')]}
+    imported = []
+
+    def import_record(importer, rec, sink=None, run_id=None,
+                      should_stop=None):
+        imported.append(rec['s3']['object']['key'])
+        return rec['s3']['object']['key'], {'harmonized': 'imported'}
+
+    with patch('service.import_record', side_effect=import_record), \
+            patch('service.FileImporter'):
+        service.handler(sqs_event([backfill, live, backfill]), Context())
+
+    assert imported == ['1', '0', '0']
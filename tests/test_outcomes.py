@@ -0,0 +1,89 @@
+import os
+import json
+import boto3
+from moto import mock_s3
+from mock import patch
+import outcomes
+import service
+
+from tests.dataservice import DataService
+from tests.test_service import BUCKET, OBJECT, obj, event
+
+
+def outcome(harmonized, source, start, duration=1.0):
+    return {'object': 'bucket/key', 'harmonized': harmonized,
+            'source': source, 'kf_ids': [], 'start': start,
+            'duration': duration}
+
+
+@mock_s3
+def test_handler_outcomes(tmpdir, event, obj):
+    """ Test that the handler writes the outcome of each record """
+    obj()
+    env = {'DATASERVICE_API': 'http://api.com/',
+           'OUTCOME_LOCATION': str(tmpdir)}
+    event['run_id'] = 'run-1'
+    with patch.dict(os.environ, env), \
+            patch('service.requests', DataService()):
+        service.handler(event, {})
+
+    lines = list(outcomes.LocalWriter(str(tmpdir)).read('run-1'))
+    assert len(lines) == 1
+    res = json.loads(lines[0])
+    assert res['object'] == '{}/{}'.format(BUCKET, OBJECT)
+    assert res['harmonized'] == 'imported'
+    assert res['source'] == 'imported'
+    assert res['kf_ids'] == ['GF_00000001', 'GF_00000002']
+    assert res['duration'] >= 0
+
+
+def test_sink_parts(tmpdir):
+    """ Test that outcomes are written in parts per run """
+    sink = outcomes.OutcomeSink(outcomes.LocalWriter(str(tmpdir)),
+                                part_size=2)
+    for i in range(3):
+        sink.append('b/{}'.format(i), {'harmonized': 'imported',
+                                       'source': 'imported'}, i, 0.5, 'a')
+    sink.append('b/3', {'harmonized': 'imported'}, 0, 0.5, 'b')
+
+    # The first part of run a is written once full
+    assert len(os.listdir(str(tmpdir.join('a')))) == 1
+    sink.flush()
+    assert len(os.listdir(str(tmpdir.join('a')))) == 2
+    assert len(os.listdir(str(tmpdir.join('b')))) == 1
+
+
+@mock_s3
+def test_s3_writer():
+    """ Test that parts may be written to and streamed from s3 """
+    boto3.client('s3').create_bucket(Bucket='outcomes')
+    writer = outcomes.writer('s3://outcomes/registry')
+    sink = outcomes.OutcomeSink(writer, part_size=10)
+    for i in range(25):
+        sink.append('b/{}'.format(i), {'harmonized': 'imported',
+                                       'source': 'imported'}, i, 1, 'run')
+    sink.flush()
+
+    keys = boto3.client('s3').list_objects(Bucket='outcomes')['Contents']
+    assert len(keys) == 3
+    assert all(k['Key'].startswith('registry/run/') for k in keys)
+    assert outcomes.summarize(writer.read('run'))['records'] == 25
+
+
+def test_summarize():
+    """ Test that totals, errors and throughput are computed """
+    res = outcomes.summarize([
+        outcome('imported', 'imported', 0),
+        outcome('imported', 'GF_1 already registered', 1),
+        json.dumps(outcome('GF_2 already registered', 'not imported', 2)),
+        outcome('bad dataservice response', 'not imported', 3),
+        outcome('bad dataservice response', 'not imported', 4, 6.0),
+    ])
+
+    assert res['records'] == 5
+    assert res['harmonized'] == {'imported': 2, 'skipped': 1, 'failed': 2}
+    assert res['source'] == {'imported': 1, 'skipped': 1,
+                             'not attempted': 3}
+    assert res['errors'] == {'bad dataservice response': 2}
+    assert res['elapsed'] == 10
+    assert res['records_per_sec'] == 0.5
@@ -0,0 +1,146 @@
+import os
+import json
+from moto import mock_s3
+from mock import patch
+import pipeline
+import service
+
+from tests.dataservice import DataService
+from tests.context import Context
+from tests.test_service import BUCKET, TAGS
+
+
+def test_workers_from_env():
+    """ Test that worker counts are parsed for each stage """
+    assert pipeline.workers_from_env('') is None
+    assert pipeline.workers_from_env('true') == {}
+    assert pipeline.workers_from_env('check=8, register=4') == \
+        {'check': 8, 'register': 4}
+
+
+@mock_s3
+def test_pipeline(records, dataservice):
+    """ Test that records are imported through every stage """
+    recs = records()
+    importer = service.FileImporter('http://api.com/', None)
+    p = pipeline.Pipeline(importer, service.is_transient,
+                          {'check': 3, 'register': 4}, batch_size=4)
+
+    results = list(p.run(recs))
+
+    assert len(results) == 20
+    assert p.started == 20
+    for record, name, res in results:
+        assert name == '{}/{}'.format(BUCKET, record['s3']['object']['key'])
+        assert res['harmonized'] == 'imported'
+        assert res['source'] == 'imported'
+        assert res['stage'] == 'done'
+        assert len(res['kf_ids']) == 2
+    assert len(dataservice.genomic_files) == 40
+
+    report = p.report()
+    assert list(report['stages']) == ['read_tags', 'check', 'register',
+                                      'write_tags']
+    assert report['stages']['register']['workers'] == 4
+    assert all(s['processed'] == 40 for s in report['stages'].values())
+    assert report['bottleneck'] in report['stages']
+
+
+@mock_s3
+def test_pipeline_stage_failed(records, dataservice):
+    """ Test that the stage a record failed at is in its result """
+    tags = {'TagSet': [t for t in TAGS['TagSet'] if t['Key'] != 'bs_id']}
+    recs = records(n=3, tags=tags)
+    importer = service.FileImporter('http://api.com/', None)
+    p = pipeline.Pipeline(importer, service.is_transient)
+
+    for _, _, res in p.run(recs):
+        assert res['stage'] == 'check'
+        assert res['harmonized'] == "missing required tag(s) ['bs_id']"
+        assert res['retry'] is False
+
+    # Imports of a single record report the same stage
+    assert importer.import_from_event(recs[0])['stage'] == 'check'
+
+
+@mock_s3
+def test_pipeline_stops(records, dataservice):
+    """ Test that no more records are started once told to stop """
+    recs = records(n=10)
+    importer = service.FileImporter('http://api.com/', None)
+    p = pipeline.Pipeline(importer, service.is_transient, max_in_flight=2)
+
+    results = list(p.run(recs, should_stop=lambda: p.started >= 3))
+
+    assert p.started == 3
+    assert len(results) == 3
+
+
+def test_biospecimens_shared():
+    """ Test that a biospecimen is looked up once for a batch """
+    ds = DataService()
+    importer = service.FileImporter('http://api.com/', None)
+    tags = {t['Key']: t['Value'] for t in TAGS['TagSet']}
+    biospecimens = {}
+    with patch('service.requests', ds):
+        for i in range(3):
+            f = service.ImportFile(None, BUCKET, 'harmonized/{}.cram'.format(i))
+            f.tags = dict(tags)
+            importer.check(f, biospecimens)
+
+    assert ds.calls.count(('GET', 'biospecimens/BS_QV3Z0DZM')) == 1
+
+
+@mock_s3
+def test_handler_pipeline(records, dataservice):
+    """ Test that the handler re-invokes with records it did not start """
+    recs = records(n=6)
+    event = {'Records': recs}
+    env = {'DATASERVICE_API': 'http://api.com/',
+           'PIPELINE_WORKERS': 'register=2'}
+
+    # Time runs out once four records have been started
+    started = []
+    harmonized_file = service.FileImporter.harmonized_file
+
+    def start(importer, record):
+        started.append(record)
+        return harmonized_file(importer, record)
+
+    with patch.dict(os.environ, env), \
+            patch.object(service.FileImporter, 'harmonized_file', start), \
+            patch('service.running_out_of_time',
+                  side_effect=lambda context: len(started) >= 4), \
+            patch('service.boto3.client') as client:
+        res = service.handler(event, Context())
+
+    assert len(res) == 4
+    # Records in flight when time ran out are paused
+    paused = [r for r in res.values() if r['stage'] == service.PAUSED]
+    assert all(r['stage'] in ('done', service.PAUSED) for r in res.values())
+    _, args = client().invoke.call_args
+    payload = json.loads(args['Payload'].decode('utf-8'))
+    assert len(payload['Records']) == len(paused) + 2
+    assert all('progress' in r for r in payload['Records'][:len(paused)])
+    assert payload['Records'][len(paused):] == recs[4:]
+
+
+@mock_s3
+def test_source_file_error(records, dataservice):
+    """ Test that failing to find the source file fails only the record """
+    recs = records(n=1)
+    importer = service.FileImporter('http://api.com/', None)
+    err = service.EndpointConnectionError(endpoint_url='https://s3')
+
+    with patch.object(importer, 'source_file', side_effect=err):
+        res = importer.import_from_event(recs[0])
+    assert res['harmonized'] == 'imported'
+    assert res['source'] == str(err)
+    assert res['retry'] is True
+    assert res['stage'] == 'read_tags'
+
+    # A malformed progress marker is not worth retrying
+    res = importer.import_from_event(dict(recs[0], progress={
+        'harmonized': 'GF_00000001', 'tags': {}}))
+    assert res['source'] == "'cavatica_source_path'"
+    assert res['retry'] is False
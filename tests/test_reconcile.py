@@ -0,0 +1,154 @@
+import os
+import json
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch, MagicMock
+import reconcile
+import service
+
+BUCKET = 'kf-study-us-east-1-dev-sd-9pyzahhe'
+REPORT_BUCKET = 'kf-reports'
+
+
+def page(results, next_page=None):
+    resp = MagicMock()
+    resp.status_code = 200
+    body = {'results': results, '_links': {}}
+    if next_page:
+        body['_links']['next'] = next_page
+    resp.json.return_value = body
+    return resp
+
+
+def genomic_file(key, etag, kf_id, bucket=BUCKET):
+    return {'kf_id': kf_id, 'hashes': {'etag': etag},
+            'urls': ['s3://{}/{}'.format(bucket, key)]}
+
+
+@pytest.fixture(scope='function')
+def study():
+    @mock_s3
+    def with_study():
+        """
+        Puts objects in s3 and returns the two pages of genomic files that
+        the dataservice would return for the study
+        """
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.create_bucket(Bucket=REPORT_BUCKET)
+        etags = {}
+        for i in range(5):
+            key = 'harmonized/{}.cram'.format(i)
+            s3.put_object(Bucket=BUCKET, Key=key, Body=str(i).encode())
+            etags[key] = s3.head_object(Bucket=BUCKET,
+                                        Key=key)['ETag'].replace('"', '')
+
+        first = [
+            genomic_file('harmonized/0.cram', etags['harmonized/0.cram'], 'GF_0'),
+            genomic_file('harmonized/1.cram', 'bad', 'GF_1'),
+            # A source file in another bucket should be ignored
+            genomic_file('source/1.bam', 'abc', 'GF_S', bucket='kf-seq-data'),
+        ]
+        second = [
+            genomic_file('harmonized/2.cram', etags['harmonized/2.cram'], 'GF_2'),
+            genomic_file('harmonized/9.cram', 'gone', 'GF_9'),
+        ]
+        return [
+            page(first, '/genomic-files?study_id=SD_9PYZAHHE&after=1'),
+            page(second)
+        ]
+    return with_study
+
+
+def test_get_genomic_files():
+    """ Test that all pages of genomic files are retrieved """
+    mock = patch('service.requests')
+    req = mock.start()
+    req.get.side_effect = [page([{'kf_id': 'GF_0'}], '/genomic-files?after=1'),
+                           page([{'kf_id': 'GF_1'}])]
+
+    importer = service.FileImporter('http://api.com/', None)
+    gfs = list(importer.get_genomic_files('SD_00000000'))
+
+    assert [gf['kf_id'] for gf in gfs] == ['GF_0', 'GF_1']
+    req.get.assert_any_call('http://api.com/genomic-files'
+                            '?study_id=SD_00000000&limit=100')
+    req.get.assert_any_call('http://api.com/genomic-files?after=1')
+
+    mock.stop()
+
+
+@mock_s3
+def test_reconcile(study):
+    """ Test that all kinds of discrepancies are found """
+    study = study()
+    s3 = boto3.resource('s3')
+    objects = s3.Bucket(BUCKET).objects.all()
+
+    with reconcile.Reconciler(BUCKET, partitions=3) as rec:
+        rec.index_dataservice(study[0].json()['results'] +
+                              study[1].json()['results'])
+        rec.index_s3(objects)
+        diff = {(d['kind'], d['key']) for d in rec.diff()}
+        workdir = rec.workdir
+
+    assert diff == {
+        (reconcile.ETAG_MISMATCH, 'harmonized/1.cram'),
+        (reconcile.MISSING_IN_DATASERVICE, 'harmonized/3.cram'),
+        (reconcile.MISSING_IN_DATASERVICE, 'harmonized/4.cram'),
+        (reconcile.MISSING_IN_S3, 'harmonized/9.cram'),
+    }
+    assert not os.path.exists(workdir)
+
+
+@mock_s3
+def test_handler_dispatch(study):
+    """ Test that only the missing objects are dispatched for import """
+    os.environ['DATASERVICE_API'] = 'http://api.com/'
+    mock = patch('service.requests')
+    req = mock.start()
+    req.get.side_effect = study()
+
+    dispatched = []
+    with patch('reconcile.invoker.dispatcher') as dispatcher, \
+            patch.dict(os.environ, {'FILEREGISTRY': 'fileregistry'}):
+        dispatcher.return_value = dispatched.append
+        res = reconcile.handler({
+            'bucket': BUCKET,
+            'dispatch': True,
+            'report': 's3://{}/reconcile.jsonl'.format(REPORT_BUCKET)
+        }, {})
+
+    assert res == {
+        reconcile.MISSING_IN_DATASERVICE: 2,
+        reconcile.MISSING_IN_S3: 1,
+        reconcile.ETAG_MISMATCH: 1,
+        'dispatched': 1
+    }
+    assert len(dispatched) == 1
+    assert dispatched[0]['Batch']['bucket'] == BUCKET
+    assert sorted(dispatched[0]['Batch']['keys']) == ['harmonized/3.cram',
+                                                      'harmonized/4.cram']
+
+    body = boto3.client('s3').get_object(Bucket=REPORT_BUCKET,
+                                         Key='reconcile.jsonl')['Body']
+    report = [json.loads(l) for l in body.read().decode().splitlines()]
+    assert len(report) == 4
+
+    mock.stop()
+
+
+def test_handler_dispatch_unconfigured():
+    """ Test that dispatching without a fileregistry fails before paging """
+    env = {'DATASERVICE_API': 'http://api.com/'}
+    with patch.dict(os.environ, env), \
+            patch('reconcile.Reconciler') as rec, \
+            patch('reconcile.service.requests') as req:
+        os.environ.pop('FILEREGISTRY', None)
+        os.environ.pop('FILEREGISTRY_QUEUE', None)
+        res = reconcile.handler({'bucket': BUCKET, 'dispatch': True}, {})
+
+    assert res == 'no fileregistry or queue specified to dispatch to'
+    assert rec.call_count == 0
+    assert req.get.call_count == 0
@@ -0,0 +1,137 @@
+import os
+import json
+from moto import mock_s3
+from mock import patch, MagicMock
+import asyncimporter
+import pipeline
+import service
+
+from tests.calls import CallCounter
+from tests.context import Context
+from tests.test_asyncimporter import import_many, no_aiohttp
+from tests.test_service import BUCKET, SOURCE_BUCKET
+
+
+@mock_s3
+def test_timeout_between_files(records, dataservice):
+    """ Test that a record paused between its files resumes at the source """
+    recs = records(n=2)
+    os.environ['DATASERVICE_API'] = 'http://api.com/'
+
+    # Time runs out once the first harmonized file is registered
+    with patch('service.running_out_of_time',
+               side_effect=[False, True, True]), \
+            patch('service.boto3.client') as client:
+        res = service.handler({'Records': recs}, Context())
+
+    name = '{}/{}'.format(BUCKET, recs[0]['s3']['object']['key'])
+    assert res[name]['stage'] == service.PAUSED
+    assert res[name]['harmonized'] == 'imported'
+    assert res[name]['source'] == 'not imported'
+    harmonized = res[name]['kf_ids'][0]
+
+    _, args = client().invoke.call_args
+    payload = json.loads(args['Payload'].decode('utf-8'))
+    assert [r['s3']['object']['key'] for r in payload['Records']] == \
+        [r['s3']['object']['key'] for r in recs]
+    progress = payload['Records'][0]['progress']
+    assert progress['harmonized'] == harmonized
+    assert progress['tags']['cavatica_source_path'] == \
+        '{}/source/0.bam'.format(SOURCE_BUCKET)
+    assert 'progress' not in payload['Records'][1]
+
+    # The re-invocation goes straight to the source file
+    with patch('service.running_out_of_time', return_value=False), \
+            patch('service.s3_clients', service.S3ClientPool()), \
+            CallCounter(dataservice) as counter:
+        res = service.handler({'Records': payload['Records'][:1]},
+                              Context())
+
+    assert res[name]['stage'] == 'done'
+    assert res[name]['source'] == 'imported'
+    assert res[name]['kf_ids'][0] == harmonized
+    assert len(res[name]['kf_ids']) == 2
+    counts = counter.counts()
+    # Only the source file's tags are read and no biospecimen is checked
+    assert counts['s3']['GetObjectTagging'] == 1
+    assert counts['dataservice'] == {'GET studies': 1,
+                                     'POST genomic-files': 1}
+
+
+@mock_s3
+def test_retry_resumes(records, dataservice):
+    """ Test that a record that failed at its source file is retried there """
+    recs = records(n=1)
+    importer = service.FileImporter('http://api.com/', None)
+
+    calls = []
+    register = importer.register
+
+    # The harmonized file registers but its source fails transiently once
+    def flaky(f):
+        calls.append(f.harmonized)
+        if not f.harmonized and len(calls) == 2:
+            raise service.TransientException('dataservice responded with 503')
+        register(f)
+
+    with patch.object(importer, 'register', side_effect=flaky):
+        res = importer.import_from_event(recs[0])
+        assert res['retry'] is True
+        assert res['stage'] == 'register'
+        assert res['progress']['harmonized'] == res['kf_ids'][0]
+
+        retried = service.with_progress(recs[0], res)
+        res = importer.import_from_event(retried)
+
+    assert res['stage'] == 'done'
+    assert calls == [True, False, False]
+
+
+@mock_s3
+def test_pipeline_resumes(records, dataservice):
+    """ Test that the pipeline pauses records and resumes them at the source """
+    recs = records(n=4)
+    importer = service.FileImporter('http://api.com/', None)
+    sink = MagicMock()
+
+    # Told to stop once every record is in the pipeline
+    p = pipeline.Pipeline(importer, service.is_transient)
+    first = list(p.run(recs, should_stop=lambda: p.started >= 4, sink=sink))
+    assert len(first) == 4
+    for _, _, res in first:
+        assert res['stage'] == service.PAUSED
+        assert res['harmonized'] == 'imported'
+        assert res['progress']['harmonized'] == res['kf_ids'][0]
+    assert len(dataservice.genomic_files) == 4
+    # Paused records are recorded once they complete
+    assert sink.append.call_count == 0
+
+    p = pipeline.Pipeline(importer, service.is_transient)
+    resumed = [service.with_progress(r, res) for r, _, res in first]
+    results = list(p.run(resumed, sink=sink))
+
+    for _, _, res in results:
+        assert res['stage'] == 'done'
+        assert res['harmonized'] == 'imported'
+        assert len(res['kf_ids']) == 2
+    assert len(dataservice.genomic_files) == 8
+    assert sink.append.call_count == 4
+    # Each stage only saw the source files
+    assert all(s['processed'] == 4 for s in p.report()['stages'].values())
+
+
+@mock_s3
+def test_async_pauses(records, dataservice, no_aiohttp):
+    """ Test that the async importer pauses records once told to stop """
+    recs = records(n=4)
+    importer = service.FileImporter('http://api.com/', None)
+    aimporter = asyncimporter.AsyncFileImporter(None, None, importer=importer)
+
+    results = import_many(aimporter, recs, concurrency=4,
+                          should_stop=lambda: aimporter.started >= 4)
+
+    assert len(results) == 4
+    for _, _, res in results:
+        assert res['stage'] == service.PAUSED
+        assert res['progress']['harmonized'] == res['kf_ids'][0]
+    assert len(dataservice.genomic_files) == 4
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import boto3
+import pytest
+from moto import mock_s3
+from mock import patch, MagicMock
+from botocore.exceptions import ClientError
+from botocore.vendored.requests.exceptions import ConnectionError
+import retry
+import service
+
+from tests.dataservice import DataService
+from tests.context import Context
+from tests.test_service import BUCKET, OBJECT, obj, event
+from tests.test_sqs import sqs_event
+
+RETRY_BUCKET = 'kf-fileregistry-retry'
+
+
+def response(status_code):
+    resp = MagicMock()
+    resp.status_code = status_code
+    return resp
+
+
+@pytest.mark.parametrize('status_code,exception', [
+    (404, service.ImportException),
+    (429, service.TransientException),
+    (503, service.TransientException),
+])
+@mock_s3
+def test_biospecimen_status(event, obj, status_code, exception):
+    """ Test that biospecimen lookups fail transiently for server errors """
+    obj()
+    mock = patch('service.requests')
+    req = mock.start()
+    req.get.return_value = response(status_code)
+
+    importer = service.FileImporter('http://api.com/', None)
+    with pytest.raises(exception):
+        importer.import_harmonized(event['Records'][0])
+
+    mock.stop()
+
+
+def test_request_error_is_transient():
+    """ Test that failing to connect to the dataservice is transient """
+    mock = patch('service.requests')
+    req = mock.start()
+    req.post.side_effect = ConnectionError('refused')
+
+    importer = service.FileImporter('http://api.com/', None)
+    with pytest.raises(service.TransientException):
+        importer.new_file(BUCKET, OBJECT, 'abc', 1024)
+
+    mock.stop()
+
+
+@pytest.mark.parametrize('err,transient', [
+    (service.TransientException('dataservice responded with 503'), True),
+    (service.DataServiceException('bad dataservice response'), False),
+    (service.ImportException("missing required tag(s) ['bs_id']"), False),
+    (ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObjectTagging'), True),
+    (ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObjectTagging'), False),
+])
+def test_is_transient(err, transient):
+    """ Test that errors are classified as transient or permanent """
+    assert service.is_transient(err) == transient
+
+
+@mock_s3
+def test_handler_stores_transient(event, obj):
+    """ Test that only transient failures are stored for replay """
+    obj()
+    boto3.client('s3').create_bucket(Bucket=RETRY_BUCKET)
+    env = patch.dict(os.environ, {
+        'DATASERVICE_API': 'http://api.com/',
+        'RETRY_LOCATION': 's3://{}/retry'.format(RETRY_BUCKET)
+    })
+    env.start()
+    mock = patch('service.requests', DataService(post_status=503))
+    mock.start()
+
+    # The second record does not exist which is not worth retrying
+    missing = dict(event['Records'][0])
+    missing['s3'] = {'bucket': {'name': BUCKET},
+                     'object': {'key': 'missing', 'size': 1, 'eTag': 'a'}}
+    event['Records'].append(missing)
+    event['run_id'] = 'run1'
+    service.handler(event, {})
+
+    store = retry.store_from_env()
+    keys = list(store.eligible(now=time.time() + retry.BASE_DELAY))
+    assert len(keys) == 1
+    batch = store.get(keys[0])
+    assert batch['attempt'] == 2
+    assert len(batch['items']) == 1
+    assert batch['items'][0]['record'] == event['Records'][0]
+    assert batch['items'][0]['error'] == 'dataservice responded with 503'
+    assert batch['items'][0]['run_id'] == 'run1'
+
+    mock.stop()
+    env.stop()
+
+
+@mock_s3
+def test_replay(event, obj):
+    """ Test that eligible batches are replayed and backed off on failure """
+    obj()
+    boto3.client('s3').create_bucket(Bucket=RETRY_BUCKET)
+    env = patch.dict(os.environ, {
+        'DATASERVICE_API': 'http://api.com/',
+        'RETRY_LOCATION': 's3://{}/retry/'.format(RETRY_BUCKET)
+    })
+    env.start()
+    store = retry.store_from_env()
+    items = [{'record': event['Records'][0], 'error': 'timeout',
+              'run_id': 'run1'}]
+    past = time.time() - retry.MAX_DELAY
+    store.put(items, attempt=2, now=past)
+    # Not yet eligible
+    store.put(items, attempt=2, now=time.time())
+
+    ds = DataService(post_status=503)
+    mock = patch('service.requests', ds)
+    mock.start()
+    sink = MagicMock()
+    with patch('service.outcomes.sink_from_env', return_value=sink):
+        res = service.replay({}, {})
+    assert res == {'batches': 1, 'records': 1, 'failed': 1}
+    # The outcome is recorded against the run the record failed in
+    assert sink.append.call_args[0][-1] == 'run1'
+
+    # The failed record is stored again with a longer delay
+    keys = list(store.eligible(now=time.time() + retry.MAX_DELAY))
+    batches = [store.get(k) for k in keys]
+    assert sorted(b['attempt'] for b in batches) == [2, 3]
+    assert all(b['items'][0]['run_id'] == 'run1' for b in batches)
+    assert list(store.eligible()) == []
+
+    # Make the retried batch eligible and let it succeed
+    ds.post_status = 201
+    with patch('retry.time') as t:
+        t.time.return_value = time.time() + retry.MAX_DELAY
+        res = service.replay({}, {})
+    assert res == {'batches': 2, 'records': 2, 'failed': 0}
+    assert list(store.eligible(now=time.time() + retry.MAX_DELAY)) == []
+
+    mock.stop()
+    env.stop()
+
+
+@mock_s3
+def test_dead_letter():
+    """ Test that batches are not retried after the last attempt """
+    boto3.client('s3').create_bucket(Bucket=RETRY_BUCKET)
+    store = retry.RetryStore(RETRY_BUCKET, 'retry/', max_attempts=3)
+
+    key = store.put([{'record': {}, 'error': 'timeout'}], attempt=4, now=0)
+
+    assert key.startswith('retry/dead/')
+    assert list(store.eligible()) == []
+
+
+def test_backoff():
+    """ Test that delays double with each attempt up to the maximum """
+    assert retry.backoff(2) == retry.BASE_DELAY
+    assert retry.backoff(3) == 2 * retry.BASE_DELAY
+    assert retry.backoff(50) == retry.MAX_DELAY
+
+
+def unknown_format(record):
+    """ Copies the object of a record to a key with an unknown extension """
+    s3 = boto3.client('s3')
+    key = record['s3']['object']['key']
+    unknown = key.replace('.cram', '.xyz')
+    tags = s3.get_object_tagging(Bucket=BUCKET, Key=key)
+    s3.put_object(Bucket=BUCKET, Key=unknown, Body=b'test')
+    s3.put_object_tagging(Bucket=BUCKET, Key=unknown,
+                          Tagging={'TagSet': tags['TagSet']})
+    record = json.loads(json.dumps(record))
+    record['s3']['object']['key'] = unknown
+    return record
+
+
+@pytest.mark.parametrize('mode', ['serial', 'pipeline'])
+@mock_s3
+def test_unknown_file_format(records, dataservice, mode):
+    """ Test that an unknown file format fails only its record for good """
+    recs = records(n=2)
+    recs[1] = unknown_format(recs[1])
+    env = {'DATASERVICE_API': 'http://api.com/'}
+    if mode == 'pipeline':
+        env['PIPELINE_WORKERS'] = 'true'
+
+    with patch.dict(os.environ, env):
+        res = service.handler({'Records': recs}, Context())
+
+    ok, unknown = ['{}/{}'.format(BUCKET, r['s3']['object']['key'])
+                   for r in recs]
+    assert res[ok]['stage'] == 'done'
+    assert res[unknown]['harmonized'] == 'unknown file format 1.xyz'
+    assert res[unknown]['retry'] is False
+
+
+@mock_s3
+def test_sqs_unknown_file_format(records, dataservice):
+    """ Test that a message with an unknown file format is not retried """
+    recs = records(n=1)
+    event = {'Records': [unknown_format(recs[0])]}
+
+    with patch.dict(os.environ, {'DATASERVICE_API': 'http://api.com/'}):
+        res = service.handler(sqs_event([event]), Context())
+
+    assert res == {'batchItemFailures': []}
@@ -98,7 +98,9 @@ def test_out_of_time(event, obj):
         assert args['FunctionName'] == Context().invoked_function_arn
         assert args['InvocationType'] == 'Event'
         payload = json.loads(args['Payload'].decode('utf-8'))
-        assert  payload == {'Records': [event['Records'][1]]}
+        assert payload['Records'] == [event['Records'][1]]
+        # The re-invocation is traced back to this invocation
+        assert payload['trace']['parent'] is not None
 
     mock_r.stop()
 
@@ -0,0 +1,97 @@
+import json
+import time
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from slack import SlackNotifier, progress_attachments
+
+
+@pytest.fixture(scope='function')
+def slack_api():
+    """ A local stand-in for the slack api that records posted messages """
+    messages = []
+
+    class Handler(BaseHTTPRequestHandler):
+        delay = 0
+
+        def do_POST(self):
+            time.sleep(Handler.delay)
+            length = int(self.headers['Content-Length'])
+            messages.append(json.loads(self.rfile.read(length).decode()))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{"ok": true}')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.messages = messages
+    server.handler = Handler
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    yield server
+    server.shutdown()
+
+
+def test_send(slack_api):
+    """ Test that messages are sent to every channel """
+    slack = SlackNotifier('abc', ['kf-dev', 'kf-ops'], url=slack_api.url)
+    slack.start()
+    slack.send('hello')
+    slack.stop()
+
+    assert [m['channel'] for m in slack_api.messages] == ['kf-dev', 'kf-ops']
+    assert slack_api.messages[0]['text'] == 'hello'
+
+
+def test_progress_coalesced(slack_api):
+    """ Test that progress updates are throttled to the latest one """
+    slack = SlackNotifier('abc', ['kf-dev'], url=slack_api.url, interval=0.2)
+    slack.start()
+    start = time.time()
+    for i in range(1, 1001):
+        slack.progress('bucket/', i * 10, i, start)
+        time.sleep(0.0005)
+    time.sleep(0.3)
+    slack.stop()
+
+    assert 0 < len(slack_api.messages) < 10
+    fields = slack_api.messages[-1]['attachments'][0]['fields']
+    assert fields[0]['value'] == 10000
+    assert fields[1]['value'] == 1000
+
+
+def test_backpressure(slack_api):
+    """ Test that sending never blocks and drops messages when backed up """
+    slack_api.handler.delay = 0.2
+    slack = SlackNotifier('abc', ['kf-dev'], url=slack_api.url, max_queue=2)
+    slack.start()
+
+    start = time.time()
+    for i in range(20):
+        slack.send('message {}'.format(i))
+    assert time.time() - start < 0.1
+    assert slack.dropped >= 17
+
+    slack_api.handler.delay = 0
+    slack.stop(timeout=1)
+
+
+def test_disabled():
+    """ Test that nothing is started without a token """
+    slack = SlackNotifier(None, ['kf-dev']).start()
+    slack.send('hello')
+    slack.progress('bucket/', 1, 1, time.time())
+    assert slack.queue.empty()
+    slack.stop()
+
+
+def test_progress_rate():
+    """ Test that the rate objects are listed at is given """
+    attachments = progress_attachments('bucket/', 50, 5, time.time() - 10)
+    fields = attachments[0]['fields']
+    assert fields[2] == {'title': 'Rate', 'value': '5/s', 'short': True}
+    assert len(fields) == 3
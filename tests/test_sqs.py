@@ -0,0 +1,173 @@
+import os
+import json
+import boto3
+import pytest
+from moto import mock_s3, mock_sqs
+from mock import patch, MagicMock
+import invoker
+import service
+
+from tests.context import Context
+from tests.test_service import BUCKET, obj, event
+
+
+@pytest.fixture(autouse=True)
+def api():
+    with patch.dict(os.environ, {'DATASERVICE_API': 'http://api.com/'}):
+        yield
+
+
+def sqs_event(bodies):
+    """ Wraps message bodies in an SQS event as delivered to a lambda """
+    return {'Records': [
+        {
+            'messageId': str(i),
+            'receiptHandle': 'handle-{}'.format(i),
+            'body': json.dumps(body),
+            'eventSource': 'aws:sqs',
+            'eventSourceARN': 'arn:aws:sqs:us-east-1:000000000000:registry'
+        }
+        for i, body in enumerate(bodies)
+    ]}
+
+
+def mock_dataservice(req, post_status=201):
+    def mock_get(url, *args, **kwargs):
+        resp = MagicMock()
+        if '/genomic-files' in url:
+            resp.status_code = 404
+        elif '/biospecimens' in url:
+            resp.status_code = 200
+        elif '/studies' in url:
+            resp.status_code = 200
+            resp.json.return_value = {'results': {'external_id': 'SD'}}
+        return resp
+
+    req.get.side_effect = mock_get
+    mock_resp = MagicMock()
+    mock_resp.json.return_value = {'results': {'kf_id': 'GF_00000000'}}
+    mock_resp.status_code = post_status
+    req.post.return_value = mock_resp
+
+
+@mock_s3
+def test_sqs_s3_notification(event, obj):
+    """ Test that s3 notifications inside SQS messages are imported """
+    obj()
+    mock = patch('service.requests')
+    req = mock.start()
+    mock_dataservice(req)
+
+    res = service.handler(sqs_event([event, {'Event': 's3:TestEvent'}]),
+                          Context())
+
+    assert res == {'batchItemFailures': []}
+    # Harmonized and source file
+    assert req.post.call_count == 2
+
+    mock.stop()
+
+
+@mock_s3
+def test_sqs_transient_failure(event, obj):
+    """ Test that only messages that failed transiently are retried """
+    obj()
+    mock = patch('service.requests')
+    req = mock.start()
+    mock_dataservice(req, post_status=500)
+
+    # The second message is missing its required tags which is permanent
+    missing = json.loads(json.dumps(event))
+    missing['Records'][0]['s3']['object']['key'] = 'harmonized/untagged.cram'
+    boto3.client('s3').put_object(Bucket=BUCKET, Key='harmonized/untagged.cram',
+                                  Body=b'test')
+
+    res = service.handler(sqs_event([event, missing]), Context())
+
+    assert res == {'batchItemFailures': [{'itemIdentifier': '0'}]}
+
+    mock.stop()
+
+
+@mock_s3
+def test_sqs_out_of_time(event, obj):
+    """ Test that unprocessed messages are returned to the queue """
+    obj()
+    mock = patch('service.requests')
+    req = mock.start()
+    mock_dataservice(req)
+
+    res = service.handler(sqs_event([event, event, event]), Context(300))
+
+    assert res == {'batchItemFailures': [{'itemIdentifier': '1'},
+                                         {'itemIdentifier': '2'}]}
+    assert req.post.call_count == 2
+
+    mock.stop()
+
+
+@mock_sqs
+@mock_s3
+def test_sqs_source_redelivered(event, obj):
+    """ Test that a source file that failed transiently is retried """
+    obj()
+    sqs = boto3.client('sqs')
+    queue = sqs.create_queue(QueueName='registry')['QueueUrl']
+    mock = patch('service.requests')
+    req = mock.start()
+    mock_dataservice(req)
+    registered, unavailable = MagicMock(), MagicMock()
+    registered.status_code = 201
+    registered.json.return_value = {'results': {'kf_id': 'GF_00000000'}}
+    unavailable.status_code = 503
+    # The harmonized file is registered but the source file is not
+    req.post.side_effect = [registered, unavailable]
+
+    with patch('retry.BASE_DELAY', 0):
+        res = service.handler(sqs_event([event]), Context())
+
+    # The message is acknowledged and the record is sent back to the queue
+    assert res == {'batchItemFailures': []}
+    messages = sqs.receive_message(QueueUrl=queue)['Messages']
+    assert len(messages) == 1
+    body = json.loads(messages[0]['Body'])
+    assert body['attempt'] == 2
+    assert body['Records'][0]['progress']['harmonized'] == 'GF_00000000'
+
+    # Delivered again, only the source file is registered
+    req.post.side_effect = None
+    req.post.return_value = registered
+    res = service.handler(sqs_event([body]), Context())
+
+    assert res == {'batchItemFailures': []}
+    assert req.post.call_count == 3
+    _, kwargs = req.post.call_args
+    assert kwargs['json']['urls'][0].startswith('s3://kf-seq-data-washu/')
+
+    mock.stop()
+
+
+@mock_sqs
+@mock_s3
+def test_invoker_enqueue():
+    """ Test that the invoker sends batches to a queue when configured """
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    for i in range(15):
+        s3.put_object(Bucket=BUCKET, Key='harmonized/{}.cram'.format(i),
+                      Body=b'test')
+
+    sqs = boto3.client('sqs')
+    queue = sqs.create_queue(QueueName='registry')['QueueUrl']
+    with patch.dict(os.environ, {'FILEREGISTRY_QUEUE': queue}):
+        res = invoker.handler({'bucket': BUCKET, 'prefix': 'harmonized/'},
+                              Context())
+
+    assert res == '15 records processed in 2 calls'
+    messages = sqs.receive_message(QueueUrl=queue,
+                                   MaxNumberOfMessages=10)['Messages']
+    records = [r for m in messages
+               for r in service.iter_records(json.loads(m['Body']))]
+    assert len(messages) == 2
+    assert len(records) == 15
+    assert records[0]['s3']['bucket']['name'] == BUCKET
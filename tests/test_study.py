@@ -0,0 +1,94 @@
+import os
+import boto3
+from moto import mock_s3
+from mock import patch
+import invoker
+import service
+
+from tests.dataservice import DataService
+from tests.context import Context
+from tests.test_service import BUCKET, TAGS
+
+STUDY = {'bucket': BUCKET, 'study_id': 'SD_9PYZAHHE', 'external_id': 'phs1',
+         'biospecimens': ['BS_QV3Z0DZM']}
+
+
+def test_resolve_study():
+    """ Test that the study of a bucket is resolved with its biospecimens """
+    ds = DataService(biospecimens=['BS_1', 'BS_2'])
+    importer = service.FileImporter(ds.api, None)
+    with patch('service.requests', ds):
+        assert importer.resolve_study(BUCKET) == {
+            'bucket': BUCKET, 'study_id': 'SD_9PYZAHHE', 'external_id': 'SD'}
+        study = importer.resolve_study(BUCKET, biospecimens=True)
+        assert study['biospecimens'] == ['BS_1', 'BS_2']
+
+        # Too many biospecimens to carry in a payload
+        with patch('service.MAX_CONTEXT_BIOSPECIMENS', 1):
+            study = importer.resolve_study(BUCKET, biospecimens=True)
+            assert 'biospecimens' not in study
+
+    # The external_id is only looked up once
+    assert ds.calls.count(('GET', 'studies/SD_9PYZAHHE')) == 1
+
+
+def test_use_study():
+    """ Test that lookups are skipped for the study given by the invoker """
+    ds = DataService()
+    importer = service.FileImporter(ds.api, None)
+    importer.use_study(STUDY)
+    tags = {t['Key']: t['Value'] for t in TAGS['TagSet']
+            if t['Key'] != 'gf_id'}
+
+    with patch('service.requests', ds):
+        assert importer.get_external_id('SD_9PYZAHHE') == 'phs1'
+        f = service.ImportFile(None, BUCKET, 'harmonized/0.cram')
+        f.tags = dict(tags)
+        importer.check(f)
+        # Biospecimens not in the study are still looked up
+        f.tags['bs_id'] = 'BS_00000000'
+        importer.check(f)
+
+    assert ds.calls == [('GET', 'biospecimens/BS_00000000')]
+    assert importer.study_ids == {BUCKET: 'SD_9PYZAHHE'}
+
+    # A missing study changes nothing
+    importer = service.FileImporter(ds.api, None)
+    importer.use_study(None)
+    assert importer.external_ids == {} and importer.biospecimens == set()
+
+
+@mock_s3
+def test_invoker_embeds_study():
+    """ Test that the study is resolved once and sent with every batch """
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    for i in range(25):
+        s3.put_object(Bucket=BUCKET, Key='harmonized/{}.cram'.format(i),
+                      Body=b'test')
+    ds = DataService(biospecimens=['BS_1'])
+    env = {'FILEREGISTRY': 'kf-fileregistry', 'DATASERVICE_API': ds.api}
+
+    with patch.dict(os.environ, env), \
+            patch('service.requests', ds), \
+            patch('invoker.PREFETCH_BIOSPECIMENS', True), \
+            patch('invoker.invoke') as invoke:
+        invoker.handler({'bucket': BUCKET}, Context())
+
+    payloads = [args[2] for args, _ in invoke.call_args_list]
+    assert len(payloads) == 3
+    for p in payloads:
+        assert p['study'] == {'bucket': BUCKET, 'study_id': 'SD_9PYZAHHE',
+                              'external_id': 'SD', 'biospecimens': ['BS_1']}
+    assert len(ds.calls) == 2
+
+
+def test_invoker_study_unavailable():
+    """ Test that batches are sent without a study if it can't be found """
+    ds = DataService()
+    ds.get.side_effect = service.TransientException('timed out')
+    with patch.dict(os.environ, {'DATASERVICE_API': ds.api}), \
+            patch('service.requests', ds):
+        assert invoker.resolve_study(BUCKET, {}) is None
+    # A study resolved by a parent invoker is used as is
+    assert invoker.resolve_study(BUCKET, {'study': STUDY}) == STUDY
@@ -0,0 +1,92 @@
+import os
+import json
+from moto import mock_s3
+from mock import patch
+import invoker
+import service
+import tracing
+
+from tests.context import Context
+from tests.dataservice import DataService
+from tests.test_service import BUCKET, OBJECT, obj, event
+
+
+def span(name, span_id, start, end, parent=None, sent=None):
+    return {'run_id': 'run-1', 'span': span_id, 'parent': parent,
+            'name': name, 'start': start, 'end': end, 'sent': sent,
+            'stages': {}}
+
+
+def test_propagate():
+    """ Test that payloads link invocations to the span that sent them """
+    logs = []
+    parent = tracing.Tracer('run-1', 'invoker', out=logs.append)
+    payload = parent.propagate({'Batch': {}})
+    assert payload['run_id'] == 'run-1'
+
+    child = tracing.from_event(json.loads(json.dumps(payload)), 'child')
+    child.out = logs.append
+    with child.stage('import'):
+        pass
+    s = child.finish(records=1)
+
+    assert s['run_id'] == 'run-1'
+    assert s['parent'] == parent.span
+    assert s['sent'] == payload['trace']['sent']
+    assert 'import' in s['stages']
+    assert s['records'] == 1
+    assert list(tracing.read_spans(logs)) == [s]
+
+
+def test_new_run():
+    """ Test that an event without a run starts a new one """
+    tracer = tracing.from_event({'bucket': BUCKET}, 'invoker')
+    assert tracer.run_id is not None
+    assert tracer.parent is None
+
+
+def test_timeline():
+    """ Test that the critical path, fan-out and idle gaps are found """
+    spans = [
+        span('invoker', 'a', 100.0, 110.0),
+        span('fileregistry', 'b', 101.0, 105.0, parent='a', sent=100.5),
+        span('fileregistry', 'c', 102.0, 104.0, parent='a', sent=101.0),
+        # A re-invocation that was only started after a gap
+        span('fileregistry', 'd', 115.0, 120.0, parent='b', sent=104.9),
+    ]
+    lines = ['2018-05-01T00:00:00 ' + tracing.PREFIX + json.dumps(s)
+             for s in spans]
+    lines.append('START RequestId: 1234')
+
+    res = tracing.stitch(lines)['run-1']
+
+    assert res['spans'] == 4
+    assert res['duration'] == 20.0
+    assert [p['span'] for p in res['critical_path']] == ['a', 'b', 'd']
+    assert res['critical_path'][-1]['waited'] == 10.1
+    assert res['max_concurrent'] == 3
+    assert res['max_fan_out'] == 2
+    assert res['idle'] == [{'start': 10.0, 'duration': 5.0}]
+
+
+@mock_s3
+def test_run_is_stitched(event, obj):
+    """ Test that spans from the invoker and fileregistry form one run """
+    obj()
+    logs = []
+    with patch('tracing.print', logs.append, create=True), \
+            patch('invoker.invoke') as invoke, \
+            patch('service.requests', DataService()), \
+            patch.dict(os.environ, {'FILEREGISTRY': 'kf-fileregistry',
+                                    'DATASERVICE_API': 'http://api.com/'}):
+        invoker.handler({'bucket': BUCKET, 'prefix': 'harmonized/'},
+                        Context())
+        for args, _ in invoke.call_args_list:
+            service.handler(json.loads(json.dumps(args[2])), Context())
+
+    runs = tracing.stitch(logs)
+    assert len(runs) == 1
+    res = list(runs.values())[0]
+    assert [p['name'] for p in res['critical_path']] == ['invoker',
+                                                         'fileregistry']
+    assert res['max_fan_out'] == 1
@@ -0,0 +1,221 @@
+"""
+Correlates the invocations of an import run and stitches their logs into a
+timeline of the run.
+
+Every invocation logs a single span, a json line prefixed with `SPAN `,
+with the time it started and ended and the seconds spent in each of its
+stages:
+```
+SPAN {"run_id": "...", "span": "...", "parent": "...", "name": "invoker",
+      "start": 1525000000.0, "end": 1525000012.5, "sent": 1525000000.0,
+      "stages": {"list": 9.1, "dispatch": 3.2}}
+```
+Every payload sent by an invocation, whether to a fileregistry, a child
+invoker or a re-invocation of itself, carries the `run_id` of the run and
+a `trace` naming the span that sent it, so that spans can be linked to the
+span of the invocation that caused them:
+```
+{"run_id": "...", "trace": {"parent": "<span>", "sent": 1525000000.0}}
+```
+
+Usage:
+    aws logs filter-log-events --log-group-name ... --filter-pattern SPAN \\
+        --output text > spans.log
+    python tracing.py spans.log [<run_id>]
+"""
+import sys
+import json
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+PREFIX = 'SPAN '
+# Gaps in a run shorter than this many seconds are not reported
+MIN_GAP = 1.0
+
+
+def from_event(event, name):
+    """
+    Returns a `Tracer` for an invocation caused by the given event, which
+    starts a new run if the event is not part of one
+    """
+    trace = event.get('trace', None) or {}
+    return Tracer(event.get('run_id', None) or uuid.uuid4().hex, name,
+                  parent=trace.get('parent', None),
+                  sent=trace.get('sent', None))
+
+
+class Tracer:
+    """
+    Times the stages of a single invocation and links the payloads it
+    sends back to it
+    """
+
+    def __init__(self, run_id, name, parent=None, sent=None, out=None):
+        self.run_id = run_id
+        self.name = name
+        self.parent = parent
+        self.sent = sent
+        self.out = out or print
+        self.span = uuid.uuid4().hex[:16]
+        self.start = time.time()
+        self.stages = defaultdict(float)
+
+    def propagate(self, payload):
+        """
+        Adds the run and this span to a payload that is about to be sent
+        """
+        payload['run_id'] = self.run_id
+        payload['trace'] = {'parent': self.span, 'sent': time.time()}
+        return payload
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Adds the time spent in the block to a stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.time() - start
+
+    def timed(self, name, func):
+        """
+        Wraps a function so that the time spent in it is added to a stage
+        """
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def iterate(self, name, iterable):
+        """
+        Yields from an iterable, adding the time spent waiting on each item
+        to a stage, eg: listing objects from s3
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def finish(self, **attrs):
+        """
+        Logs the span of the invocation
+
+        :param attrs: Any counts to log with the span, eg: records
+        """
+        span = {
+            'run_id': self.run_id,
+            'span': self.span,
+            'parent': self.parent,
+            'name': self.name,
+            'start': round(self.start, 3),
+            'end': round(time.time(), 3),
+            'sent': self.sent,
+            'stages': {k: round(v, 3) for k, v in self.stages.items()}
+        }
+        span.update(attrs)
+        self.out(PREFIX + json.dumps(span))
+        return span
+
+
+def read_spans(lines):
+    """
+    Yields spans from log lines, ignoring anything that is not a span such
+    as timestamps that prefix exported log lines
+    """
+    for line in lines:
+        i = line.find(PREFIX)
+        if i < 0:
+            continue
+        try:
+            yield json.loads(line[i + len(PREFIX):])
+        except ValueError:
+            continue
+
+
+def timeline(spans, min_gap=MIN_GAP):
+    """
+    Stitches the spans of a run together
+
+    :returns: A dict with the duration of the run, the critical path from
+        the first span to the one that ended last, the most invocations
+        running at once and started by any one span, and the gaps in which
+        no invocation was running
+    """
+    spans = {s['span']: s for s in spans}
+    if len(spans) == 0:
+        return None
+    start = min(s['start'] for s in spans.values())
+    end = max(s['end'] for s in spans.values())
+
+    children = defaultdict(int)
+    for s in spans.values():
+        if s.get('parent') in spans:
+            children[s['parent']] += 1
+
+    # Walk back from the last span to finish through its parents
+    path = []
+    span = max(spans.values(), key=lambda s: s['end'])
+    while span is not None:
+        sent = span.get('sent')
+        path.append({
+            'span': span['span'],
+            'name': span['name'],
+            'start': round(span['start'] - start, 3),
+            'duration': round(span['end'] - span['start'], 3),
+            'waited': round(span['start'] - sent, 3) if sent else None,
+            'stages': span.get('stages', {})
+        })
+        span = spans.get(span.get('parent'))
+    path.reverse()
+
+    # Sweep over starts and ends for concurrency and idle time
+    events = sorted([(s['start'], 1) for s in spans.values()] +
+                    [(s['end'], -1) for s in spans.values()])
+    running = width = 0
+    gaps = []
+    idle_since = None
+    for t, change in events:
+        if running == 0 and idle_since is not None and t - idle_since >= min_gap:
+            gaps.append({'start': round(idle_since - start, 3),
+                         'duration': round(t - idle_since, 3)})
+        running += change
+        width = max(width, running)
+        idle_since = t if running == 0 else None
+
+    return {
+        'spans': len(spans),
+        'duration': round(end - start, 3),
+        'critical_path': path,
+        'max_concurrent': width,
+        'max_fan_out': max(children.values()) if children else 0,
+        'idle': gaps
+    }
+
+
+def stitch(lines, run_id=None):
+    """
+    Groups spans by run and returns the timeline of each
+    """
+    runs = defaultdict(list)
+    for span in read_spans(lines):
+        if run_id is None or span['run_id'] == run_id:
+            runs[span['run_id']].append(span)
+    return {r: timeline(spans) for r, spans in runs.items()}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print(__doc__)
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        runs = stitch(f, sys.argv[2] if len(sys.argv) == 3 else None)
+    print(json.dumps(runs, indent=2))